@@ -11,10 +11,10 @@ import pickle
 import re
 import sys
 from GitTktCache import GitTktCache
+from GitTktFolder import GitTktError
 from xml.etree import ElementTree
 
 LS_TREE_RE = re.compile('((\d{6}) (tree|blob)) ([0-9a-f]{40})\t(start|(.+))$')
-class GitTktError(Exception):pass
 
 class TicketField(object):
     """
@@ -189,6 +189,10 @@ class GitTkt(object):
 
         command = command[0].upper() + command[1:]
         function = getattr(self,command)
-        return function(args,kwargs)
+        try:
+            with gitshelve.operation(command):
+                return function(args,kwargs)
+        finally:
+            self.cache.Close()
 
 
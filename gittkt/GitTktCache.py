@@ -1,17 +1,33 @@
 from GitTktFolder import GitTktFolder
+import GitTktDatabase
+import gitshelve
 import sys
 
 GITTKT_DEFAULT_FOLDER = 'active'
 class GitTktCache(object):
     gitTktFolders = {}
-    def __init__(self, folders, fields, branch, outstream = None):
+    database = None
+    def __init__(self, folders, fields, branch, outstream = None,
+                 useDatabase = True):
         if outstream is None:
             outstream = sys.stdout
         if folders is None:
             folders = [GITTKT_DEFAULT_FOLDER]
+        #all the folders are read from one shelf of the branch
+        self.shelf = gitshelve.gitshelve(branch)
+        #and their tickets are queried in one database, opened when needed
+        if useDatabase:
+            self.database = GitTktDatabase.Open(branch,fields)
+        self.gitTktFolders = {}
         for folder in folders:
             self.gitTktFolders[folder] = GitTktFolder(folder,fields,branch,
-                outstream)
+                outstream,self.shelf,self.database)
+
+    def Close(self):
+        for folder in self.gitTktFolders.values():
+            folder.Close()
+        if self.database is not None:
+            self.database.Close()
 
     def Add(self,ticketData,folder = None):
         if folder is None:
@@ -0,0 +1,129 @@
+"""
+    How the data of a ticket is turned into the text of its blob, and back.
+
+    Each blob starts with a line naming the codec that wrote it,
+    "gittkt:<name>", so tickets written one way can still be read after the
+    default changes.  Blobs without that line were written before there were
+    codecs, as str() of the dict, and are read with ast.literal_eval, which
+    unlike eval() can't run anything found in a ticket pulled from a remote.
+    Since anyone can write that line, only the codecs that are safe for any
+    input are read unless others are allowed.
+
+        text = GitTktCodec.Encode(data)             # the default, json
+        text = GitTktCodec.Encode(data,'marshal')
+        data = GitTktCodec.Decode(text)             # json or legacy
+        data = GitTktCodec.Decode(text,('json','marshal'))
+"""
+import ast
+import base64
+from collections import OrderedDict
+import json
+import marshal
+
+MARKER_PREFIX = 'gittkt:'
+DEFAULT_CODEC = 'json'
+SAFE_CODECS = ('json',)
+
+class TicketCodec(object):
+    """
+    Encodes the data of a ticket, a dict of field names to values, as text,
+    and decodes it again.  Register an instance with RegisterCodec to use it.
+    """
+    name = None
+
+    def Encode(self,data):
+        raise NotImplementedError
+
+    def Decode(self,text):
+        raise NotImplementedError
+
+class JsonCodec(TicketCodec):
+    """
+    JSON with one field to a line, in the order of the fields, so that the
+    changes git shows and merges between two versions of a ticket are per
+    field.  Only ascii is written, so the text is the same on every python.
+    """
+    name = 'json'
+
+    def Encode(self,data):
+        return json.dumps(data,indent=0,separators=(',',':'))
+
+    def Decode(self,text):
+        data = json.loads(text,object_pairs_hook=OrderedDict)
+        if not isinstance(data,dict):
+            raise ValueError("A ticket has to be a dict, not %r"%type(data))
+        return data
+
+class MarshalCodec(TicketCodec):
+    """
+    The fields as a marshalled list of pairs, in base64 since blobs are read
+    as text.  It's the quickest to encode and decode, but marshal's format
+    changes between versions of python, and loading a corrupt one can crash
+    the interpreter, so it's only for tickets that are never shared.
+    """
+    name = 'marshal'
+
+    def Encode(self,data):
+        return base64.b64encode(marshal.dumps(list(data.items())))\
+                                                            .decode('ascii')
+
+    def Decode(self,text):
+        return OrderedDict(marshal.loads(base64.b64decode(text)))
+
+class LegacyCodec(TicketCodec):
+    """
+    str() of the dict, as tickets were first written.  This isn't registered,
+    since new tickets shouldn't be written this way, but it's what Decode uses
+    for a blob with no marker.
+    """
+    name = 'legacy'
+
+    def Encode(self,data):
+        return str(dict(data))
+
+    def Decode(self,text):
+        data = ast.literal_eval(text)
+        if not isinstance(data,dict):
+            raise ValueError("A ticket has to be a dict, not %r"%type(data))
+        return OrderedDict(data.items())
+
+codecs = {}
+legacyCodec = LegacyCodec()
+
+def RegisterCodec(codec):
+    """ Makes codec available by its name, replacing any codec of that name """
+    if not codec.name or '\n' in codec.name:
+        raise ValueError("Codec name not valid: %r"%codec.name)
+    codecs[codec.name] = codec
+
+def GetCodec(name):
+    """ Returns the codec registered as name; KeyError if there is none """
+    return codecs[name]
+
+def Encode(data,codecName = DEFAULT_CODEC):
+    """ Returns the text of the blob for the ticket data, marked with the
+        codec it was written with
+    """
+    return "%s%s\n%s"%(MARKER_PREFIX,codecName,
+                       GetCodec(codecName).Encode(data))
+
+def Decode(text,allowed = SAFE_CODECS):
+    """ Returns the ticket data read from the text of a blob, by the codec it
+        was marked with, which has to be one of the names in allowed (blobs
+        with no marker are always read).  Raises ValueError if the text can't
+        be read.
+    """
+    if not text.startswith(MARKER_PREFIX):
+        return legacyCodec.Decode(text)
+    marker,sep,payload = text.partition('\n')
+    codecName = marker[len(MARKER_PREFIX):]
+    if codecName not in allowed:
+        raise ValueError("Ticket codec not allowed: %s"%codecName)
+    try:
+        codec = GetCodec(codecName)
+    except KeyError:
+        raise ValueError("Unknown ticket codec: %s"%codecName)
+    return codec.Decode(payload)
+
+RegisterCodec(JsonCodec())
+RegisterCodec(MarshalCodec())
@@ -0,0 +1,192 @@
+"""
+    A SQLite copy of the tickets of a branch, so that the list command can
+    query them without reading and decoding every ticket.
+
+    The database is a file in the git directory, gittkt/<branch>.sqlite, with
+    a table for each folder.  A table has a row for each ticket, with the
+    ticket's number and uuid and a column for each field, and every field is
+    indexed.  The branch is always written first; each table records the head
+    of the branch it was last brought up to, so that GitTktFolder.List
+    can tell when it's out of date and what to read again.  If the file is
+    lost, or the fields change, a table is rebuilt from the branch.  The file
+    isn't looked for until a folder first needs it.
+"""
+from collections import OrderedDict
+import gitodb
+import gitshelve
+import os
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None      # python built without it; tickets are read instead
+
+RESERVED_COLUMNS = ['num','uuid','creation_date']
+
+def Quote(name):
+    """ Returns name quoted as an SQL identifier """
+    return '"%s"'%name.replace('"','""')
+
+def DatabasePath(branch,repository = None):
+    """ Returns the path of the database of branch, in the git directory """
+    gitDir = gitodb.find_git_dir(repository)
+    if gitDir is None:
+        kwargs = {}
+        if repository:
+            kwargs['repository'] = repository
+        gitDir = gitshelve.git('rev-parse','--git-dir',**kwargs)
+    return os.path.join(os.path.abspath(gitDir),'gittkt','%s.sqlite'%branch)
+
+def Open(branch,fields,repository = None):
+    """ Returns the GitTktDatabase of branch, which is found in the git
+        directory when first used, or None if sqlite3 isn't available
+    """
+    if sqlite3 is None:
+        return None
+    return GitTktDatabase(None,fields,branch,repository)
+
+def Where(columns,query = None,equals = None,notEquals = None,like = None,
+          notLike = None):
+    """ Returns the SQL condition, and its parameters, that a ticket has to
+        meet to be listed: the query, which is SQL, and ALL of equals and like
+        and NONE of notEquals and notLike, which map field names to values or
+        SQL like patterns.  Raises ValueError for a field there is no column
+        for.
+    """
+    conditions = []
+    params = []
+    if query:
+        conditions.append('(%s)'%query)
+    for filters,test in ((equals,'%s = ?'),(notEquals,'%s IS NOT ?'),
+                         (like,'%s LIKE ?'),(notLike,'%s NOT LIKE ?')):
+        if not filters:
+            continue
+        for name,value in filters.items():
+            if name not in columns:
+                raise ValueError("No such field: %s"%name)
+            conditions.append(test%Quote(name))
+            params.append(value)
+    if not conditions:
+        return None,params
+    return ' AND '.join(conditions),params
+
+class GitTktDatabase(object):
+    """
+    The tables of a branch's tickets, one per folder, in the SQLite file at
+    path, or at the DatabasePath of branch if path is None.  fields is the
+    OrderedDict of TicketFields the columns are made from, after num, uuid
+    and creation_date.  The file is opened when it's first used, and again
+    after Close.
+    """
+    path = None
+    branch = None
+    repository = None
+    columns = None
+    connection = None
+
+    def __init__(self,path,fields,branch = None,repository = None):
+        self.path = path
+        self.branch = branch
+        self.repository = repository
+        self.columns = list(RESERVED_COLUMNS)
+        for name in fields:
+            if name not in self.columns:
+                self.columns.append(name)
+
+    def Connection(self):
+        """ Returns the connection to the file, opening it if need be """
+        if self.connection is None:
+            if self.path is None:
+                self.path = DatabasePath(self.branch,self.repository)
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            connection = sqlite3.connect(self.path)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS folders '
+                                   '(name TEXT PRIMARY KEY, head TEXT, '
+                                   'columns TEXT)')
+            self.connection = connection
+        return self.connection
+
+    def Connect(self):
+        """ Opens the file, and returns False if it can't be: outside of a
+            repository, for one
+        """
+        try:
+            self.Connection()
+        except (gitshelve.GitError,sqlite3.Error,IOError,OSError):
+            return False
+        return True
+
+    def Close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def Table(self,name):
+        return Quote('folder/%s'%name)
+
+    def GetHead(self,name):
+        """ Returns the head of the branch the table of folder name was
+            brought up to, or None if it has to be built
+        """
+        row = self.Connection().execute('SELECT head,columns FROM folders '
+                                        'WHERE name = ?',(name,)).fetchone()
+        if row is None or row[1] != '\t'.join(self.columns):
+            return None
+        return row[0]
+
+    def GetIds(self,name):
+        """ Returns a dict of the number to the uuid of each ticket in the
+            table of folder name
+        """
+        return dict(self.Connection().execute('SELECT num,uuid FROM %s'%
+                                              self.Table(name)))
+
+    def Update(self,name,head,tickets,removed = (),rebuild = False):
+        """ Brings the table of folder name up to head of the branch, in a
+            single transaction: the tickets with the numbers in removed are
+            deleted and tickets, the data of each ticket to add or change, is
+            written.  If rebuild is set, the table is emptied first.
+        """
+        table = self.Table(name)
+        connection = self.Connection()
+        with connection:
+            if rebuild:
+                self.__CreateTable(connection,name)
+            connection.executemany('DELETE FROM %s WHERE num = ?'%table,
+                                   [(num,) for num in removed])
+            connection.executemany('INSERT OR REPLACE INTO %s VALUES '
+                '(%s)'%(table,','.join('?' * len(self.columns))),
+                (self.__Row(ticketData) for ticketData in tickets))
+            connection.execute('INSERT OR REPLACE INTO folders VALUES '
+                               '(?,?,?)',(name,head,'\t'.join(self.columns)))
+
+    def __CreateTable(self,connection,name):
+        table = self.Table(name)
+        connection.execute('DROP TABLE IF EXISTS %s'%table)
+        columns = ['num INTEGER PRIMARY KEY','uuid TEXT UNIQUE NOT NULL']
+        columns += [Quote(column) for column in self.columns[2:]]
+        connection.execute('CREATE TABLE %s (%s)'%(table,','.join(columns)))
+        for column in self.columns[2:]:
+            connection.execute('CREATE INDEX %s ON %s (%s)'%(
+                Quote('folder/%s/%s'%(name,column)),table,Quote(column)))
+
+    def __Row(self,ticketData):
+        row = []
+        for column in self.columns:
+            value = ticketData.get(column)
+            if value is not None and not isinstance(value,(int,float)):
+                value = '%s'%(value,)
+            row.append(value)
+        return row
+
+    def Select(self,name,where = None,params = ()):
+        """ Yields the data of the tickets in the table of folder name that
+            meet the condition where, in order of their numbers
+        """
+        sql = 'SELECT * FROM %s'%self.Table(name)
+        if where:
+            sql += ' WHERE %s'%where
+        for row in self.Connection().execute(sql + ' ORDER BY num',params):
+            yield OrderedDict(zip(self.columns,row))
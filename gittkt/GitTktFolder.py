@@ -2,19 +2,24 @@
 
 #TODO: Change input() to support multiple lines for some fields (such as 
 #      description)
-#TODO: Cache the map
 #TODO: support query parameters for the List command
 #TODO: use a screen formatting library for the List command
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import datetime
 from difflib import Differ
 import gitshelve
+import GitTktCodec
+import GitTktDatabase
 import os
-import re
 import sys
 import uuid
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None   # python 2 without the futures backport
+
 try:
     #python 2
     raw_input
@@ -27,85 +32,191 @@ GITTKT_NUM_MAP_FILE='index.txt'
 GITTKT_RESERVED_FIELD_NAMES=['uuid','num','creation_date']
 MIN_UUID_LENGTH=30
 
+class GitTktError(Exception):pass
+
+def FolderOperation(function):
+    """Reports the git commands run by a folder method as part of it, e.g.
+    as "active.List" (see gitshelve.operation), and brings the shelf up to
+    date with the branch before it starts."""
+    def Operation(self,*args,**kwargs):
+        with gitshelve.operation("%s.%s"%(self.name,function.__name__)):
+            self.Refresh()
+            return function(self,*args,**kwargs)
+    Operation.__name__ = function.__name__
+    Operation.__doc__ = function.__doc__
+    return Operation
+
 class GitTktFolder(object):
     name  = ""
     fields  = []
     branch  = None
     nextNum = 0
     numMap = None
+    numToId = None
+    idToNum = None
+    numMapHead = None
     outstream = None
+    shelf = None
+    database = None
+    workers = 4
+    codec = GitTktCodec.DEFAULT_CODEC
+    #the codecs tickets are read with, as well as codec
+    codecs = GitTktCodec.SAFE_CODECS
 
-    def __init__(self, name, fields, branch, outstream = None):
+    def __init__(self, name, fields, branch, outstream = None, shelf = None,
+                 database = None):
+        """ shelf is the gitshelve of the branch, which can be shared by the
+            folders on it.  It is read the first time it is needed.
+            database is the GitTktDatabase of the branch, if List is to query
+            it rather than read every ticket.
+        """
         self.name = name
         self.fields = fields
         self.branch = branch
         self.outstream = outstream
         if self.outstream is None:
             self.outstream = sys.stdout
+        self.shelf = shelf
+        if self.shelf is None:
+            self.shelf = gitshelve.gitshelve(branch)
+        self.database = database
 
-    def __GetTicketIds(self,num):
-        localNum = None
-        ticketId = None
-        if len(num) < MIN_UUID_LENGTH: 
-            #we can assume this is a not uuid
-            searchRE = re.compile("(?P<num>%s)\t(?P<ticketId>.*)"%num)
-        else:
-            searchRE = re.compile("(?P<num>[0-9]+)\t(?P<ticketId>%s)"%num)
+    def Refresh(self):
+        """ Applies whatever was committed to the branch since the shelf was
+            last read; the first time, this reads it.
+        """
+        self.shelf.refresh()
 
+    def Close(self):
+        """ Stops the git processes the shelf keeps for reading """
+        self.shelf.close_reader()
+        self.shelf.close_odb()
+
+    def __GetTicketIds(self,num):
+        """ Returns the local number and the uuid of the ticket given by
+            either, or (None,None) if there is no such ticket.
+        """
+        num = str(num)
         self.__LoadNumMap()
-        if len(self.numMap) > 0:
-            matchObj = searchRE.search(self.numMap)
-            if matchObj is not None:
-                localNum = int(matchObj.group('num'))
-                ticketId = matchObj.group('ticketId')
-        return localNum,ticketId
+        if len(num) < MIN_UUID_LENGTH:
+            #we can assume this is a not uuid
+            try:
+                localNum = int(num)
+            except ValueError:
+                return None,None
+            if localNum in self.numToId:
+                return localNum,self.numToId[localNum]
+            return None,None
+        if num in self.idToNum:
+            return self.idToNum[num],num
+        #a uuid can be shortened, as long as it stays unique enough
+        for ticketId,localNum in self.idToNum.items():
+            if ticketId.startswith(num):
+                return localNum,ticketId
+        return None,None
 
     def __LoadNumMap(self):
-        if self.numMap is None:
-            shelfData = gitshelve.open(branch=self.branch)
+        if self.numMap is None or self.numMapHead != self.shelf.head:
+            shelfData = self.shelf
+            self.numMapHead = shelfData.head
             try:
-                self.numMap = shelfData[GITTKT_NUM_MAP_FILE]
+                self.numMap = shelfData['%s/%s'%(self.name,
+                                                 GITTKT_NUM_MAP_FILE)]
             except KeyError:
-                #reading from the shelf failed, so we have to start new
-                self.numMap = ""
-            shelfData.close()
+                try:
+                    #where it was kept at first
+                    self.numMap = shelfData[GITTKT_NUM_MAP_FILE]
+                except KeyError:
+                    #reading from the shelf failed, so we have to start new
+                    self.numMap = ""
+            self.__ParseNumMap()
 
-    def __AddToNumMap(self,ticketId):
+    def __ParseNumMap(self):
+        """ Indexes the lines of numMap, "<num>\t<uuid>", both ways """
+        self.numToId = OrderedDict()
+        self.idToNum = {}
+        self.nextNum = 0
+        for line in self.numMap.split("\n"):
+            if len(line) == 0:
+                continue
+            localNum,ticketId = line.split("\t",1)
+            localNum = int(localNum)
+            self.numToId[localNum] = ticketId
+            self.idToNum[ticketId] = localNum
+            self.nextNum = max(self.nextNum,localNum)
+
+    def __AddToNumMap(self,shelfData,ticketId):
         self.__LoadNumMap()
-        
-        #attempt to read it from te shelf
-        if self.__GetTicketIds(ticketId) == (None,None) and len(self.numMap) > 0:
-            lastEntry = self.numMap.split("\n")[-2]
-            self.nextNum = int(lastEntry[:lastEntry.find("\t")])
-            
+        if ticketId in self.idToNum:
+            return
+
         self.nextNum += 1
+        self.numToId[self.nextNum] = ticketId
+        self.idToNum[ticketId] = self.nextNum
         self.numMap += "%d\t%s\n"%(self.nextNum,ticketId)
         commitMsg = "Updating map with %d %s"%(self.nextNum, ticketId)
-        shelfData = gitshelve.open(branch=self.branch)
-        shelfData['%s/%s'%(self.name,GITTKT_NUM_MAP_FILE)] = self.numMap
-        shelfData.commit(commitMsg)
-        shelfData.close()
+        with shelfData.transaction(commitMsg):
+            shelfData['%s/%s'%(self.name,GITTKT_NUM_MAP_FILE)] = self.numMap
 
-    def __SaveToShelf(self,ticketId,data,message):
+    def __SaveToShelf(self,shelfData,ticketId,data,message):
         if 'uuid' in data:
             del data['uuid']
         if 'num' in data:
             del data['num']
-        shelfData = gitshelve.open(branch=self.branch)
-        shelfData['active/%s'%ticketId] = str(data)
-        shelfData.commit(message)
-        shelfData.close()
+        with shelfData.transaction(message):
+            shelfData['active/%s'%ticketId] = GitTktCodec.Encode(data,
+                                                                 self.codec)
 
     def __GetTicketData(self,ticketId):
         local,uuid = self.__GetTicketIds(ticketId)
         if uuid is None:
             raise GitTktError("Ticket not found: %s"%ticketId)
-        shelfData = gitshelve.open(branch=self.branch)
-        returnData = ticketData = eval(shelfData["active/%s"%uuid])
+        return self.__DecodeTicket(self.shelf["active/%s"%uuid],local,uuid)
+
+    def __DecodeTicket(self,text,local,uuid):
+        returnData = GitTktCodec.Decode(text,
+                                        tuple(self.codecs) + (self.codec,))
         returnData['num'] = local
         returnData['uuid'] = uuid
-        shelfData.close()
         return returnData
+
+    def GetTickets(self,ticketIds):
+        """ Yields (ticketId,ticketData) for each of ticketIds, in order, as
+            soon as it has been read.  The tickets are all looked up first,
+            their blobs are read a batch at a time, and up to self.workers
+            of them are decoded at once while the next ones are read.
+        """
+        self.__LoadNumMap()
+        found = []
+        for ticketId in ticketIds:
+            local,uuid = self.__GetTicketIds(ticketId)
+            if uuid is None:
+                raise GitTktError("Ticket not found: %s"%ticketId)
+            found.append((ticketId,local,uuid))
+        texts = self.shelf.load_books(['active/%s'%uuid
+                                       for ticketId,local,uuid in found])
+
+        pool = None
+        if ThreadPoolExecutor is not None and self.workers > 1:
+            pool = ThreadPoolExecutor(self.workers)
+        try:
+            decoding = deque()
+            for num,text in enumerate(texts):
+                ticketId,local,uuid = found[num]
+                if pool is None:
+                    yield ticketId,self.__DecodeTicket(text,local,uuid)
+                    continue
+                decoding.append((ticketId,pool.submit(self.__DecodeTicket,
+                                                      text,local,uuid)))
+                if len(decoding) > self.workers:
+                    ticketId,future = decoding.popleft()
+                    yield ticketId,future.result()
+            while decoding:
+                ticketId,future = decoding.popleft()
+                yield ticketId,future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
         
     def __MergeLocalNumbers(self,keepLocal = True):
         """
@@ -250,26 +361,35 @@ class GitTktFolder(object):
     def __MergeFiles(self):
         pass
 
+    @FolderOperation
     def Add(self,ticketData,nonInteractive = False ):
         uuid._uuid_generate_time = None
         uuid._uuid_generate_random = None
         ticketId = str(uuid.uuid4())
         message = "Added Ticket %s"%ticketId
         #ticket = ticketId : ticketData
-        #store the new data in gitshelve
-        self.__SaveToShelf(ticketId,ticketData,message)
-        self.__AddToNumMap(ticketId)
+        #store the new data and its number in gitshelve, as a single commit
+        shelfData = self.shelf
+        try:
+            with shelfData.transaction():
+                self.__SaveToShelf(shelfData,ticketId,ticketData,message)
+                self.__AddToNumMap(shelfData,ticketId)
+        except:
+            #the index was changed along with the shelf, which was rolled back
+            self.numMap = None
+            raise
+        self.numMapHead = shelfData.head
         self.outstream.write("Added Ticket %s"%ticketId)
         return ticketId
 
+    @FolderOperation
     def Show(self,ticketIds):
         """ Writes the ticket data to self.outstream and returns a dictionary
             where the key is the ticketId and the value is a dictionary of field
             value pairs.
         """
         ticketDatas = {}
-        for ticketId in ticketIds:
-            ticketData = self.__GetTicketData(ticketId)
+        for ticketId,ticketData in self.GetTickets(ticketIds):
             ticketDatas[ticketId] = ticketData
             self.outstream.write("-"*30 + "\n")
             self.outstream.write("Ticket %d (%s)\n"%(ticketData['num'],
@@ -279,18 +399,69 @@ class GitTktFolder(object):
                     self.outstream.write("  %s = %s\n"%(key.upper(),value))
         return ticketDatas
 
-    def List(self):
+    def __SyncDatabase(self):
+        """ Brings the folder's table in the database up to the head of the
+            shelf.  Only the tickets that differ between the head it was last
+            brought up to and this one are read again, unless that head can't
+            be read any more or the fields changed, when the table is rebuilt.
+        """
+        head = self.shelf.head or ''
+        lastHead = self.database.GetHead(self.name)
+        if lastHead == head:
+            return
+        self.__LoadNumMap()
+        changed = None
+        if lastHead and head:
+            try:
+                changed = set(path[len('active/'):] for treep,status,name,path
+                              in self.shelf.tree_changes(lastHead,head)
+                              if not treep and path.startswith('active/'))
+            except (gitshelve.GitError,ValueError):
+                #e.g. garbage collected
+                changed = None
+        if changed is None:
+            tickets = self.GetTickets(list(self.numToId.values()))
+            self.database.Update(self.name,head,
+                                 (ticketData for ticketId,ticketData
+                                  in tickets),rebuild = True)
+            return
+
+        rows = self.database.GetIds(self.name)
+        removed = [num for num,ticketId in rows.items()
+                   if self.numToId.get(num) != ticketId]
+        reload = [ticketId for num,ticketId in self.numToId.items()
+                  if rows.get(num) != ticketId or ticketId in changed]
+        self.database.Update(self.name,head,
+                             (ticketData for ticketId,ticketData
+                              in self.GetTickets(reload)),removed)
+
+    @FolderOperation
+    def List(self,query = None,equals = None,notEquals = None,like = None,
+             notLike = None):
         """ Writes the ticket data to self.outstream and returns a dictionary
             where the key is the column title and the value is a list of ticket
             data for that column.
+            Only the tickets that meet query, an SQL 'WHERE' condition, and
+            ALL of equals and like and NONE of notEquals and notLike, which
+            map field names to values and SQL like patterns, are listed.
+            These need the database, which is brought up to date first.
         """
         self.__LoadNumMap()
         returnData = {}
-        tickets = [line.split("\t") 
-                    for line in self.numMap.strip().split("\n") 
-                    if len(line)>0]
+        tickets = list(self.numToId.items())
         if len(tickets) == 0:
             return "No Tickets Found"
+        if self.database is not None and self.database.Connect():
+            self.__SyncDatabase()
+            where,params = GitTktDatabase.Where(self.database.columns,query,
+                                                equals,notEquals,like,notLike)
+            ticketDatas = self.database.Select(self.name,where,params)
+        elif query or equals or notEquals or like or notLike:
+            raise GitTktError("Queries need the ticket database")
+        else:
+            ticketDatas = (ticketData for ticketId,ticketData
+                           in self.GetTickets([ticketId for num,ticketId
+                                               in tickets]))
         #print the columns
         colData = ["#  |"]
         for field in self.fields.values():
@@ -301,10 +472,9 @@ class GitTktFolder(object):
                 colData.append(colStr)
         self.outstream.write(''.join(colData) + "\n")
 
-        #print the ticket data
-        for ticket in tickets:
-            num="%s"%(ticket[0])
-            ticketData = self.__GetTicketData(ticket[0])
+        #print the ticket data as it is read
+        for ticketData in ticketDatas:
+            num="%s"%(ticketData['num'])
             rowData = [num.ljust(3) + "|"]
             for field in self.fields.values():
                 colSize = field.listColSize
@@ -319,6 +489,7 @@ class GitTktFolder(object):
             self.outstream.write(''.join(rowData) + "\n")
         return returnData
 
+    @FolderOperation
     def Edit(self,ticketIds,interactive = True):
         """
             Returns a list of dictionaries where the key is the ticketId and the
@@ -326,28 +497,35 @@ class GitTktFolder(object):
             Writes to self.outstream
         """
         returnData = {}
-        for ticketId in ticketIds:
-            ticketData = self.__GetTicketData(ticketId)
-            localId = ticketData['num']
-            uuid = ticketData['uuid']
-            for field in self.fields:
-                try:
-                    currentValue = ticketData[field.name]
-                except KeyError:
-                    currentValue = field.default
-                if field.value is None:
-                    if interactive and field.editable:
-                        inputStr = raw_input("%s [%s]: "%(field.title,currentValue))
-                        if len(inputStr) != 0:
-                            ticketData[field.name] = inputStr
-                else:
-                    ticketData[field.name] = field.value
-            message = "Editing ticket %s"%uuid
-            self.__SaveToShelf(uuid,ticketData,message)
-            returnData[ticketId] = ticketData
-            self.outstream.write("Successfully edited ticket #%s\n"%localId)
+        shelfData = self.shelf
+        with shelfData.transaction():
+            for ticketId in ticketIds:
+                returnData[ticketId] = self.__EditTicket(shelfData,ticketId,
+                                                         interactive)
         return returnData
 
+    def __EditTicket(self,shelfData,ticketId,interactive):
+        ticketData = self.__GetTicketData(ticketId)
+        localId = ticketData['num']
+        uuid = ticketData['uuid']
+        for field in self.fields:
+            try:
+                currentValue = ticketData[field.name]
+            except KeyError:
+                currentValue = field.default
+            if field.value is None:
+                if interactive and field.editable:
+                    inputStr = raw_input("%s [%s]: "%(field.title,currentValue))
+                    if len(inputStr) != 0:
+                        ticketData[field.name] = inputStr
+            else:
+                ticketData[field.name] = field.value
+        message = "Editing ticket %s"%uuid
+        self.__SaveToShelf(shelfData,uuid,ticketData,message)
+        self.outstream.write("Successfully edited ticket #%s\n"%localId)
+        return ticketData
+
+    @FolderOperation
     def Pull(self,remote,remoteBranch,keepLocal = True):
         gitshelve.git('fetch',remote,remoteBranch)
         self.__mergeLocalNumbers(keepLocal)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# asyncgitshelve.py
+#
+# A gitshelve whose reads and commits run git through asyncio subprocesses,
+# so that a service answering many lookups at once can share one event loop
+# instead of tying up a thread in Popen.communicate() for every request.
+# Blobs are read through a single 'git cat-file --batch' child, and requests
+# are pipelined: each one is written as soon as it is made, and the answers,
+# which come back in the same order, are handed out as they arrive.
+#
+# The objects of the shelf are the same as gitshelve's, so everything that
+# doesn't touch the repository -- setting items, deleting them, listing keys
+# -- is shared with it and doesn't need to be awaited.  The methods that do
+# are the ones starting with 'a'.  This module needs Python 3.6 or later.
+#
+# Example:
+#
+#   import asyncgitshelve
+#
+#   async def main():
+#       data = await asyncgitshelve.open(branch = 'mydata')
+#       data['foo/bar/git.c'] = "This is some sample data."
+#       await data.acommit("Changes")
+#
+#       print(await data.aget('foo/bar/git.c'))
+#       async for path, text in data.aitems('foo'):
+#           print(path, text)
+#
+#       await data.aclose()
+
+import asyncio
+import collections
+import io
+import os
+import shutil
+import tempfile
+
+import gitshelve
+from gitshelve import GitError, decode, encode
+
+######################################################################
+
+# Python's asyncio counterpart to gitshelve.git().  It takes the same
+# 'input', 'repository' and 'keep_newline' keywords.
+
+async def git(cmd, *args, input=None, repository=None, keep_newline=False):
+    environ = None
+    if repository:
+        environ = os.environ.copy()
+        environ['GIT_DIR'] = repository
+
+    if gitshelve.verbose:
+        print("Command: git %s %s" % (cmd, ' '.join(args)))
+
+    start = gitshelve.timer()
+    proc = await asyncio.create_subprocess_exec(
+        'git', cmd, *args, env=environ,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    input = encode(input)
+    out, err = await proc.communicate(input)
+    gitshelve.notify(cmd, args, start, len(input), len(out) + len(err),
+                     proc.returncode)
+    if proc.returncode != 0:
+        raise GitError(cmd, args, {}, err, proc.returncode)
+
+    if not keep_newline:
+        out = out[:-1]
+    return decode(out)
+
+
+# The asyncio version of gitshelve.gitbatch.  get() can be called by any
+# number of tasks at once: requests are queued in the order they were written
+# and a reader task hands each answer to the request at the front.
+
+
+class asyncbatch:
+    def __init__(self, repository=None):
+        self.repository = repository
+        self.proc = None
+        self.started = None
+        self.reader = None
+        self.waiting = collections.deque()
+        self.draining = None
+
+    async def start(self):
+        environ = None
+        if self.repository:
+            environ = os.environ.copy()
+            environ['GIT_DIR'] = self.repository
+
+        if gitshelve.verbose:
+            print("Command: git cat-file --batch")
+
+        self.proc = await asyncio.create_subprocess_exec(
+            'git', 'cat-file', '--batch', env=environ,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        self.draining = asyncio.Lock()
+        self.reader = asyncio.ensure_future(self.read_answers())
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def get(self, name):
+        """Returns a (kind, data) tuple for the object 'name', where data is
+        the raw contents as bytes.  Raises KeyError if the object does not
+        exist, and IOError if the child process cannot be talked to."""
+        if self.started is None:
+            # the first request starts the child, and the others wait for it
+            self.started = asyncio.ensure_future(self.start())
+        await self.started
+        if not self.alive() or self.reader.done():
+            raise IOError("git cat-file --batch is not running")
+
+        if gitshelve.verbose:
+            print("Request: cat-file --batch %s" % name)
+
+        answer = asyncio.get_event_loop().create_future()
+        self.waiting.append((name, answer, gitshelve.timer()))
+        try:
+            self.proc.stdin.write(('%s\n' % name).encode('utf-8'))
+            async with self.draining:
+                await self.proc.stdin.drain()
+        except (ConnectionError, RuntimeError):
+            raise IOError("git cat-file --batch is not running")
+        return await answer
+
+    async def read_answers(self):
+        try:
+            while True:
+                header = await self.proc.stdout.readline()
+                if not header.endswith(b'\n'):
+                    raise IOError("git cat-file --batch exited")
+
+                name, answer, start = self.waiting.popleft()
+                fields = header.split()
+                if len(fields) != 3:
+                    # "<name> missing" or "<name> ambiguous"
+                    gitshelve.notify('cat-file', ('--batch', name), start,
+                                     len(name) + 1, len(header), 1)
+                    if not answer.done():
+                        answer.set_exception(KeyError(name))
+                    continue
+
+                size = int(fields[2])
+                try:
+                    data = await self.proc.stdout.readexactly(size + 1)
+                except asyncio.IncompleteReadError:
+                    raise IOError("short read from git cat-file --batch")
+                gitshelve.notify('cat-file', ('--batch', name), start,
+                                 len(name) + 1, len(header) + size + 1, 0)
+                if not answer.done():
+                    answer.set_result((fields[1].decode('utf-8'), data[:-1]))
+        except (IOError, OSError) as e:
+            self.fail(e)
+        except asyncio.CancelledError:
+            self.fail(IOError("git cat-file --batch was closed"))
+            raise
+
+    def fail(self, error):
+        while self.waiting:
+            name, answer, start = self.waiting.popleft()
+            if not answer.done():
+                answer.set_exception(error)
+
+    async def close(self):
+        if self.started is None:
+            return
+        await self.started
+        self.started = None
+        self.reader.cancel()
+        try:
+            self.proc.stdin.close()
+            await self.proc.wait()
+        except (IOError, OSError):
+            pass
+        self.proc = None
+
+
+class asyncgitshelve(gitshelve.gitshelve):
+    """A gitshelve with coroutines for everything that reads or writes the
+    repository.  Trees are always listed in full when the shelf is opened,
+    since listing them on demand would block, and the snapshot kept by
+    gitshelve is not used for the same reason."""
+    use_snapshot = False
+    batch = None
+    committing = None
+    changing = None
+
+    def __init__(self, branch='master', repository=None,
+                 keep_history=True, book_type=gitshelve.gitbook):
+        gitshelve.gitshelve.__init__(self, branch, repository, keep_history,
+                                     book_type)
+
+    def agit(self, *args, **kwargs):
+        if self.repository:
+            kwargs['repository'] = self.repository
+        return git(*args, **kwargs)
+
+    async def open(cls, branch='master', repository=None,
+                   keep_history=True, book_type=gitshelve.gitbook):
+        shelf = cls(branch, repository, keep_history, book_type)
+        await shelf.aread_repository()
+        return shelf
+
+    open = classmethod(open)
+
+    async def aread_repository(self):
+        self.init_data()
+        try:
+            head = await self.agit('rev-parse', self.branch)
+        except GitError:
+            return
+        if len(head) != 40:
+            raise ValueError("rev-parse went insane: %s" % head)
+        self.head = head
+
+        ls_tree = await self.agit('ls-tree', '--full-tree', '-r', '-t', '-z',
+                                  self.head)
+        for perm, kind, name, path in self.ls_tree_entries(ls_tree):
+            treep = kind == 'tree'
+            self.check_mode(path, perm, treep)
+            self.add_entry(treep, name, path)
+
+    async def aget_blob(self, name):
+        cache = self.blob_cache
+        if cache is not None:
+            data = cache.get(name)
+            if data is not None:
+                return data
+        data = await self.aread_blob(name)
+        if cache is not None:
+            cache.put(name, data)
+        return data
+
+    async def aread_blob(self, name):
+        if self.use_batch:
+            try:
+                if self.batch is None:
+                    self.batch = asyncbatch(self.repository)
+                kind, data = await self.batch.get(name)
+                if kind == 'blob':
+                    return decode(data)
+            except KeyError:
+                # let the per-call path report the missing object
+                pass
+            except (IOError, OSError):
+                # the batch child died; don't try to use it again
+                await self.aclose_batch()
+                self.use_batch = False
+
+        return await self.agit('cat-file', 'blob', name, keep_newline=True)
+
+    async def aclose_batch(self):
+        if self.batch is not None:
+            await self.batch.close()
+            self.batch = None
+
+    async def aload(self, book):
+        if book.data is None:
+            if book.name is None:
+                raise ValueError("name and data re both None")
+            data = book.deserialize_data(await self.aget_blob(book.name))
+            if book.data is None:   # unless it was set meanwhile
+                book.data = data
+        return book.data
+
+    async def aget(self, path):
+        try:
+            book = gitshelve.leaf_book(self.get_tree(path))
+        except KeyError:
+            book = None
+        if book is None:
+            raise KeyError(path)
+        return await self.aload(book)
+
+    async def aset(self, path, data):
+        """The same as shelf[path] = data, which never has to wait."""
+        self[path] = data
+
+    async def aitems(self, prefix='', start=None, stop=None):
+        """Yields (path, data) for the books that iteritems would list,
+        reading up to 'prefetch' of them at a time.  As with iteritems, the
+        shelf must not be changed until it's done."""
+        books = []
+        for item in self.iteritems(prefix, start, stop):
+            books.append(item)
+            if len(books) == self.prefetch:
+                for item in await self.aload_all(books):
+                    yield item
+                books = []
+        for item in await self.aload_all(books):
+            yield item
+
+    async def aload_all(self, books):
+        datas = await asyncio.gather(*[self.aload(book)
+                                       for path, book in books])
+        return [(path, data) for (path, book), data in zip(books, datas)]
+
+    async def akeys(self, prefix='', start=None, stop=None):
+        for key in self.iterkeys(prefix, start, stop):
+            yield key
+
+    def __aiter__(self):
+        return self.akeys()
+
+    async def amake_blobs(self, datas):
+        """Writes the blobs with one 'git hash-object --stdin-paths', as
+        gitshelve.write_blobs does, and returns their names."""
+        if not datas:
+            return []
+
+        tmpdir = tempfile.mkdtemp(prefix='gitshelve-')
+        try:
+            paths = []
+            for data in datas:
+                path = os.path.join(tmpdir, str(len(paths)))
+                fd = io.open(path, 'wb')
+                try:
+                    fd.write(encode(data))
+                finally:
+                    fd.close()
+                paths.append(path)
+
+            names = await self.agit('hash-object', '-w', '--no-filters',
+                                    '--stdin-paths',
+                                    input='\n'.join(paths) + '\n')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        names = names.split('\n')
+        if len(names) != len(datas):
+            raise GitError('hash-object', ['-w', '--stdin-paths'], {},
+                           'Expected %d names, got %d' %
+                           (len(datas), len(names)))
+        return names
+
+    def plan_tree(self, objects, unwritten):
+        """Notes down, before anything is awaited, what has to be written
+        for the trees below 'objects': the name of a tree that is unchanged,
+        or (objects, entries), each entry naming its book's blob, or the
+        index of the book in 'unwritten', or giving the plan of a subtree.
+        Changes made while the commit is being written aren't seen by it."""
+        if '__root__' in objects:
+            return objects['__root__']
+
+        entries = []
+        for path, obj in objects.items():
+            book = gitshelve.leaf_book(obj)
+            if book is None:
+                entries.append(('040000', path,
+                                self.plan_tree(obj, unwritten)))
+            elif book.name is None:
+                entries.append(('100644', path, unwritten[book]))
+            else:
+                entries.append(('100644', path, book.name))
+        return objects, entries
+
+    async def amake_tree(self, plan, names):
+        """make_tree for a plan from plan_tree, once the blobs of the
+        unwritten books have been written as 'names': a tree that kept its
+        '__root__' is unchanged, and the others are written with 'git
+        mktree', side by side."""
+        if not isinstance(plan, tuple):
+            return plan
+
+        objects, entries = plan
+        trees = [entry[2] for entry in entries if entry[0] == '040000']
+        tree_names = await asyncio.gather(*[self.amake_tree(tree, names)
+                                            for tree in trees])
+        tree_names.reverse()
+
+        buf = []
+        for mode, path, name in entries:
+            if mode == '040000':
+                kind = 'tree'
+                name = tree_names.pop()
+            else:
+                kind = 'blob'
+                if isinstance(name, int):
+                    name = names[name]
+            buf.append("%s %s %s\t%s\0" % (mode, kind, name, path))
+        name = await self.agit('mktree', '-z', input=''.join(buf))
+        objects['__root__'] = name
+        return name
+
+    def mark_dirty(self, path):
+        if self.changing is not None:
+            self.changing.append(path)
+        gitshelve.gitshelve.mark_dirty(self, path)
+
+    def __delitem__(self, path):
+        gitshelve.gitshelve.__delitem__(self, path)
+        if self.changing is not None:
+            self.changing.append(path)
+
+    async def acommit(self, comment=None):
+        if self.committing is None:
+            self.committing = asyncio.Lock()
+        async with self.committing:
+            if not self.dirty:
+                return self.head
+
+            # what other tasks change from here on is left for the next commit
+            self.changing = []
+            try:
+                return await self.acommit_books(comment)
+            finally:
+                changing = self.changing
+                self.changing = None
+                for path in changing:
+                    # drop the '__root__' amake_tree gave the trees above it
+                    gitshelve.gitshelve.mark_dirty(self, path)
+                if changing:
+                    self.dirty = True
+
+    async def acommit_books(self, comment):
+        accumulator = None
+        if comment is None:
+            accumulator = gitshelve.StringIO()
+        books = []
+        self.collect_books(self.objects, books, accumulator)
+        states = [(book, book.data, book.name) for book in books]
+        deleted = len(self.deleted)
+        unwritten = [book for book in books if book.name is None]
+        plan = self.plan_tree(self.objects,
+                              dict((book, i)
+                                   for i, book in enumerate(unwritten)))
+        try:
+            names = await self.amake_blobs([book.serialize_data(book.data)
+                                            for book in unwritten])
+            tree = await self.amake_tree(plan, names)
+            if accumulator:
+                comment = accumulator.getvalue()
+
+            if self.head and self.keep_history:
+                name = await self.agit('commit-tree', tree, '-p', self.head,
+                                       input=comment or '')
+            else:
+                name = await self.agit('commit-tree', tree,
+                                       input=comment or '')
+            ref = 'refs/heads/%s' % self.branch
+            if self.head:
+                await self.agit('update-ref', ref, name, self.head)
+            else:
+                await self.agit('update-ref', ref, name)
+        except BaseException:
+            # the trees written so far don't stand for anything yet
+            self.changing.extend(book.path for book in books)
+            raise
+        self.head = name
+
+        written = dict(zip(unwritten, names))
+        for book, data, book_name in states:
+            if book.data is not data or book.name != book_name:
+                continue            # changed again; it stays dirty
+            if book in written:
+                book.name = written[book]
+            book.dirty = False
+        del self.deleted[:deleted]
+        self.dirty = False
+        return name
+
+    async def aclose(self):
+        if self.dirty:
+            await self.acommit()
+        await self.aclose_batch()
+        self.close_reader()
+        self.close_odb()
+        del self.objects
+
+
+open = asyncgitshelve.open
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Speed and size of the ticket codecs.
+
+Encodes and decodes the same tickets with each codec registered in
+GitTktCodec, and with the str()/eval() they were first written with, and
+reports the tickets per second both ways and the average size of a blob --
+as text, and compressed the way git stores it.
+
+    python benchmarks/b_GitTktCodec.py [tickets]
+"""
+from collections import OrderedDict
+import datetime
+import os
+import sys
+import time
+import uuid
+import zlib
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import GitTktCodec
+
+ROUNDS = 3
+
+class EvalCodec(GitTktCodec.TicketCodec):
+    """ How tickets were read before there were codecs """
+    name = 'eval'
+
+    def Encode(self,data):
+        return str(dict(data))
+
+    def Decode(self,text):
+        return eval(text)
+
+def MakeTickets(count):
+    tickets = []
+    for num in range(count):
+        tickets.append(OrderedDict([
+            ('name','Ticket %d: something is wrong with part %d'%(num,num%97)),
+            ('author','Someone Else <someone%d@example.com>'%(num%13)),
+            ('status',('open','closed','resolved')[num%3]),
+            ('assigned',None),
+            ('description','Steps to reproduce:\n%s'%('do this, then that\n'
+                                                       * (num%5 + 1))),
+            ('creation_date',str(datetime.datetime(2020,1,1) +
+                                 datetime.timedelta(minutes=num))),
+            ('uuid_ref',str(uuid.UUID(int=num))),
+            ]))
+    return tickets
+
+def Best(function,tickets):
+    best = None
+    for run in range(ROUNDS):
+        start = time.time()
+        results = [function(ticket) for ticket in tickets]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best,results
+
+def Measure(codec,tickets):
+    encodeTime,texts = Best(codec.Encode,tickets)
+    decodeTime,decoded = Best(codec.Decode,texts)
+    for ticket,data in zip(tickets,decoded):
+        assert dict(ticket) == dict(data),codec.name
+    size = sum(len(text) for text in texts)
+    packed = sum(len(zlib.compress(text.encode('utf-8'))) for text in texts)
+    return encodeTime,decodeTime,size,packed
+
+def main(count):
+    tickets = MakeTickets(count)
+    codecs = [GitTktCodec.GetCodec(name)
+              for name in sorted(GitTktCodec.codecs)]
+    codecs += [GitTktCodec.legacyCodec,EvalCodec()]
+    print("%d tickets"%count)
+    print("%-8s %12s %12s %10s %10s"%('codec','encode/s','decode/s',
+                                      'bytes','in git'))
+    for codec in codecs:
+        encodeTime,decodeTime,size,packed = Measure(codec,tickets)
+        print("%-8s %12.0f %12.0f %10.1f %10.1f"%(codec.name,
+              count / max(encodeTime,1e-9),count / max(decodeTime,1e-9),
+              float(size) / count,float(packed) / count))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Commit cost against shelf size.
+
+Fills shelves of increasing size in a scratch repository, then times commits
+that change a fixed number of books, counting the trees make_tree has to look
+at.  Both should stay flat as the shelf grows: only the trees above the
+changed books are visited and written again.
+
+Then times a bulk import of the largest size with different numbers of
+max_workers, which should speed up with the number of cores.
+
+    python benchmarks/b_gitshelve.py [sizes...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import gitshelve
+
+BOOKS_PER_TREE = 100
+CHANGED = 10
+ROUNDS = 5
+WORKERS = (1,2,4,8)
+
+class countingshelve(gitshelve.gitshelve):
+    visited = 0
+    def make_tree(self, objects, comment_accumulator=None):
+        self.visited += 1
+        return gitshelve.gitshelve.make_tree(self, objects,
+                                             comment_accumulator)
+
+def BookPath(num):
+    return 'active/%04d/%d'%(num // BOOKS_PER_TREE,num)
+
+def Run(size):
+    shelf = countingshelve('bench-%d'%size)
+    for num in range(size):
+        shelf[BookPath(num)] = 'ticket %d'%num
+    shelf.commit('fill')
+
+    best = None
+    for run in range(ROUNDS):
+        step = size // CHANGED
+        for num in range(0,step * CHANGED,step):
+            shelf[BookPath(num)] = 'ticket %d, round %d'%(num,run)
+        shelf.visited = 0
+        start = time.time()
+        shelf.commit('round %d'%run)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    visited = shelf.visited
+    shelf.close()
+    return visited,best
+
+def Import(size,workers):
+    shelf = gitshelve.gitshelve('import-%d-%d'%(size,workers),
+                                max_workers=workers)
+    for num in range(size):
+        shelf[BookPath(num)] = 'ticket %d, %d workers\n%s'%(num,workers,
+                                                               'x' * 2000)
+    start = time.time()
+    shelf.commit('import')
+    elapsed = time.time() - start
+    shelf.close()
+    return elapsed
+
+def main(sizes):
+    gitDir = tempfile.mkdtemp()
+    lastCWD = os.getcwd()
+    os.chdir(gitDir)
+    try:
+        gitshelve.git('init')
+        print("%8s %8s %8s %10s"%('books','changed','trees','commit ms'))
+        for size in sizes:
+            visited,best = Run(size)
+            print("%8d %8d %8d %10.1f"%(size,CHANGED,visited,best * 1000))
+        print("")
+        print("%8s %8s %10s"%('books','workers','import ms'))
+        for workers in WORKERS:
+            elapsed = Import(sizes[-1],workers)
+            print("%8d %8d %10.1f"%(sizes[-1],workers,elapsed * 1000))
+    finally:
+        os.chdir(lastCWD)
+        shutil.rmtree(gitDir)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000,4000,16000])
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Memory held by a shelf's index, per ticket.
+
+Fills a branch with tickets laid out the way GitTktFolder stores them, one
+blob per ticket under active/, then reads the branch into a fresh shelf and
+uses tracemalloc to measure what the objects tree keeps alive.  The contents
+of the tickets are never read, so this is the cost of the index alone.
+
+    python benchmarks/b_gitshelve_memory.py [sizes...]
+"""
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None      # before Python 3.4
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import gitshelve
+
+def Fill(branch,size):
+    shelf = gitshelve.gitshelve(branch)
+    for num in range(size):
+        shelf['active/%s'%uuid.uuid4()] = 'ticket %d'%num
+    shelf.commit('fill')
+    shelf.close()
+
+def Measure(branch):
+    shelf = gitshelve.gitshelve(branch)
+    shelf.use_snapshot = False
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    shelf.read_repository()
+    shelf.close_reader()
+    shelf.close_odb()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    del shelf
+    return used
+
+def main(sizes):
+    if tracemalloc is None:
+        sys.exit("tracemalloc is needed, which came with Python 3.4")
+    gitDir = tempfile.mkdtemp()
+    lastCWD = os.getcwd()
+    os.chdir(gitDir)
+    try:
+        gitshelve.git('init')
+        print("%8s %12s %12s"%('tickets','bytes','per ticket'))
+        for size in sizes:
+            branch = 'bench-%d'%size
+            Fill(branch,size)
+            tracemalloc.start()
+            used = Measure(branch)
+            tracemalloc.stop()
+            print("%8d %12d %12.1f"%(size,used,float(used) / size))
+    finally:
+        os.chdir(lastCWD)
+        shutil.rmtree(gitDir)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000,10000,100000])
@@ -0,0 +1,1158 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# gitodb.py
+#
+# Pure Python access to the object database of a Git repository.  gitshelve
+# uses it to resolve refs and to read commits, trees and blobs straight from
+# .git, so that read-only work doesn't have to start a git process at all.
+# It can also write loose objects and move branches, which covers everything
+# a gitshelve commit needs.
+#
+# Loose objects are inflated with zlib.  Packed objects are found through the
+# version 2 pack index, which is mapped with mmap, and OFS_DELTA/REF_DELTA
+# chains are resolved against a small, size-bounded cache of delta bases.
+# Loose objects and undeltified packed objects can also be read as a stream,
+# a chunk at a time, and new objects written from one, for values too big to
+# hold in memory.  New objects are written as loose objects (compressed into
+# a temporary file and renamed into place), and refs are updated under a '<ref>.lock' file with
+# the same compare-and-swap rule as 'git update-ref <ref> <new> <old>'.
+# Anything this module does not understand raises one of the exceptions in
+# 'errors', and the caller is expected to fall back to the git command line.
+#
+# Example:
+#
+#   import gitodb
+#
+#   odb = gitodb.open()              # the repository containing the cwd
+#   head = odb.resolve('master')
+#   for mode, kind, name, path in odb.ls_tree(head, recursive=True):
+#       print path, odb.read(name)[1]
+#
+#   blob = odb.write_object('blob', b'some data')
+#   tree = odb.write_tree([('100644', 'file', blob)])
+#   commit = odb.write_commit(tree, [head], 'Add file')
+#   odb.update_ref('refs/heads/master', commit, head)
+#   odb.close()
+
+import binascii
+import calendar
+import errno
+import hashlib
+import io
+import mmap
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+
+from collections import OrderedDict
+
+######################################################################
+
+OBJ_COMMIT    = 1
+OBJ_TREE      = 2
+OBJ_BLOB      = 3
+OBJ_TAG       = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+type_names = { OBJ_COMMIT: 'commit', OBJ_TREE: 'tree',
+               OBJ_BLOB: 'blob', OBJ_TAG: 'tag' }
+
+sha_pat = re.compile('^[0-9a-f]{40}$')
+
+# Ref names that git would have to interpret (revision expressions, reflog
+# lookups, ...) are left to 'git rev-parse'.
+unsafe_ref_pat = re.compile(r'\.\.|[~^:?*\[\\\s]|@\{|^-|^/|/$|//')
+
+# Characters git trims from both ends of a name or email in an ident line.
+ident_crud = '.,:;<>"\\\''
+
+true_values = ('true', 'yes', 'on', '1')
+
+######################################################################
+
+
+class OdbError(Exception):
+    pass
+
+
+class RefError(OdbError):
+    """A ref could not be updated because it has moved or is locked; git
+    would refuse the update as well."""
+    pass
+
+
+# Everything that a read can raise when the repository holds something this
+# module doesn't handle; callers catch these and fall back to git.
+errors = (OdbError, KeyError, IOError, OSError, ValueError, IndexError,
+          struct.error, zlib.error)
+
+
+def find_git_dir(repository=None):
+    """Returns the git directory that git itself would use, or None if it
+    cannot be found or is set up in a way this module doesn't support."""
+    if os.environ.get('GIT_OBJECT_DIRECTORY') or \
+       os.environ.get('GIT_ALTERNATE_OBJECT_DIRECTORIES'):
+        return None
+
+    if not repository:
+        repository = os.environ.get('GIT_DIR')
+    if repository:
+        if os.path.isdir(os.path.join(repository, 'objects')):
+            return repository
+        return None
+
+    path = os.getcwd()
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return dotgit
+        if os.path.isfile(dotgit):
+            # a linked worktree or a submodule: "gitdir: <path>"
+            fd = io.open(dotgit)
+            try:
+                line = fd.readline().strip()
+            finally:
+                fd.close()
+            if not line.startswith('gitdir: '):
+                return None
+            return os.path.join(path, line[8:])
+        if os.path.isfile(os.path.join(path, 'HEAD')) and \
+           os.path.isdir(os.path.join(path, 'objects')):
+            return path                 # a bare repository
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_varint(data, pos):
+    """Reads the little-endian base 128 sizes used in delta headers."""
+    result = 0
+    shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        result |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, result
+
+
+def apply_delta(base, delta):
+    delta = bytearray(delta)
+    pos, base_size = read_varint(delta, 0)
+    pos, result_size = read_varint(delta, pos)
+    if base_size != len(base):
+        raise OdbError("delta base is %d bytes, expected %d" %
+                       (len(base), base_size))
+
+    out = []
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy a range of the base
+            offset = 0
+            size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out.append(base[offset:offset + size])
+        elif op:
+            # insert the next 'op' bytes of the delta
+            out.append(bytes(delta[pos:pos + op]))
+            pos += op
+        else:
+            raise OdbError("invalid delta opcode 0")
+
+    result = b''.join(out)
+    if len(result) != result_size:
+        raise OdbError("delta produced %d bytes, expected %d" %
+                       (len(result), result_size))
+    return result
+
+
+def parse_tree(data):
+    """Returns the (mode, name, sha) entries of a raw tree object.  Modes are
+    zero-padded to six digits, as ls-tree prints them."""
+    entries = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b' ', pos)
+        nul = data.index(b'\0', space)
+        mode = '%06o' % int(data[pos:space], 8)
+        name = data[space + 1:nul].decode('utf-8')
+        sha = binascii.hexlify(data[nul + 1:nul + 21]).decode('ascii')
+        if len(sha) != 40:
+            raise OdbError("truncated tree entry %s" % name)
+        entries.append((mode, name, sha))
+        pos = nul + 21
+    return entries
+
+
+def object_bytes(kind, data):
+    """Returns an object as git hashes it: a '<kind> <size>' header, a NUL
+    and the contents."""
+    return ('%s %d\0' % (kind, len(data))).encode('ascii') + data
+
+
+def tree_sort_key(entry):
+    # git sorts trees as if their names ended with a slash
+    mode, name, sha = entry
+    name = name.encode('utf-8')
+    if int(mode, 8) == 0o40000:
+        name += b'/'
+    return name
+
+
+def config_value(value):
+    """Unquotes the value part of a 'key = value' line of a config file."""
+    out = []
+    keep = 0
+    quoted = False
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == '"':
+            quoted = not quoted
+        elif c == '\\':
+            i += 1
+            if i == len(value):
+                raise OdbError("continued config lines are left to git")
+            if value[i] not in 'ntb"\\':
+                raise OdbError("unknown escape in config value")
+            out.append({'n': '\n', 't': '\t', 'b': '\b'}.get(value[i],
+                                                             value[i]))
+            keep = len(out)
+        elif c in '#;' and not quoted:
+            break
+        else:
+            out.append(c)
+            if quoted or not c.isspace():
+                keep = len(out)
+        i += 1
+    return ''.join(out[:keep]).lstrip()
+
+
+def read_config(path, config=None):
+    """Adds the settings in the git config file 'path' to the dict 'config'
+    as 'section.key' or 'section.subsection.key'.  Section and key names are
+    lower-cased, as git compares them without regard to case."""
+    if config is None:
+        config = {}
+    try:
+        fd = io.open(path, encoding='utf-8')
+    except (IOError, OSError):
+        return config
+
+    try:
+        section = None
+        for line in fd:
+            line = line.strip()
+            if line.startswith('['):
+                end = line.find(']')
+                if end < 0:
+                    raise OdbError("bad section header in %s" % path)
+                header = line[1:end].strip().split(None, 1)
+                if not header:
+                    raise OdbError("bad section header in %s" % path)
+                section = header[0].lower()
+                if section in ('include', 'includeif'):
+                    raise OdbError("config includes are left to git")
+                if len(header) > 1:
+                    section += '.' + header[1].strip('"')
+                line = line[end + 1:].strip()
+            if not line or line[0] in '#;':
+                continue
+            if section is None:
+                raise OdbError("setting outside of a section in %s" % path)
+
+            key, sep, value = line.partition('=')
+            if sep:
+                value = config_value(value)
+            else:
+                value = 'true'
+            config['%s.%s' % (section, key.strip().lower())] = value
+    finally:
+        fd.close()
+    return config
+
+
+def strip_crud(value):
+    """Cleans up a name or email the way git does before it goes into an
+    ident line."""
+    value = value.strip(ident_crud + ''.join(chr(c) for c in range(33)))
+    for c in '<>\n':
+        value = value.replace(c, '')
+    return value
+
+
+def local_date(now=None):
+    """Returns '<seconds> <+hhmm>' for 'now' in the local timezone."""
+    if now is None:
+        now = int(time.time())
+    offset = (calendar.timegm(time.localtime(now)) - now) // 60
+    if offset < 0:
+        sign = '-'
+        offset = -offset
+    else:
+        sign = '+'
+    return '%d %s%02d%02d' % (now, sign, offset // 60, offset % 60)
+
+
+def parse_date(value):
+    """Accepts the raw '<seconds> <+hhmm>' format (optionally with a
+    leading '@') in GIT_*_DATE; anything fancier is parsed by git."""
+    match = re.match(r'^@?(\d+) ([+-]\d{4})$', value.strip())
+    if not match:
+        raise OdbError("dates like '%s' are left to git" % value)
+    return '%s %s' % match.groups()
+
+
+class deltacache:
+    """Keeps the most recently used delta bases, up to 'max_bytes' of
+    object data in total."""
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value       # most recently used goes last
+        return value
+
+    def put(self, key, kind, data):
+        if len(data) > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = (kind, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old_key, (old_kind, old_data) = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class inflater(io.RawIOBase):
+    """A file object giving the 'size' bytes inflated from what 'source'
+    returns, where source(n) returns up to n more bytes of compressed data.
+    'pending' is data that was already inflated by 'decompressor'."""
+    chunk = 64 * 1024
+
+    def __init__(self, source, size, decompressor=None, pending=b'',
+                 on_close=None):
+        self.source = source
+        self.remaining = size
+        self.decompressor = decompressor or zlib.decompressobj()
+        self.pending = pending
+        self.on_close = on_close
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending and self.remaining > 0:
+            # no more than a chunk at a time comes out, however well the
+            # data compresses
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.source(self.chunk)
+                if not data:
+                    raise OdbError("truncated object")
+            self.pending = self.decompressor.decompress(data, self.chunk)
+        data = self.pending[:min(len(b), self.remaining)]
+        self.pending = self.pending[len(data):]
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.on_close is not None:
+            self.on_close()
+        io.RawIOBase.close(self)
+
+
+class packfile:
+    """A pack and its version 2 index, both mapped into memory."""
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + '.pack'
+        self.idx = None
+        self.pack = None
+
+        self.idx = self.map(idx_path)
+        if self.idx[:8] != b'\377tOc\0\0\0\2':
+            self.close()
+            raise OdbError("%s is not a version 2 pack index" % idx_path)
+
+        self.fanout = struct.unpack('>256I', self.idx[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.sha_base = 8 + 1024
+        self.offset_base = self.sha_base + 24 * self.count  # shas, then crcs
+        self.offset64_base = self.offset_base + 4 * self.count
+
+        self.pack = self.map(self.pack_path)
+        if self.pack[:4] != b'PACK':
+            self.close()
+            raise OdbError("%s is not a pack" % self.pack_path)
+
+    def map(self, path):
+        fd = io.open(path, 'rb')
+        try:
+            return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+    def close(self):
+        for m in (self.idx, self.pack):
+            if m is not None:
+                m.close()
+        self.idx = self.pack = None
+
+    def find(self, binsha):
+        """Returns the pack offset of the object 'binsha', or None."""
+        first = bytearray(binsha[:1])[0]
+        lo = first and self.fanout[first - 1] or 0
+        hi = self.fanout[first]
+        idx = self.idx
+        base = self.sha_base
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + 20 * mid
+            sha = idx[pos:pos + 20]
+            if sha < binsha:
+                lo = mid + 1
+            elif sha > binsha:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def offset(self, i):
+        pos = self.offset_base + 4 * i
+        offset = struct.unpack('>I', self.idx[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self.offset64_base + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', self.idx[pos:pos + 8])[0]
+        return offset
+
+    def header(self, offset):
+        """Returns (type, size, data offset) for the entry at 'offset'."""
+        c = bytearray(self.pack[offset:offset + 1])[0]
+        offset += 1
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = bytearray(self.pack[offset:offset + 1])[0]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return kind, size, offset
+
+    def ofs_delta_base(self, offset, pos):
+        """Decodes the negative base offset of an OFS_DELTA entry at
+        'offset', whose header ends at 'pos'.  Returns (base, pos)."""
+        c = bytearray(self.pack[pos:pos + 1])[0]
+        pos += 1
+        distance = c & 0x7f
+        while c & 0x80:
+            c = bytearray(self.pack[pos:pos + 1])[0]
+            pos += 1
+            distance = ((distance + 1) << 7) | (c & 0x7f)
+        return offset - distance, pos
+
+    def inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        out = []
+        length = 0
+        chunk = max(size, 4096)
+        while length < size:
+            data = self.pack[pos:pos + chunk]
+            if not data:
+                raise OdbError("truncated object in %s" % self.pack_path)
+            pos += len(data)
+            data = decompressor.decompress(data)
+            length += len(data)
+            out.append(data)
+        data = b''.join(out)
+        if len(data) != size:
+            raise OdbError("object in %s inflated to %d bytes, expected %d" %
+                           (self.pack_path, len(data), size))
+        return data
+
+
+class gitodb:
+    """Reads and writes objects and refs in the git directory 'git_dir'."""
+    def __init__(self, git_dir, delta_cache_bytes=16 * 1024 * 1024):
+        self.git_dir = git_dir
+        self.common_dir = git_dir
+        commondir = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir):
+            # linked worktrees keep objects and refs in the main repository
+            fd = io.open(commondir)
+            try:
+                self.common_dir = os.path.join(git_dir, fd.read().strip())
+            finally:
+                fd.close()
+        self.objects_dir = os.path.join(self.common_dir, 'objects')
+        if os.path.exists(os.path.join(self.objects_dir, 'info',
+                                       'alternates')):
+            raise OdbError("alternate object directories are not supported")
+
+        try:
+            self.config = read_config(os.path.join(self.common_dir, 'config'))
+        except OdbError:
+            self.config = None      # we can still read, but not write
+        if self.config is not None:
+            if self.config.get('extensions.objectformat', 'sha1') != 'sha1':
+                raise OdbError("only sha1 repositories are supported")
+            if self.config.get('extensions.refstorage', 'files') != 'files':
+                self.config = None
+            elif self.config.get('core.sharedrepository', 'false').lower() \
+                    not in ('false', 'umask', 'no', 'off', '0'):
+                self.config = None  # files need group permissions
+
+        self.packs = []
+        self.packs_stamp = None
+        self.cache = deltacache(delta_cache_bytes)
+        self.packed_refs = {}
+        self.packed_refs_stamp = None
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.packs_stamp = None
+        self.cache.clear()
+
+    ##################################################################
+    # objects
+
+    def scan_packs(self):
+        """(Re)reads the list of packs.  Returns True if it changed."""
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        try:
+            names = sorted(n for n in os.listdir(pack_dir)
+                           if n.endswith('.idx'))
+        except OSError:
+            names = []
+        if names == self.packs_stamp:
+            return False
+
+        known = dict((os.path.basename(p.idx_path), p) for p in self.packs)
+        packs = []
+        for name in names:
+            if name in known:
+                packs.append(known.pop(name))
+                continue
+            try:
+                packs.append(packfile(os.path.join(pack_dir, name)))
+            except (OdbError, IOError, OSError, ValueError):
+                # half-written, or a format we don't know; git can read it
+                pass
+        for pack in known.values():
+            pack.close()
+        self.packs = packs
+        self.packs_stamp = names
+        return True
+
+    def read(self, sha):
+        """Returns (kind, data) for the object 'sha', or raises KeyError."""
+        if self.packs_stamp is None:
+            self.scan_packs()
+        result = self.read_packed(sha)
+        if result is None:
+            result = self.read_loose(sha)
+        if result is None and self.scan_packs():
+            # a repack or a fast-import may have added packs since we looked
+            result = self.read_packed(sha)
+        if result is None:
+            raise KeyError(sha)
+        return result
+
+    def read_loose(self, sha):
+        path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        try:
+            fd = io.open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            raw = zlib.decompress(fd.read())
+        finally:
+            fd.close()
+
+        nul = raw.index(b'\0')
+        kind, size = raw[:nul].split(b' ')
+        data = raw[nul + 1:]
+        if int(size) != len(data):
+            raise OdbError("loose object %s has the wrong size" % sha)
+        return kind.decode('ascii'), data
+
+    def open_object(self, sha):
+        """Like read, but returns (kind, size, stream), where stream is a
+        file object to read the contents from.  Only deltified objects are
+        inflated in memory all at once; the stream of a packed object can't
+        be read once the gitodb is closed."""
+        if self.packs_stamp is None:
+            self.scan_packs()
+        result = self.open_packed(sha)
+        if result is None:
+            result = self.open_loose(sha)
+        if result is None and self.scan_packs():
+            result = self.open_packed(sha)
+        if result is None:
+            raise KeyError(sha)
+        return result
+
+    def open_loose(self, sha):
+        path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        try:
+            fd = io.open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            decompressor = zlib.decompressobj()
+            data = b''
+            while b'\0' not in data:
+                chunk = decompressor.unconsumed_tail or fd.read(inflater.chunk)
+                if not chunk:
+                    raise OdbError("loose object %s has no header" % sha)
+                data += decompressor.decompress(chunk, inflater.chunk)
+            nul = data.index(b'\0')
+            kind, size = data[:nul].split(b' ')
+        except:
+            fd.close()
+            raise
+        stream = inflater(fd.read, int(size), decompressor, data[nul + 1:],
+                          fd.close)
+        return kind.decode('ascii'), int(size), io.BufferedReader(stream)
+
+    def open_packed(self, sha):
+        binsha = binascii.unhexlify(sha)
+        for pack in self.packs:
+            offset = pack.find(binsha)
+            if offset is None:
+                continue
+            kind, size, pos = pack.header(offset)
+            if kind not in type_names:
+                kind, data = self.read_pack_entry(pack, offset)
+                return kind, len(data), io.BytesIO(data)
+
+            where = [pos]
+            def source(n):
+                data = pack.pack[where[0]:where[0] + n]
+                where[0] += len(data)
+                return data
+            return type_names[kind], size, \
+                   io.BufferedReader(inflater(source, size))
+        return None
+
+    def read_packed(self, sha):
+        binsha = binascii.unhexlify(sha)
+        for pack in self.packs:
+            offset = pack.find(binsha)
+            if offset is not None:
+                return self.read_pack_entry(pack, offset)
+        return None
+
+    def read_pack_entry(self, pack, offset):
+        # Walk down the delta chain until we hit a whole object (or a cached
+        # one), then apply the deltas on the way back up.
+        chain = []
+        while True:
+            cached = self.cache.get((pack.pack_path, offset))
+            if cached is not None:
+                kind, data = cached
+                break
+
+            kind, size, pos = pack.header(offset)
+            if kind == OBJ_OFS_DELTA:
+                base, pos = pack.ofs_delta_base(offset, pos)
+                chain.append((pack, offset, pos, size))
+                offset = base
+            elif kind == OBJ_REF_DELTA:
+                base = binascii.hexlify(pack.pack[pos:pos + 20]) \
+                                .decode('ascii')
+                chain.append((pack, offset, pos + 20, size))
+                kind, data = self.read(base)
+                break
+            elif kind in type_names:
+                kind = type_names[kind]
+                data = pack.inflate(pos, size)
+                if chain:
+                    self.cache.put((pack.pack_path, offset), kind, data)
+                break
+            else:
+                raise OdbError("unknown object type %d in %s" %
+                               (kind, pack.pack_path))
+
+        for depth in range(len(chain) - 1, -1, -1):
+            pack, offset, pos, size = chain[depth]
+            data = apply_delta(data, pack.inflate(pos, size))
+            if depth:
+                # only cache what is a base of something else
+                self.cache.put((pack.pack_path, offset), kind, data)
+        return kind, data
+
+    def read_tree(self, sha):
+        """Returns the entries of the tree 'sha' (see parse_tree).  Commits
+        and tags are peeled to their trees, as ls-tree does."""
+        kind, data = self.read(sha)
+        while kind != 'tree':
+            if kind == 'commit':
+                sha = self.field(data, b'tree')
+            elif kind == 'tag':
+                sha = self.field(data, b'object')
+            else:
+                raise OdbError("%s is a %s, not a tree" % (sha, kind))
+            kind, data = self.read(sha)
+        return parse_tree(data)
+
+    def field(self, data, key):
+        """Returns the first header line called 'key' in a commit or tag."""
+        for line in data.split(b'\n'):
+            if not line:
+                break
+            if line.startswith(key + b' '):
+                return line[len(key) + 1:].decode('utf-8')
+        raise OdbError("no %s in object" % key.decode('ascii'))
+
+    def ls_tree(self, treeish, recursive=False, path=''):
+        """Yields (mode, kind, sha, path) for each entry of 'treeish', like
+        'git ls-tree', or 'git ls-tree -r -t' if 'recursive' is True."""
+        for mode, name, sha in self.read_tree(treeish):
+            if path:
+                entry_path = '/'.join((path, name))
+            else:
+                entry_path = name
+            if mode == '040000':
+                kind = 'tree'
+            elif mode == '160000':
+                kind = 'commit'
+            else:
+                kind = 'blob'
+            yield mode, kind, sha, entry_path
+            if recursive and kind == 'tree':
+                for entry in self.ls_tree(sha, True, entry_path):
+                    yield entry
+
+    def diff_tree(self, old, new, path=''):
+        """Yields (old_mode, new_mode, old_sha, new_sha, status, path) for
+        each entry that differs between the trees 'old' and 'new', like
+        'git diff-tree -r -t'.  Either tree may be None, meaning empty.
+        Subtrees with the same name on both sides are not even read."""
+        old_entries = {}
+        new_entries = {}
+        if old:
+            for mode, name, sha in self.read_tree(old):
+                old_entries[name] = (mode, sha)
+        if new:
+            for mode, name, sha in self.read_tree(new):
+                new_entries[name] = (mode, sha)
+
+        null = ('000000', '0' * 40)
+        for name in sorted(set(old_entries) | set(new_entries)):
+            old_entry = old_entries.get(name, null)
+            new_entry = new_entries.get(name, null)
+            if old_entry == new_entry:
+                continue
+            if path:
+                entry_path = '/'.join((path, name))
+            else:
+                entry_path = name
+
+            old_tree = old_entry[0] == '040000'
+            new_tree = new_entry[0] == '040000'
+            if old_entry is not null and new_entry is not null and \
+               old_tree == new_tree:
+                if old_entry[0] == new_entry[0] or old_tree:
+                    status = 'M'
+                else:
+                    status = 'T'
+                yield old_entry[0], new_entry[0], old_entry[1], \
+                      new_entry[1], status, entry_path
+                if old_tree:
+                    for entry in self.diff_tree(old_entry[1], new_entry[1],
+                                                entry_path):
+                        yield entry
+                continue
+
+            # added, removed, or replaced by something of another kind
+            if old_entry is not null:
+                yield old_entry[0], null[0], old_entry[1], null[1], 'D', \
+                      entry_path
+                if old_tree:
+                    for entry in self.diff_tree(old_entry[1], None,
+                                                entry_path):
+                        yield entry
+            if new_entry is not null:
+                yield null[0], new_entry[0], null[1], new_entry[1], 'A', \
+                      entry_path
+                if new_tree:
+                    for entry in self.diff_tree(None, new_entry[1],
+                                                entry_path):
+                        yield entry
+
+    def has_object(self, sha):
+        if os.path.exists(os.path.join(self.objects_dir, sha[:2], sha[2:])):
+            return True
+        if self.packs_stamp is None:
+            self.scan_packs()
+        binsha = binascii.unhexlify(sha)
+        for pack in self.packs:
+            if pack.find(binsha) is not None:
+                return True
+        return False
+
+    ##################################################################
+    # writing objects
+
+    def check_writable(self):
+        if self.config is None:
+            raise OdbError("this repository is written through git")
+
+    def hash_object(self, kind, data):
+        return hashlib.sha1(object_bytes(kind, data)).hexdigest()
+
+    def write_object(self, kind, data):
+        """Stores 'data' as a loose object, unless the repository already
+        has it, and returns its name."""
+        self.check_writable()
+        raw = object_bytes(kind, data)
+        sha = hashlib.sha1(raw).hexdigest()
+        if self.has_object(sha):
+            return sha
+
+        obj_dir = self.make_object_dir(sha)
+        # Readers must never see a partial object, so it only gets its real
+        # name once it has been written out completely.
+        fd, tmp = tempfile.mkstemp(prefix='tmp_obj_', dir=obj_dir)
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                out.write(zlib.compress(raw, self.compression_level()))
+            finally:
+                out.close()
+            self.rename_object(tmp, sha)
+        finally:
+            if os.path.exists(tmp):
+                os.chmod(tmp, 0o644)
+                os.remove(tmp)
+        return sha
+
+    def write_stream(self, kind, size, chunks):
+        """Stores the 'size' bytes given by 'chunks', an iterable of bytes,
+        as a loose object and returns its name.  They are hashed and
+        compressed as they come, so only one chunk is in memory at a time."""
+        self.check_writable()
+        header = ('%s %d\0' % (kind, size)).encode('ascii')
+        sha = hashlib.sha1(header)
+        compressor = zlib.compressobj(self.compression_level())
+        length = 0
+        fd, tmp = tempfile.mkstemp(prefix='tmp_obj_', dir=self.objects_dir)
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                out.write(compressor.compress(header))
+                for chunk in chunks:
+                    length += len(chunk)
+                    sha.update(chunk)
+                    out.write(compressor.compress(chunk))
+                out.write(compressor.flush())
+            finally:
+                out.close()
+            if length != size:
+                raise OdbError("expected %d bytes for the object, got %d" %
+                               (size, length))
+            sha = sha.hexdigest()
+            if not self.has_object(sha):
+                self.make_object_dir(sha)
+                self.rename_object(tmp, sha)
+        finally:
+            if os.path.exists(tmp):
+                os.chmod(tmp, 0o644)
+                os.remove(tmp)
+        return sha
+
+    def compression_level(self):
+        return int(self.config.get('core.loosecompression',
+                                   self.config.get('core.compression', -1)))
+
+    def make_object_dir(self, sha):
+        obj_dir = os.path.join(self.objects_dir, sha[:2])
+        if not os.path.isdir(obj_dir):
+            try:
+                os.makedirs(obj_dir)
+            except OSError:
+                if not os.path.isdir(obj_dir):
+                    raise
+        return obj_dir
+
+    def rename_object(self, tmp, sha):
+        path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        os.chmod(tmp, 0o444)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # someone else wrote the same object first
+            if not os.path.exists(path):
+                raise
+
+    def write_tree(self, entries):
+        """Writes a tree of (mode, name, sha) entries, as 'git mktree'
+        does.  The entries may be given in any order."""
+        data = []
+        for mode, name, sha in sorted(entries, key=tree_sort_key):
+            data.append(('%o %s\0' % (int(mode, 8), name)).encode('utf-8'))
+            data.append(binascii.unhexlify(sha))
+        return self.write_object('tree', b''.join(data))
+
+    def user_config(self):
+        """Returns the settings git would see from the system, global and
+        repository config files, in that order of precedence."""
+        self.check_writable()
+        for var in ('GIT_CONFIG', 'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_COUNT'):
+            if os.environ.get(var):
+                raise OdbError("%s is left to git" % var)
+
+        config = {}
+        if not os.environ.get('GIT_CONFIG_NOSYSTEM'):
+            read_config(os.environ.get('GIT_CONFIG_SYSTEM', '/etc/gitconfig'),
+                        config)
+        if os.environ.get('GIT_CONFIG_GLOBAL'):
+            read_config(os.environ['GIT_CONFIG_GLOBAL'], config)
+        else:
+            xdg = os.environ.get('XDG_CONFIG_HOME') or \
+                  os.path.join(os.path.expanduser('~'), '.config')
+            read_config(os.path.join(xdg, 'git', 'config'), config)
+            read_config(os.path.join(os.path.expanduser('~'), '.gitconfig'),
+                        config)
+        read_config(os.path.join(self.common_dir, 'config'), config)
+        return config
+
+    def ident(self, role, config=None):
+        """Returns the 'Name <email> <date>' that git would use for the
+        'author' or 'committer' of a new commit."""
+        if config is None:
+            config = self.user_config()
+        var = 'GIT_%s_' % role.upper()
+        name = os.environ.get(var + 'NAME') or \
+               config.get('%s.name' % role) or config.get('user.name')
+        email = os.environ.get(var + 'EMAIL') or \
+                config.get('%s.email' % role) or config.get('user.email') or \
+                os.environ.get('EMAIL')
+        if not name or not email or not strip_crud(name):
+            # git would guess from the system, or refuse
+            raise OdbError("no %s identity configured" % role)
+
+        if os.environ.get(var + 'DATE'):
+            date = parse_date(os.environ[var + 'DATE'])
+        else:
+            date = local_date()
+        return '%s <%s> %s' % (strip_crud(name), strip_crud(email), date)
+
+    def write_commit(self, tree, parents, message):
+        """Writes a commit of 'tree', as 'git commit-tree' does."""
+        config = self.user_config()
+        if config.get('i18n.commitencoding', 'utf-8').lower() \
+                not in ('utf-8', 'utf8'):
+            raise OdbError("commit encodings are left to git")
+
+        lines = ['tree %s' % tree]
+        for parent in parents:
+            lines.append('parent %s' % parent)
+        lines.append('author %s' % self.ident('author', config))
+        lines.append('committer %s' % self.ident('committer', config))
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        data = ('\n'.join(lines) + '\n\n').encode('utf-8') + message
+        return self.write_object('commit', data)
+
+    ##################################################################
+    # refs
+
+    def read_packed_refs(self):
+        path = os.path.join(self.common_dir, 'packed-refs')
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.packed_refs = {}
+            self.packed_refs_stamp = None
+            return self.packed_refs
+
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        if stamp != self.packed_refs_stamp:
+            refs = {}
+            fd = io.open(path)
+            try:
+                for line in fd:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    fields = line.split()
+                    if len(fields) == 2:
+                        refs[fields[1]] = fields[0]
+            finally:
+                fd.close()
+            self.packed_refs = refs
+            self.packed_refs_stamp = stamp
+        return self.packed_refs
+
+    def read_line(self, path):
+        """Returns the first line of 'path', or '' if it can't be read."""
+        try:
+            fd = io.open(path)
+            try:
+                return fd.readline().strip()
+            finally:
+                fd.close()
+        except (IOError, OSError):
+            return ''
+
+    def read_ref(self, ref, depth=0):
+        """Returns the sha that 'ref' (e.g. 'refs/heads/master') points to,
+        following symbolic refs, or None if it doesn't exist."""
+        if depth > 5:
+            raise OdbError("too many levels of symbolic refs at %s" % ref)
+
+        if ref.startswith('refs/'):
+            path = os.path.join(self.common_dir, ref)
+        else:
+            path = os.path.join(self.git_dir, ref)
+        value = self.read_line(path)
+        if value:
+            if value.startswith('ref: '):
+                return self.read_ref(value[5:].strip(), depth + 1)
+            if sha_pat.match(value[:40]) and \
+               (len(value) == 40 or value[40].isspace()):
+                return value[:40]
+            return None
+
+        return self.read_packed_refs().get(ref)
+
+    def resolve(self, name):
+        """Resolves 'name' the way 'git rev-parse' does for plain ref names,
+        returning None when git should be asked instead."""
+        if sha_pat.match(name):
+            return name
+        if not name or unsafe_ref_pat.search(name):
+            return None
+        for ref in (name, 'refs/%s' % name, 'refs/tags/%s' % name,
+                    'refs/heads/%s' % name, 'refs/remotes/%s' % name,
+                    'refs/remotes/%s/HEAD' % name):
+            sha = self.read_ref(ref)
+            if sha:
+                return sha
+        return None
+
+    def update_ref(self, ref, new, old=None, message=''):
+        """Points 'ref' at 'new'.  If 'old' is given, the ref must still
+        point there, otherwise RefError is raised and nothing changes."""
+        self.check_writable()
+        if not ref.startswith('refs/') or unsafe_ref_pat.search(ref):
+            raise OdbError("%s is left to git" % ref)
+        ident = self.ident('committer')
+
+        path = os.path.join(self.common_dir, ref)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        lock = path + '.lock'
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise RefError("%s is locked by another process" % ref)
+            raise
+
+        # The ref can only be read once the lock is held: anybody else
+        # moving it has to take the same lock first.
+        try:
+            try:
+                if self.read_line(path).startswith('ref:'):
+                    raise OdbError("symbolic ref %s is left to git" % ref)
+                current = self.read_ref(ref)
+                if old is not None and current != old:
+                    raise RefError("%s is at %s, not %s" % (ref, current, old))
+                os.write(fd, (new + '\n').encode('ascii'))
+            finally:
+                os.close(fd)
+            getattr(os, 'replace', os.rename)(lock, path)
+        except:
+            if os.path.exists(lock):
+                os.remove(lock)
+            raise
+
+        if not current:
+            current = '0' * 40
+        entry = '%s %s %s' % (current, new, ident)
+        if message:
+            entry += '\t' + message
+        self.append_reflog(ref, entry)
+        if self.read_line(os.path.join(self.git_dir, 'HEAD')) == \
+           'ref: %s' % ref:
+            self.append_reflog('HEAD', entry)
+
+    def append_reflog(self, ref, entry):
+        if ref == 'HEAD':
+            path = os.path.join(self.git_dir, 'logs', ref)
+        else:
+            path = os.path.join(self.common_dir, 'logs', ref)
+
+        if not os.path.exists(path):
+            # only start a new reflog where core.logAllRefUpdates says so
+            setting = self.config.get('core.logallrefupdates', '').lower()
+            if not setting:
+                # defaults to true, except in bare repositories
+                if self.config.get('core.bare', '').lower() in true_values:
+                    return
+                setting = 'true'
+            if setting != 'always':
+                if setting not in true_values:
+                    return
+                if ref != 'HEAD' and not ref.startswith(
+                        ('refs/heads/', 'refs/remotes/', 'refs/notes/')):
+                    return
+
+        # The ref has already moved, so a reflog we can't write isn't worth
+        # failing over.
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd = io.open(path, 'ab')
+            try:
+                fd.write((entry + '\n').encode('utf-8'))
+            finally:
+                fd.close()
+        except (IOError, OSError):
+            pass
+
+
+def open(repository=None):
+    """Returns a gitodb for 'repository' (a git directory), or for the
+    repository containing the current directory.  Raises OdbError if there
+    is none, or if it cannot be read natively."""
+    git_dir = find_git_dir(repository)
+    if git_dir is None:
+        raise OdbError("no usable git directory found")
+    return gitodb(git_dir)
+
+# gitodb.py ends here
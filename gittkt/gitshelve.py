@@ -25,13 +25,25 @@
 #
 #   print data['foo/bar/git.c']
 #
+#   with data.transaction("More changes"):   # one commit for both
+#       data['foo/bar/git.h'] = "More sample data."
+#       del data['foo/bar/git.c']
+#
 #   data.close()
 #
 # If you checkout the 'mydata' branch now, you'll see the file 'git.c' in the
 # directory 'foo/bar'.  Running 'git log' will show the change you made.
 
+import binascii
+import collections
+import io
+import random
 import re
 import os
+import shutil
+import tempfile
+import threading
+import time
 from pipes import quote
 
 try:
@@ -41,12 +53,181 @@ except:
 
 from subprocess import Popen, PIPE
 
+try:
+    import gitodb
+except ImportError:
+    gitodb = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None   # Python 2 without the futures backport
+
 ######################################################################
 
 verbose = False
 
 ######################################################################
 
+# Every git process that is run, and every object asked of a 'cat-file
+# --batch' child, is reported once it's done to each function in 'hooks', as
+# a gitcall: the subcommand and its arguments, the time it took, the bytes
+# sent to it and read back, its exit code (1 for a missing object, in the
+# batch case) and the operation it was run for, if any was named with
+# operation().  gitstats is such a hook, which keeps counters and a
+# histogram of the times per subcommand and per operation.
+#
+#   stats = gitshelve.gitstats().install()
+#   with gitshelve.operation('List'):
+#       ...
+#   print stats.summary()
+
+hooks = []
+operations = []
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class gitcall(object):
+    __slots__ = ('cmd', 'args', 'elapsed', 'bytes_in', 'bytes_out',
+                 'returncode', 'operation')
+
+    def __init__(self, cmd, args, elapsed, bytes_in, bytes_out, returncode,
+                 operation=None):
+        self.cmd = cmd
+        self.args = args
+        self.elapsed = elapsed
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.returncode = returncode
+        self.operation = operation
+
+    def __repr__(self):
+        return '<gitshelve.gitcall %s %s %.3fs %d>' % \
+                (self.cmd, ' '.join(self.args), self.elapsed, self.returncode)
+
+
+def notify(cmd, args, start, bytes_in, bytes_out, returncode):
+    """Tells the hooks about a call to git that began at 'start'."""
+    if not hooks:
+        return
+    operation = None
+    if operations:
+        operation = operations[-1]
+    call = gitcall(cmd, tuple(args), timer() - start, bytes_in, bytes_out,
+                   returncode, operation)
+    for hook in list(hooks):
+        hook(call)
+
+
+class operation:
+    """Names the git calls made within it after what is being done, as in
+    'with operation("Folder.List"): ...'.  Operations can be nested; the
+    innermost one is reported."""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        operations.append(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        operations.pop()
+        return False
+
+
+class gitstats:
+    """A hook that counts the calls to git, their times, the bytes they
+    moved and their failures, for each subcommand and for each operation.
+    The times are also counted in a histogram whose buckets double from one
+    millisecond; the last one holds everything slower."""
+    buckets = tuple(0.001 * 2 ** i for i in range(12))
+
+    def __init__(self):
+        self.commands = {}
+        self.operations = {}
+        self.started = timer()
+
+    def __call__(self, call):
+        self.count(self.commands, call.cmd, call)
+        self.count(self.operations, call.operation, call)
+
+    def count(self, table, key, call):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = {'calls': 0, 'elapsed': 0.0, 'max': 0.0,
+                                  'bytes_in': 0, 'bytes_out': 0,
+                                  'failures': 0,
+                                  'histogram': [0] * (len(self.buckets) + 1)}
+        entry['calls'] += 1
+        entry['elapsed'] += call.elapsed
+        entry['max'] = max(entry['max'], call.elapsed)
+        entry['bytes_in'] += call.bytes_in
+        entry['bytes_out'] += call.bytes_out
+        if call.returncode != 0:
+            entry['failures'] += 1
+        bucket = 0
+        while bucket < len(self.buckets) and \
+              call.elapsed > self.buckets[bucket]:
+            bucket += 1
+        entry['histogram'][bucket] += 1
+
+    def install(self):
+        hooks.append(self)
+        return self
+
+    def uninstall(self):
+        if self in hooks:
+            hooks.remove(self)
+
+    def percentile(self, entry, fraction):
+        """Returns the bucket bound below which 'fraction' of the calls in
+        'entry' took, or None if that is past the last bucket."""
+        wanted = entry['calls'] * fraction
+        seen = 0
+        for bucket, count in enumerate(entry['histogram']):
+            seen += count
+            if seen >= wanted:
+                if bucket < len(self.buckets):
+                    return self.buckets[bucket]
+                return None
+        return None
+
+    def summary(self):
+        """Returns a table of the counts, slowest subcommands first, and
+        how much of the time since the stats were started went to git."""
+        lines = []
+        for title, table in (('command', self.commands),
+                             ('operation', self.operations)):
+            lines.append('%-20s %6s %10s %8s %8s %8s %10s %10s %5s' %
+                         (title, 'calls', 'total ms', 'mean ms', 'p50 ms',
+                          'p90 ms', 'bytes in', 'bytes out', 'fail'))
+            keys = sorted(table, key=lambda key: -table[key]['elapsed'])
+            for key in keys:
+                entry = table[key]
+                quantiles = []
+                for fraction in (0.5, 0.9):
+                    bound = self.percentile(entry, fraction)
+                    if bound is None:
+                        quantiles.append('>%d' % (self.buckets[-1] * 1000))
+                    else:
+                        quantiles.append('<%g' % (bound * 1000))
+                lines.append('%-20s %6d %10.1f %8.2f %8s %8s %10d %10d %5d' %
+                             (key or '-', entry['calls'],
+                              entry['elapsed'] * 1000,
+                              entry['elapsed'] * 1000 / entry['calls'],
+                              quantiles[0], quantiles[1], entry['bytes_in'],
+                              entry['bytes_out'], entry['failures']))
+            lines.append('')
+
+        total = timer() - self.started
+        in_git = sum(entry['elapsed'] for entry in self.commands.values())
+        lines.append('%.1f ms in all, %.1f ms waiting for git, %.1f ms '
+                     'elsewhere' % (total * 1000, in_git * 1000,
+                                    (total - in_git) * 1000))
+        return '\n'.join(lines) + '\n'
+
+######################################################################
+
 # Utility function for calling out to Git (this script does not try to
 # be a Git library, just an interface to the underlying commands).  It
 # supports a 'restart' keyword, which will cause a Python function to
@@ -79,6 +260,16 @@ class GitError(Exception):
             errorMsg += " %s"%(self.stderr)
         return errorMsg
 
+class StaleHeadError(GitError):
+    """The branch could not be moved, because it no longer points where the
+    shelf last saw it, or because someone else is moving it."""
+
+
+class ConflictError(GitError):
+    """A commit could not be rebased onto changes made to the branch by
+    someone else, because they touched the same paths."""
+
+
 def git(cmd, *args, **kwargs):
     restart = True
     while restart:
@@ -113,6 +304,7 @@ def git(cmd, *args, **kwargs):
             if not os.path.isdir(work_tree):
                 os.makedirs(work_tree)
 
+        start = timer()
         proc = Popen(('git', cmd) + args, env=environ,
                      stdin=stdin_mode,
                      stdout=PIPE,
@@ -128,6 +320,8 @@ def git(cmd, *args, **kwargs):
         out, err = proc.communicate(input)
 
         returncode = proc.returncode
+        notify(cmd, args, start, len(input or b''), len(out) + len(err),
+               returncode)
         restart = False
         ignore_errors = 'ignore_errors' in kwargs and kwargs['ignore_errors']
         if returncode != 0:
@@ -148,9 +342,382 @@ def git(cmd, *args, **kwargs):
         return unicode(retval)
 
 
-class gitbook:
+def decode(data):
+    try:
+        return str(data, "utf-8")
+    except TypeError:
+        return unicode(data)
+
+
+def encode(data):
+    if data is None:
+        return b''              # git() sends nothing on stdin for None
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+
+# A long-lived 'git cat-file --batch' child.  Object names are written to its
+# stdin one per line, and it answers each with a '<sha> <type> <size>' header
+# followed by the raw contents, so reading a blob costs a write and a read on
+# a pipe rather than a fork/exec.  If the child goes away, get() raises
+# IOError and the caller is expected to fall back to git().
+
+
+class gitbatch:
+    def __init__(self, repository=None):
+        environ = None
+        if repository:
+            environ = os.environ.copy()
+            environ['GIT_DIR'] = repository
+
+        if verbose:
+            print("Command: git cat-file --batch")
+
+        # stderr is never read, so don't let the child block on it
+        self.devnull = io.open(os.devnull, 'wb')
+        self.proc = Popen(('git', 'cat-file', '--batch'), env=environ,
+                          stdin=PIPE,
+                          stdout=PIPE,
+                          stderr=self.devnull)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def get(self, name):
+        """Returns a (kind, data) tuple for the object 'name', where data is
+        the raw contents as bytes.  Raises KeyError if the object does not
+        exist, and IOError if the child process cannot be talked to."""
+        if not self.alive():
+            raise IOError("git cat-file --batch is not running")
+
+        if verbose:
+            print("Request: cat-file --batch %s" % name)
+
+        start = timer()
+        try:
+            self.proc.stdin.write(('%s\n' % name).encode('utf-8'))
+            self.proc.stdin.flush()
+        except ValueError:
+            # the pipes were already closed
+            raise IOError("git cat-file --batch is not running")
+        return self.read_answer(name, start)
+
+    def get_many(self, names):
+        """Like get, but asks for all of 'names' before reading any of the
+        answers, so that git goes from one to the next without waiting for
+        us.  Returns a list of (kind, data) in the same order, with None for
+        the objects that don't exist.  Every name has to fit in the pipe
+        before git is read from, so no more than a few hundred should be
+        asked for at a time."""
+        if not self.alive():
+            raise IOError("git cat-file --batch is not running")
+
+        if verbose:
+            print("Request: cat-file --batch %s" % ' '.join(names))
+
+        start = timer()
+        try:
+            self.proc.stdin.write(''.join('%s\n' % name for name in names)
+                                  .encode('utf-8'))
+            self.proc.stdin.flush()
+        except ValueError:
+            raise IOError("git cat-file --batch is not running")
+
+        answers = []
+        for name in names:
+            try:
+                answers.append(self.read_answer(name, start))
+            except KeyError:
+                answers.append(None)
+        return answers
+
+    def read_answer(self, name, start):
+        try:
+            header = self.proc.stdout.readline()
+        except ValueError:
+            raise IOError("git cat-file --batch is not running")
+
+        if not header.endswith(b'\n'):
+            raise IOError("git cat-file --batch exited")
+
+        fields = header.split()
+        if len(fields) != 3:
+            # "<name> missing" or "<name> ambiguous"
+            notify('cat-file', ('--batch', name), start, len(name) + 1,
+                   len(header), 1)
+            raise KeyError(name)
+
+        size = int(fields[2])
+        data = self.proc.stdout.read(size)
+        if len(data) != size or self.proc.stdout.read(1) != b'\n':
+            raise IOError("short read from git cat-file --batch")
+        notify('cat-file', ('--batch', name), start, len(name) + 1,
+               len(header) + size + 1, 0)
+        return fields[1].decode('utf-8'), data
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc.stdout.close()
+        except (IOError, OSError):
+            pass
+        self.devnull.close()
+        self.proc = None
+
+
+# The stdout of a git command, to be read as it is written: what
+# gitshelve.open_read returns when the object database can't be read
+# natively.  The exit code is checked once everything has been read, and
+# reading after a failure raises GitError.
+
+class gitpipe(io.RawIOBase):
+    def __init__(self, cmd, *args, **kwargs):
+        environ = None
+        if kwargs.get('repository'):
+            environ = os.environ.copy()
+            environ['GIT_DIR'] = kwargs['repository']
+
+        if verbose:
+            print("Command: git %s %s" % (cmd, ' '.join(args)))
+
+        self.cmd = cmd
+        self.args = args
+        self.start = timer()
+        self.bytes_out = 0
+        # stderr goes to a file, which can't fill up and block the child
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = Popen(('git', cmd) + args, env=environ,
+                          stdout=PIPE, stderr=self.stderr)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.proc.returncode is not None:
+            return 0
+        data = os.read(self.proc.stdout.fileno(), len(b))
+        if not data:
+            self.finish()
+            return 0
+        self.bytes_out += len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def finish(self):
+        returncode = self.proc.wait()
+        self.proc.stdout.close()
+        self.stderr.seek(0)
+        err = self.stderr.read()
+        self.stderr.close()
+        notify(self.cmd, self.args, self.start, 0, self.bytes_out + len(err),
+               returncode)
+        if returncode != 0:
+            raise GitError(self.cmd, self.args, {}, err, returncode)
+
+    def close(self):
+        if not self.closed and self.proc.returncode is None:
+            # closed before the end, so the rest isn't wanted
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            self.stderr.close()
+        io.RawIOBase.close(self)
+
+
+# What gitshelve.open_write returns.  The data written to it is kept in a
+# temporary file, and stored as the book's blob when it is closed, by
+# streaming that file into the object database or into 'git hash-object'.
+# Leaving a 'with' block by an exception throws the data away instead.
+
+class gitbookwriter(io.RawIOBase):
+    def __init__(self, shelf, path):
+        self.shelf = shelf
+        self.path = path
+        self.name = None
+        fd, self.tmp = tempfile.mkstemp(prefix='gitshelve-')
+        self.fd = os.fdopen(fd, 'w+b')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.fd.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.fd.flush()
+            self.name = self.shelf.write_blob_file(self.fd, self.tmp)
+            self.shelf.set_blob(self.path, self.name)
+        finally:
+            self.discard()
+
+    def discard(self):
+        if not self.closed:
+            self.fd.close()
+            os.remove(self.tmp)
+            io.RawIOBase.close(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+        return False
+
+
+# The contents of blobs already read, shared by every shelf in the process.
+# A blob never changes once written, so what was read under a name is good for
+# any shelf, branch or repository that asks for it again.  The least recently
+# used blobs are dropped once their contents add up to more than 'max_bytes'.
+# If 'directory' is set, each blob is also written there as a file, named
+# like a loose object, and read back from it when it's no longer in memory --
+# so that separate runs of a command don't have to ask git again either.
+#
+#   gitshelve.blobs.directory = os.path.expanduser('~/.cache/gitshelve')
+#   print gitshelve.blobs.summary()
+
+class blobcache:
+    def __init__(self, max_bytes=32 << 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'disk_hits': 0,
+                      'evictions': 0}
+
+    def get(self, name):
+        """Returns the contents of blob 'name', or None if they aren't
+        cached."""
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.entries[name] = entry      # now the most recent
+                self.stats['hits'] += 1
+                return entry[0]
+
+        data = self.read_file(name)
+        if data is None:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        size = len(encode(data))
+        with self.lock:
+            self.stats['disk_hits'] += 1
+            self.insert(name, data, size)
+        return data
+
+    def put(self, name, data):
+        size = len(encode(data))
+        with self.lock:
+            if name in self.entries:
+                return
+            self.insert(name, data, size)
+        self.write_file(name, data)
+
+    def insert(self, name, data, size):
+        """Keeps 'data', which is 'size' bytes as stored by git, unless
+        another thread got there first."""
+        if name in self.entries or size > self.max_bytes:
+            return                  # or it would push everything else out
+        self.entries[name] = (data, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            old_name, old_entry = self.entries.popitem(last=False)
+            self.size -= old_entry[1]
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def file_path(self, name):
+        return os.path.join(self.directory, name[:2], name[2:])
+
+    def read_file(self, name):
+        if not self.directory:
+            return None
+        try:
+            fd = io.open(self.file_path(name), 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            return decode(fd.read())
+        finally:
+            fd.close()
+
+    def write_file(self, name, data):
+        if not self.directory:
+            return
+        path = self.file_path(name)
+        if os.path.exists(path):
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write it aside first, so that no reader sees half of it
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                os.write(fd, encode(data))
+            finally:
+                os.close(fd)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass                    # the disk tier is only a convenience
+
+    def summary(self):
+        lookups = self.stats['hits'] + self.stats['disk_hits'] + \
+                  self.stats['misses']
+        rate = 0.0
+        if lookups:
+            rate = 100.0 * (lookups - self.stats['misses']) / lookups
+        return 'blob cache: %d hits, %d from disk, %d misses (%.0f%% hit), ' \
+               '%d evicted, %d bytes in %d blobs\n' % \
+               (self.stats['hits'], self.stats['disk_hits'],
+                self.stats['misses'], rate, self.stats['evictions'],
+                self.size, len(self.entries))
+
+
+blobs = blobcache()
+
+
+# The objects of a shelf are a tree of gittree dicts, one per Git tree,
+# mapping each entry to the gitbook of a blob or to another gittree.  A tree
+# holds its own name under '__root__' for as long as it is known to be
+# unchanged, and in lazy mode its path under '__lazy__' until it is listed.
+# A shelf can hold a great many books, so both are kept small: a gittree is
+# no bigger than a plain dict, and a gitbook has slots instead of a __dict__
+# and keeps its blob name as 20 binary bytes.
+
+class gittree(dict):
+    __slots__ = ()
+
+
+def leaf_book(obj):
+    """Returns the gitbook at a tree entry, or None if the entry is a tree.
+    A book wrapped in a dict of its own, {'__book__': book}, as books once
+    were, is still understood."""
+    if isinstance(obj, gitbook):
+        return obj
+    if len(obj) == 1 and '__book__' in obj:
+        return obj['__book__']
+    return None
+
+
+class gitbook(object):
     """Abstracts a reference to a data file within a Git repository.  It also
     maintains knowledge of whether the object has been modified or not."""
+    __slots__ = ('shelf', 'path', 'binname', 'data', 'dirty')
+    name_pat = re.compile('[0-9a-f]{40}$')
+
     def __init__(self, shelf, path, name=None):
         self.shelf = shelf
         self.path = path
@@ -158,6 +725,30 @@ class gitbook:
         self.data = None
         self.dirty = False
 
+    def get_name(self):
+        binname = self.binname
+        if isinstance(binname, bytes) and len(binname) == 20:
+            return str(binascii.hexlify(binname).decode('ascii'))
+        return binname
+
+    def set_name(self, name):
+        if name is not None and self.name_pat.match(name):
+            name = binascii.unhexlify(name)
+        self.binname = name
+
+    name = property(get_name, set_name)
+
+    # Code that reaches into the objects may still look a book up the way it
+    # was found when books were kept in dicts, as book['__book__'].
+
+    def __getitem__(self, key):
+        if key != '__book__':
+            raise KeyError(key)
+        return self
+
+    def __contains__(self, key):
+        return key == '__book__'
+
     def __repr__(self):
         return '<gitshelve.gitbook %s %s %s>' % \
                 (self.path, self.name, self.dirty)
@@ -174,6 +765,7 @@ class gitbook:
             self.name = None
             self.data = data
             self.dirty = True
+            self.shelf.mark_dirty(self.path)
 
     def serialize_data(self, data):
         return data
@@ -185,13 +777,98 @@ class gitbook:
         return None
 
     def __getstate__(self):
-        odict = self.__dict__.copy()  # copy the dict since we change it
-        del odict['dirty']            # remove dirty flag
-        return odict
+        return {'shelf': self.shelf, 'path': self.path, 'name': self.name,
+                'data': self.data}
 
     def __setstate__(self, ndict):
-        self.__dict__.update(ndict)   # update attributes
+        for key in ('shelf', 'path', 'name', 'data'):
+            if key in ndict:
+                setattr(self, key, ndict[key])
+            elif not hasattr(self, key):
+                setattr(self, key, None)
+        self.dirty = False
+
+
+# A transaction groups any number of changes to a shelf into one commit, made
+# when the outermost transaction ends.  Everything it changes is recorded in a
+# journal the first time it is touched -- the contents of each tree dict, and
+# the name, data and dirty flag of each book, including those a rebase patches
+# -- and the head is noted, so that an exception can put the shelf back
+# exactly as it was.  A nested transaction keeps a journal of
+# its own and hands it to the enclosing one when it succeeds, so a failure
+# only undoes its own changes.
+
+class gittransaction:
+    def __init__(self, shelf, message=None):
+        self.shelf = shelf
+        self.message = message
+        self.messages = []
+        self.journal = {}
         self.dirty = False
+        self.deleted = 0
+        self.head = None
+        self.snapshot_head = None
+
+    def __enter__(self):
+        self.dirty = self.shelf.dirty
+        self.deleted = len(self.shelf.deleted)
+        # a rebase moves the head along with the trees it patches
+        self.head = self.shelf.head
+        self.snapshot_head = self.shelf.snapshot_head
+        if self.message:
+            self.messages.append(self.message)
+        self.shelf.journals.append(self)
+        return self.shelf
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        journals = self.shelf.journals
+        journals.pop()
+        if exc_type is not None:
+            self.rollback()
+            return False
+
+        if journals:
+            # join the enclosing transaction
+            outer = journals[-1]
+            for key, entry in self.journal.items():
+                outer.journal.setdefault(key, entry)
+            outer.messages.extend(self.messages)
+            return False
+
+        comment = None
+        if self.messages:
+            comment = '\n\n'.join(self.messages)
+        # still journalling, for the trees and books a rebase patches
+        journals.append(self)
+        try:
+            self.shelf.commit(comment)
+        except:
+            journals.pop()
+            self.rollback()
+            raise
+        journals.pop()
+        return False
+
+    def touch(self, obj):
+        if id(obj) in self.journal:
+            return
+        if isinstance(obj, dict):
+            self.journal[id(obj)] = (obj, obj.copy())
+        else:
+            self.journal[id(obj)] = (obj, (obj.name, obj.data, obj.dirty))
+
+    def rollback(self):
+        for obj, saved in self.journal.values():
+            if isinstance(obj, dict):
+                obj.clear()
+                obj.update(saved)
+            else:
+                obj.name, obj.data, obj.dirty = saved
+        self.journal = {}
+        del self.shelf.deleted[self.deleted:]
+        self.shelf.dirty = self.dirty
+        self.shelf.head = self.head
+        self.shelf.snapshot_head = self.snapshot_head
 
 
 class gitshelve(dict):
@@ -212,38 +889,122 @@ class gitshelve(dict):
     branch = 'master'
     repository = None
     keep_history = True
+    engine = 'mktree'
+    lazy = False
+    reader = None
+    use_batch = True
+    odb = None
+    odb_cwd = None
+    use_odb = True
+    use_snapshot = True
+    snapshot_head = None
+    deleted = []
+    journals = None
+    snapshot_magic = 'gitshelve-snapshot 1'
+    blob_cache = blobs
+    view_trees = None
+    prefetch = 64
+    max_workers = None
+    retry_limit = 8
+    retry_delay = 0.01
+    retry_delay_max = 1.0
+    contention = None
 
     def __init__(self, branch='master', repository=None,
-                 keep_history=True, book_type=gitbook):
+                 keep_history=True, book_type=gitbook, engine='mktree',
+                 lazy=False, max_workers=None):
+        if engine not in ('mktree', 'fast-import'):
+            raise ValueError("engine must be 'mktree' or 'fast-import'")
         self.branch = branch
         self.repository = repository
         self.keep_history = keep_history
         self.book_type = book_type
+        self.engine = engine
+        self.lazy = lazy
+        self.max_workers = max_workers
+        self.journals = []
+        self.contention = {'commits': 0, 'retries': 0, 'rebases': 0,
+                           'conflicts': 0}
         self.init_data()
         dict.__init__(self)
 
     def init_data(self):
         self.head = None
         self.dirty = False
-        self.objects = {}
+        self.objects = gittree()
+        self.deleted = []
 
     def git(self, *args, **kwargs):
         if self.repository:
             kwargs['repository'] = self.repository
         return git(*args, **kwargs)
 
+    def get_odb(self):
+        """Returns a gitodb for reading the repository without running git,
+        or None if that isn't possible."""
+        if not self.use_odb or gitodb is None:
+            return None
+
+        if self.odb is not None and not self.repository and \
+           self.odb_cwd != os.getcwd():
+            # git finds the repository from the current directory
+            self.close_odb()
+
+        if self.odb is None:
+            try:
+                self.odb = gitodb.open(self.repository)
+                self.odb_cwd = os.getcwd()
+            except gitodb.errors:
+                pass
+        return self.odb
+
+    def close_odb(self):
+        if self.odb is not None:
+            self.odb.close()
+            self.odb = None
+
     def current_head(self):
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                x = odb.resolve(self.branch)
+            except gitodb.errors:
+                x = None
+            if x:
+                return x
+
         x = self.git('rev-parse', self.branch)
         if len(x) != 40:
             raise ValueError("rev-parse went insane: %s" % x)
         return x
 
     def update_head(self, new_head):
-        if self.head:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head,
-                     self.head)
-        else:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head)
+        """Moves the branch from 'head' to 'new_head', or raises
+        StaleHeadError if it isn't at 'head' any more.  A shelf without a
+        head moves the branch wherever it is."""
+        ref = 'refs/heads/%s' % self.branch
+        old = self.head
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                odb.update_ref(ref, new_head, old)
+                self.head = new_head
+                return
+            except gitodb.RefError as e:
+                # git would refuse just the same
+                raise StaleHeadError('update-ref', [ref, new_head, old], {},
+                                     str(e))
+            except gitodb.errors:
+                pass
+
+        try:
+            if old:
+                self.git('update-ref', ref, new_head, old)
+            else:
+                self.git('update-ref', ref, new_head)
+        except GitError as e:
+            raise StaleHeadError(e.cmd, e.args, e.kwargs, e.stderr,
+                                 e.returncode)
         self.head = new_head
 
     def read_repository(self):
@@ -256,60 +1017,795 @@ class gitshelve(dict):
         if not self.head:
             return
 
-        ls_tree = self.git('ls-tree', '--full-tree','-r', '-t', '-z', self.head).split('\0')
-        for line in ls_tree:
+        if self.lazy:
+            # Nothing is listed until it is asked for; see expand_tree.
+            self.objects['__lazy__'] = ''
+            return
+
+        if self.load_snapshot(self.head):
+            return
+
+        for treep, name, path in self.tree_entries(self.head, True):
+            self.add_entry(treep, name, path)
+        self.save_snapshot()
+
+    def add_entry(self, treep, name, path):
+        parts = path.split(os.sep)
+        d = self.objects
+        for part in parts[:-1]:
+            if not part in d:
+                d[part] = gittree()
+            d = d[part]
+
+        if treep:
+            d.setdefault(parts[-1], gittree())['__root__'] = name
+        else:
+            d[parts[-1]] = self.book_type(self, path, name)
+
+    # The objects of a branch are kept in .git/gitshelve/<branch> between
+    # runs, so that they don't have to be listed again with ls-tree every
+    # time the shelf is opened.  The file holds NUL-separated records: a
+    # header naming the commit they describe, then one record per tree or
+    # blob, made of 't' or 'b', the object name and the path.
+
+    def snapshot_path(self):
+        """Returns where the snapshot of this branch is kept, or None."""
+        if not self.use_snapshot or self.lazy:
+            return None
+        odb = self.get_odb()
+        if odb is not None:
+            git_dir = odb.common_dir
+        else:
+            try:
+                git_dir = self.git('rev-parse', '--git-common-dir')
+            except GitError:
+                return None
+        name = self.branch.replace('%', '%25').replace('/', '%2F')
+        return os.path.join(git_dir, 'gitshelve', name)
+
+    def load_snapshot(self, head):
+        """Fills in the objects from the snapshot of the branch, catching
+        up with 'head' if the branch has moved since it was written.  Returns
+        False, leaving the objects empty, if there's no usable snapshot."""
+        path = self.snapshot_path()
+        if path is None:
+            return False
+        try:
+            fd = io.open(path, 'rb')
+            try:
+                records = decode(fd.read()).split('\0')
+            finally:
+                fd.close()
+        except (IOError, OSError, UnicodeError):
+            return False
+
+        header = records[0].rsplit(' ', 1)
+        if len(header) != 2 or header[0] != self.snapshot_magic:
+            return False
+        self.head = header[1]
+        for record in records[1:]:
+            if len(record) < 42 or record[0] not in 'tb':
+                self.init_data()
+                self.head = head
+                return False
+            self.add_entry(record[0] == 't', record[1:41], record[41:])
+        self.snapshot_head = self.head
+
+        if self.head != head:
+            try:
+                changes = list(self.tree_changes(self.head, head))
+            except (GitError, ValueError):
+                self.init_data()
+                self.head = head
+                return False
+            self.apply_changes(head, changes)
+        return True
+
+    def snapshot_records(self, objects, records, path=''):
+        for entry, obj in objects.items():
+            if entry == '__root__':
+                continue
+            if path:
+                entry_path = os.sep.join((path, entry))
+            else:
+                entry_path = entry
+            book = leaf_book(obj)
+            if book is not None:
+                records.append('b%s%s' % (book.name, entry_path))
+            else:
+                if '__root__' in obj:
+                    records.append('t%s%s' % (obj['__root__'], entry_path))
+                self.snapshot_records(obj, records, entry_path)
+
+    def save_snapshot(self):
+        """Writes the objects out as the snapshot of the branch, if they
+        are all committed and the snapshot doesn't already hold them."""
+        if self.dirty or not self.head or self.head == self.snapshot_head \
+           or '__lazy__' in self.objects:
+            return
+        path = self.snapshot_path()
+        if path is None:
+            return
+
+        records = ['%s %s' % (self.snapshot_magic, self.head)]
+        self.snapshot_records(self.objects, records)
+        # It's only a cache, so failing to write it is not an error.
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                out = os.fdopen(fd, 'wb')
+                try:
+                    out.write(encode('\0'.join(records)))
+                finally:
+                    out.close()
+                getattr(os, 'replace', os.rename)(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        except (IOError, OSError):
+            return
+        self.snapshot_head = self.head
+
+    def ls_tree_entries(self, ls_tree):
+        """Parses the output of 'ls-tree -z' into (perm, kind, name, path)
+        tuples."""
+        for line in ls_tree.split('\0'):
             if not line:
                 continue
             match = self.ls_tree_pat.match(line)
             if not match:
                 raise ValueError("ls-tree went insane: %s" % line)
+            yield match.group(2), match.group(3), match.group(4), \
+                  match.group(5)
+
+    def tree_entries(self, treeish, recursive=False):
+        """Lists 'treeish' as (treep, name, path) tuples, the way
+        'ls-tree -z' does, or 'ls-tree -r -t -z' if 'recursive' is set.  The
+        object database is read directly when possible."""
+        entries = None
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                entries = list(odb.ls_tree(treeish, recursive))
+            except gitodb.errors:
+                entries = None
+
+        if entries is None:
+            if recursive:
+                ls_tree = self.git('ls-tree', '--full-tree', '-r', '-t', '-z',
+                                   treeish)
+            else:
+                ls_tree = self.git('ls-tree', '-z', treeish)
+            entries = self.ls_tree_entries(ls_tree)
+
+        for perm, kind, name, path in entries:
+            treep = kind == 'tree'
+            self.check_mode(path, perm, treep)
+            yield treep, name, path
+
+    def check_mode(self, path, perm, treep):
+        if treep and perm != '040000':
+            raise GitError('read_repository', [], {},
+                   'Invalid mode for %s : 040000 required, %s found' \
+                           % (path, perm))
+        if not treep and perm != '100644':
+            raise GitError('read_repository', [], {},
+                   'Invalid mode for %s : 100644 required, %s found' \
+                           % (path, perm))
+
+    def tree_changes(self, old, new):
+        """Lists the differences between commits 'old' and 'new' as
+        (treep, status, name, path) tuples, the way 'diff-tree -r -t -z'
+        does.  'name' is the new object, or None for deletions."""
+        changes = None
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                changes = list(odb.diff_tree(old, new))
+            except gitodb.errors:
+                changes = None
+
+        if changes is None:
+            changes = []
+            fields = self.git('diff-tree', '-r', '-t', '-z', old, new,
+                              keep_newline=True).split('\0')
+            for i in range(0, len(fields) - 1, 2):
+                meta = fields[i].lstrip(':').split(' ')
+                if len(meta) != 5:
+                    raise ValueError("diff-tree went insane: %s" % fields[i])
+                changes.append(tuple(meta) + (fields[i + 1],))
+
+        for old_perm, new_perm, old_name, new_name, status, path in changes:
+            if status == 'D':
+                treep = old_perm == '040000'
+                self.check_mode(path, old_perm, treep)
+                yield treep, status, None, path
+            else:
+                treep = new_perm == '040000'
+                self.check_mode(path, new_perm, treep)
+                yield treep, status, new_name, path
+
+    def history(self, path_prefix=None, since=None, base=None):
+        """Yields (commit, author, date, path, old_name, new_name) for every
+        book changed on the branch, newest commit first, as told by one 'git
+        log --raw -z' that is read and parsed as it goes.  'author' is 'Name
+        <email>', 'date' is in seconds since the epoch, and old_name is None
+        for a book that was added, new_name None for one that was deleted.
+        Only the changes below 'path_prefix' are listed, and only those made
+        after 'since' (any date git understands), or not reachable from the
+        commit 'base'.  Closing the generator early stops git."""
+        try:
+            head = self.current_head()
+        except (GitError, ValueError):
+            return                  # no branch, so no history
+        args = ['--raw', '-z', '--root', '--no-abbrev', '--no-renames',
+                '--no-color', '--format=%H%x00%an <%ae>%x00%at']
+        if since is not None:
+            args.append('--since=%s' % since)
+        if base is not None:
+            args.append('^%s' % base)
+        args.extend([head, '--'])
+        if path_prefix:
+            args.append(path_prefix)
+
+        kwargs = {}
+        if self.repository:
+            kwargs['repository'] = self.repository
+        stream = io.BufferedReader(gitpipe('log', *args, **kwargs))
+        try:
+            fields = self.nul_fields(stream)
+            for field in fields:
+                field = field.lstrip('\n')
+                if not field.startswith(':'):
+                    commit = field
+                    author = next(fields)
+                    date = int(next(fields))
+                    continue
+
+                meta = field[1:].split(' ')
+                if len(meta) != 5:
+                    raise ValueError("git log went insane: %s" % field)
+                path = next(fields)
+                old_name = meta[2]
+                if meta[4] == 'A':
+                    old_name = None
+                new_name = meta[3]
+                if meta[4] == 'D':
+                    new_name = None
+                yield commit, author, date, path, old_name, new_name
+        finally:
+            stream.close()
+
+    def nul_fields(self, stream, size=64 * 1024):
+        """Yields the NUL-terminated fields read from 'stream'."""
+        rest = b''
+        while True:
+            data = stream.read(size)
+            if not data:
+                break
+            fields = (rest + data).split(b'\0')
+            rest = fields.pop()
+            for field in fields:
+                yield decode(field)
+
+    def refresh(self):
+        """Brings the shelf up to date with its branch by applying only
+        what changed since 'head' was read, instead of reading everything
+        again.  Books that did not change keep their cached data.  Pending
+        changes are kept too, and win over the branch where both touched
+        the same path.  Returns the paths of the books that changed on the
+        branch, or None if everything had to be read again."""
+        try:
+            new_head = self.current_head()
+        except (GitError, ValueError):
+            new_head = None
+        if new_head == self.head:
+            return []
+        if not self.head or not new_head:
+            if self.dirty:
+                raise GitError('refresh', [], {},
+                               'Cannot refresh %s over pending changes' %
+                               self.branch)
+            self.read_repository()
+            return None
 
-            treep = match.group(1) == "040000 tree"
-            perm = match.group(2)
-            name = match.group(4)
-            path = match.group(5)
+        try:
+            changes = list(self.tree_changes(self.head, new_head))
+        except (GitError, ValueError):
+            if self.dirty:
+                raise
+            # e.g. the old head was garbage collected
+            self.read_repository()
+            return None
+        return self.apply_changes(new_head, changes)
+
+    def apply_changes(self, new_head, changes):
+        """Patches the objects with the tree_changes that lead from 'head'
+        to 'new_head'.  Returns the paths of the books that changed.  Every
+        tree and book it changes is touched, so that a transaction can put
+        them back along with the head."""
+        self.head = new_head
+        if '__root__' in self.objects:
+            self.touch(self.objects)
+            del self.objects['__root__']
+        if '__lazy__' in self.objects:
+            return [path for treep, status, name, path in changes
+                    if not treep]
+
+        # Trees can only take their new names as they are when there is
+        # nothing pending that make_tree would have to write into them.
+        exact = not self.dirty
+        changed = []
+        for treep, status, name, path in changes:
+            if not treep:
+                changed.append(path)
+            if [p for p in self.deleted
+                if path == p or path.startswith(p + os.sep)]:
+                continue            # deleted here, and that still stands
 
             parts = path.split(os.sep)
             d = self.objects
-            for part in parts:
+            for part in parts[:-1]:
+                if '__lazy__' in d:
+                    break           # never listed, so nothing to patch
+                if not exact and '__root__' in d:
+                    self.touch(d)
+                    del d['__root__']
                 if not part in d:
-                    d[part] = {}
+                    if status == 'D' or treep:
+                        break       # removed here, or added by its parent
+                    self.touch(d)
+                    d[part] = gittree()
                 d = d[part]
+            else:
+                if '__lazy__' in d:
+                    continue
+                if not exact and '__root__' in d:
+                    self.touch(d)
+                    del d['__root__']
+                self.apply_change(d, parts[-1], treep, status, name, path,
+                                  exact)
+        return changed
+
+    def has_pending(self, objects):
+        for path, obj in objects.items():
+            if path in ('__root__', '__lazy__'):
+                continue
+            book = leaf_book(obj)
+            if book is not None:
+                if book.dirty:
+                    return True
+            elif self.has_pending(obj):
+                return True
+        return False
+
+    def apply_change(self, objects, entry, treep, status, name, path, exact):
+        obj = objects.get(entry)
+        bookp = obj is not None and leaf_book(obj) is not None
+        if bookp and leaf_book(obj).dirty:
+            return                  # a pending change to the same path
+
+        if status == 'D':
+            # only remove what was there before; an entry that changed kind
+            # may already have been replaced
+            if obj is None or bookp == treep:
+                return
+            if treep and self.has_pending(obj):
+                # the deletions of its other entries follow
+                if '__root__' in obj:
+                    self.touch(obj)
+                    del obj['__root__']
+                return
+            self.touch(objects)
+            del objects[entry]
+        elif not treep:
+            self.touch(objects)
+            objects[entry] = self.book_type(self, path, name)
+        elif obj is None and status == 'M':
+            return                  # removed here along with its contents
+        elif self.lazy and (obj is None or bookp):
+            self.touch(objects)
+            objects[entry] = gittree(__root__=name, __lazy__=path)
+        else:
+            if obj is None or bookp:
+                self.touch(objects)
+                obj = objects[entry] = gittree()
+            self.touch(obj)
+            if '__lazy__' in obj or exact:
+                obj['__root__'] = name
+            elif '__root__' in obj:
+                del obj['__root__']
+
+    def expand_tree(self, objects):
+        """In lazy mode, a tree is only listed the first time something
+        reaches into it.  Until then it holds just its '__root__' name and a
+        '__lazy__' key giving its path; this replaces them with the tree's
+        entries, found with a non-recursive ls-tree.  Returns 'objects'."""
+        if not '__lazy__' in objects:
+            return objects
+
+        self.touch(objects)
+        path = objects['__lazy__']
+        if '__root__' in objects:
+            treeish = objects['__root__']
+        else:
+            treeish = self.head     # the top of the branch
 
+        for treep, name, entry in self.tree_entries(treeish):
+            if path:
+                entry_path = os.sep.join((path, entry))
+            else:
+                entry_path = entry
             if treep:
-                if perm == '040000':
-                    d['__root__'] = name
-                else:
-                    raise GitError('read_repository', [], {},
-                           'Invalid mode for %s : 040000 required, %s found' \
-                                   % (path, perm))
+                objects[entry] = self.lazy_tree(name, entry_path)
             else:
-                if perm == '100644':
-                    d['__book__'] = self.book_type(self, path, name)
-                else:
-                    raise GitError('read_repository', [], {},
-                           'Invalid mode for %s : 100644 required, %s found' \
-                                % (path, perm))
+                objects[entry] = self.book_type(self, entry_path, name)
+
+        del objects['__lazy__']
+        return objects
+
+    def lazy_tree(self, name, path):
+        """Returns the unlisted tree 'name' found at 'path'."""
+        return gittree(__root__=name, __lazy__=path)
 
     def open(cls, branch='master', repository=None,
-             keep_history=True, book_type=gitbook):
-        shelf = gitshelve(branch, repository, keep_history, book_type)
+             keep_history=True, book_type=gitbook, engine='mktree',
+             lazy=False, max_workers=None):
+        shelf = gitshelve(branch, repository, keep_history, book_type, engine,
+                          lazy, max_workers)
         shelf.read_repository()
         return shelf
 
     open = classmethod(open)
 
+    def open_at(self, revision):
+        """Returns a read-only gitview of the repository at 'revision'.  The
+        views opened from the same shelf share the trees they have read, so
+        comparing two revisions only lists what differs between them."""
+        if self.view_trees is None:
+            self.view_trees = {}
+        return gitview.open(revision, self.repository, self.book_type,
+                            self.view_trees)
+
     def get_blob(self, name):
+        """Returns the contents of blob 'name', from 'blob_cache' if they
+        have been read before."""
+        cache = self.blob_cache
+        if cache is not None:
+            data = cache.get(name)
+            if data is not None:
+                return data
+        data = self.read_blob(name)
+        if cache is not None:
+            cache.put(name, data)
+        return data
+
+    def get_blobs(self, names):
+        """Returns the contents of the blobs 'names', as get_blob would.
+        Those that have to be read through git are asked for in one go."""
+        cache = self.blob_cache
+        odb = self.get_odb()
+        datas = [None] * len(names)
+        wanted = []
+        for i, name in enumerate(names):
+            if cache is not None:
+                datas[i] = cache.get(name)
+            if datas[i] is None and odb is not None:
+                try:
+                    kind, data = odb.read(name)
+                    if kind == 'blob':
+                        datas[i] = decode(data)
+                except gitodb.errors:
+                    pass
+            if datas[i] is None:
+                wanted.append(i)
+            elif cache is not None:
+                cache.put(name, datas[i])
+
+        if wanted and self.use_batch:
+            try:
+                if self.reader is None:
+                    self.reader = gitbatch(self.repository)
+                answers = self.reader.get_many([names[i] for i in wanted])
+                for i, answer in zip(wanted, answers):
+                    if answer is not None and answer[0] == 'blob':
+                        datas[i] = decode(answer[1])
+                        if cache is not None:
+                            cache.put(names[i], datas[i])
+            except (IOError, OSError):
+                self.close_reader()
+                self.use_batch = False
+
+        for i in wanted:
+            if datas[i] is None:
+                # a missing object, or no batch to ask
+                datas[i] = self.get_blob(names[i])
+        return datas
+
+    def load_books(self, paths):
+        """Yields the data of the books at 'paths', in order, as __getitem__
+        would return it, as soon as it's read.  The books that aren't loaded
+        yet are read 'prefetch' at a time with get_blobs."""
+        for i in range(0, len(paths), self.prefetch):
+            books = []
+            for path in paths[i:i + self.prefetch]:
+                try:
+                    book = leaf_book(self.get_tree(path))
+                except KeyError:
+                    book = None
+                if book is None:
+                    raise KeyError(path)
+                books.append(book)
+
+            unloaded = [book for book in books if book.data is None]
+            datas = self.get_blobs([book.name for book in unloaded])
+            for book, data in zip(unloaded, datas):
+                if book.data is None:
+                    book.data = book.deserialize_data(data)
+            for book in books:
+                yield book.get_data()
+
+    def read_blob(self, name):
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                kind, data = odb.read(name)
+                if kind == 'blob':
+                    return decode(data)
+            except gitodb.errors:
+                pass
+
+        if self.use_batch:
+            try:
+                if self.reader is None:
+                    self.reader = gitbatch(self.repository)
+                kind, data = self.reader.get(name)
+                if kind == 'blob':
+                    return decode(data)
+            except KeyError:
+                # let the per-call path report the missing object
+                pass
+            except (IOError, OSError):
+                # the batch child died; don't try to use it again
+                self.close_reader()
+                self.use_batch = False
+
         return self.git('cat-file', 'blob', name, keep_newline=True)
 
+    def open_blob(self, name):
+        """Returns a binary file object to read the contents of blob 'name'
+        from, a piece at a time."""
+        if self.blob_cache is not None:
+            data = self.blob_cache.get(name)
+            if data is not None:
+                return io.BytesIO(encode(data))
+
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                kind, size, stream = odb.open_object(name)
+                if kind == 'blob':
+                    return stream
+                stream.close()
+            except gitodb.errors:
+                pass
+
+        kwargs = {}
+        if self.repository:
+            kwargs['repository'] = self.repository
+        return io.BufferedReader(gitpipe('cat-file', 'blob', name, **kwargs))
+
+    def open_read(self, path):
+        """Returns a binary file object to read the book at 'path' from, for
+        values too big to be read whole.  Raises KeyError if there is no such
+        book.  A book whose data is already in memory is read from there."""
+        try:
+            book = leaf_book(self.get_tree(path))
+        except KeyError:
+            book = None
+        if book is None:
+            raise KeyError(path)
+        if book.data is not None or book.name is None:
+            data = book.serialize_data(book.get_data())
+            return io.BytesIO(encode(data))
+        return self.open_blob(book.name)
+
+    def open_write(self, path):
+        """Returns a binary file object whose contents replace the book at
+        'path' once it's closed.  They are written as a blob at once, without
+        ever being held in memory, so serialize_data is not used, and the
+        commit that follows only has to write the trees."""
+        return gitbookwriter(self, path)
+
+    def write_blob_file(self, fd, path):
+        """Writes the file 'fd', whose name is 'path', as a blob and returns
+        its name."""
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                size = fd.seek(0, 2) or fd.tell()
+                fd.seek(0)
+                return odb.write_stream('blob', size,
+                                        iter(lambda: fd.read(64 * 1024), b''))
+            except gitodb.errors:
+                pass
+        return self.git('hash-object', '-w', '--no-filters', path)
+
+    def set_blob(self, path, name):
+        """Makes the book at 'path' refer to the blob 'name', whose contents
+        are already in the repository."""
+        parts = path.split(os.sep)
+        if len(parts) > 1:
+            d = self.get_tree(os.sep.join(parts[:-1]), make_dirs=True)
+        else:
+            d = self.expand_tree(self.objects)
+        self.touch(d)
+        book = d.get(parts[-1])
+        if book is None or leaf_book(book) is None:
+            book = d[parts[-1]] = self.book_type(self, path)
+        else:
+            book = leaf_book(book)
+            self.touch(book)
+        # still dirty, as far as commits and rebases go, but with a name
+        # there is nothing left to write
+        book.name = name
+        book.data = None
+        book.dirty = True
+        self.mark_dirty(path)
+        self.dirty = True
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
     def hash_blob(self, data):
+        odb = self.get_odb()
+        if odb is not None:
+            return odb.hash_object('blob', encode(data))
         return self.git('hash-object', '--stdin', input=data)
 
     def make_blob(self, data):
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                return odb.write_object('blob', encode(data))
+            except gitodb.errors:
+                pass
         return self.git('hash-object', '-w', '--stdin', input=data)
 
+    def map_chunks(self, func, items):
+        """Returns func(items), but with 'max_workers' set, splits 'items'
+        into that many runs and calls 'func' on each of them at once, in a
+        pool of threads.  'func' must return a list of one result per item;
+        the results are joined back together in order."""
+        workers = min(self.max_workers or 1, len(items))
+        if workers < 2 or ThreadPoolExecutor is None:
+            return func(items)
+
+        odb = self.get_odb()
+        if odb is not None and odb.packs_stamp is None:
+            odb.scan_packs()        # rather than in every thread at once
+        size = -(-len(items) // workers)
+        runs = [items[i:i + size] for i in range(0, len(items), size)]
+        pool = ThreadPoolExecutor(len(runs))
+        try:
+            results = []
+            for run in pool.map(func, runs):
+                results.extend(run)
+            return results
+        finally:
+            pool.shutdown()
+
+    def make_blobs(self, datas):
+        """Writes every item of 'datas' as a blob, and returns their names in
+        the same order.  Each thread of map_chunks uses a single
+        'git hash-object --stdin-paths' process if git has to be run."""
+        return self.map_chunks(self.write_blobs, datas)
+
+    def write_blobs(self, datas):
+        if not datas:
+            return []
+
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                return [odb.write_object('blob', encode(data))
+                        for data in datas]
+            except gitodb.errors:
+                pass
+
+        tmpdir = tempfile.mkdtemp(prefix='gitshelve-')
+        try:
+            paths = []
+            for data in datas:
+                path = os.path.join(tmpdir, str(len(paths)))
+                fd = io.open(path, 'wb')
+                try:
+                    fd.write(encode(data))
+                finally:
+                    fd.close()
+                paths.append(path)
+
+            # --no-filters, so that the result matches 'hash-object --stdin'
+            names = self.git('hash-object', '-w', '--no-filters',
+                             '--stdin-paths', input='\n'.join(paths) + '\n')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        names = names.split('\n')
+        if len(names) != len(datas):
+            raise GitError('hash-object', ['-w', '--stdin-paths'], {},
+                           'Expected %d names, got %d' %
+                           (len(datas), len(names)))
+        return names
+
+    def collect_books(self, objects, books, comment_accumulator=None):
+        """Appends every dirty book found below 'objects' to 'books'.  Trees
+        on the way to a dirty book lose their '__root__', since make_tree will
+        have to write them again.  Returns True if anything was found."""
+        if '__lazy__' in objects:
+            return False            # never expanded, so nothing changed
+
+        found = False
+        for path in list(objects.keys()):
+            if path == '__root__':
+                continue
+
+            obj = objects[path]
+            if not isinstance(obj, (dict, gitbook)):
+                raise TypeError("objects['%s'] is not a dict"%path)
+
+            book = leaf_book(obj)
+            if book is not None:
+                if book.dirty:
+                    if comment_accumulator:
+                        comment = book.change_comment()
+                        if comment:
+                            comment_accumulator.write(comment)
+                    books.append(book)
+                    found = True
+            elif '__root__' in obj:
+                continue            # nothing below it has changed
+            elif self.collect_books(obj, books, comment_accumulator):
+                found = True
+
+        if found and '__root__' in objects:
+            del objects['__root__']
+        return found
+
+    def write_books(self, objects, comment_accumulator=None):
+        """Writes all the dirty books below 'objects' in one batch, rather
+        than leaving make_tree to write them one process at a time."""
+        books = []
+        self.collect_books(objects, books, comment_accumulator)
+        # the books written by open_write already have their blobs
+        unwritten = [book for book in books if book.name is None]
+        names = self.map_chunks(self.write_book_data, unwritten)
+        for book, name in zip(unwritten, names):
+            book.name = name
+        for book in books:
+            book.dirty = False
+
+    def write_book_data(self, books):
+        datas = [book.serialize_data(book.data) for book in books]
+        names = self.write_blobs(datas)
+        if self.blob_cache is not None:
+            # as get_blob would return them
+            for name, data in zip(names, datas):
+                self.blob_cache.put(name, decode(encode(data)))
+        return names
+
     def make_tree(self, objects, comment_accumulator=None):
-        buf = StringIO()
+        if '__lazy__' in objects:
+            if '__root__' in objects:
+                # never expanded, so it cannot have changed
+                return objects['__root__']
+            self.expand_tree(objects)
+
+        entries = []
 
         root = None
         if '__root__' in objects:
@@ -320,11 +1816,11 @@ class gitshelve(dict):
                 continue
 
             obj = objects[path]
-            if not isinstance(obj, dict):
+            if not isinstance(obj, (dict, gitbook)):
                 raise TypeError("objects['%s'] is not a dict"%path)
 
-            if len(list(obj.keys())) == 1 and '__book__' in obj:
-                book = obj['__book__']
+            book = leaf_book(obj)
+            if book is not None:
                 if book.dirty:
                     #"""change_comment is alwyas None, so this block does nothing
                     if comment_accumulator:
@@ -333,60 +1829,271 @@ class gitshelve(dict):
                             comment_accumulator.write(comment)
                     #"""
 
-                    book.name = self.make_blob(book.serialize_data(book.data))
+                    if book.name is None:   # unless written by open_write
+                        book.name = self.make_blob(
+                            book.serialize_data(book.data))
                     book.dirty = False
                     root = None
 
-                buf.write("100644 blob %s\t%s\0" % (book.name, path))
+                entries.append(('100644', path, book.name))
 
-            else:
-                tree_root = None
-                if '__root__' in obj:
-                    tree_root = obj['__root__']
+            elif '__root__' in obj:
+                # Nothing below it has changed (see mark_dirty), so there's
+                # no need to even look inside.
+                entries.append(('040000', path, obj['__root__']))
 
+            else:
                 tree_name = self.make_tree(obj, comment_accumulator)
-                if tree_name != tree_root:
-                    root = None
-
-                buf.write("040000 tree %s\t%s\0" % (tree_name, path))
+                entries.append(('040000', path, tree_name))
+                root = None
 
         if root is None:
-            name = self.git('mktree', '-z', input=buf.getvalue())
+            name = self.write_tree(entries)
             objects['__root__'] = name
             return name
         else:
             return root
 
+    def write_tree(self, entries):
+        """Writes a tree from (mode, name, sha) entries and returns its
+        name."""
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                return odb.write_tree(entries)
+            except gitodb.errors:
+                pass
+
+        buf = StringIO()
+        for mode, path, name in entries:
+            if mode == '040000':
+                kind = 'tree'
+            else:
+                kind = 'blob'
+            buf.write("%s %s %s\t%s\0" % (mode, kind, name, path))
+        return self.git('mktree', '-z', input=buf.getvalue())
+
     def make_commit(self, tree_name, comment):
         if not comment:
             comment = ""
-        if self.head and self.keep_history:
-            name = self.git('commit-tree', tree_name, '-p', self.head,
-                            input=comment)
-        else:
-            name = self.git('commit-tree', tree_name, input=comment)
+        name = None
+        odb = self.get_odb()
+        if odb is not None:
+            parents = []
+            if self.head and self.keep_history:
+                parents.append(self.head)
+            try:
+                name = odb.write_commit(tree_name, parents, comment)
+            except gitodb.errors:
+                pass
+
+        if name is None:
+            if self.head and self.keep_history:
+                name = self.git('commit-tree', tree_name, '-p', self.head,
+                                input=comment)
+            else:
+                name = self.git('commit-tree', tree_name, input=comment)
 
         self.update_head(name)
         return name
 
+    # Several processes may write to the same branch at once, and only one of
+    # them can move it from where they all started.  The others don't just
+    # fail: each puts its changes back the way they were before the commit,
+    # waits a while (twice as long, at random, after every attempt), brings
+    # the shelf up to the new head and tries again.  That is only safe when
+    # the branch changed no path that also has a pending change; otherwise
+    # ConflictError is raised and the changes stay pending.  'contention'
+    # counts what happened, for anyone tuning the number of writers.
+
     def commit(self, comment=None):
         if not self.dirty:
             return self.head
 
+        books = []
+        self.collect_books(self.objects, books)
+        self.contention['commits'] += 1
+        attempt = 0
+        while True:
+            try:
+                name = self.commit_pending(comment)
+                break
+            except StaleHeadError:
+                for book in books:
+                    book.dirty = True
+                    self.mark_dirty(book.path)
+                for path in self.deleted:
+                    self.mark_dirty(path)
+                if attempt == self.retry_limit:
+                    raise
+                self.contention['retries'] += 1
+                delay = min(self.retry_delay * 2 ** attempt,
+                            self.retry_delay_max)
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+                self.rebase([book.path for book in books] + self.deleted)
+
+        self.deleted = []
+        self.dirty = False
+        return name
+
+    def rebase(self, paths):
+        """Brings the shelf up to wherever its branch is now, keeping the
+        pending changes to 'paths'.  Raises ConflictError if the branch
+        changed any of them, and leaves the shelf alone."""
+        try:
+            new_head = self.current_head()
+        except (GitError, ValueError):
+            new_head = None
+        if new_head == self.head:
+            return                  # it was only locked
+        if not new_head:
+            raise ConflictError('commit', [self.branch], {},
+                                '%s was deleted' % self.branch)
+        changes = list(self.tree_changes(self.head, new_head))
+
+        pending = set(paths)
+        parents = set()
+        for path in paths:
+            parts = path.split(os.sep)
+            for i in range(1, len(parts)):
+                parents.add(os.sep.join(parts[:i]))
+        for treep, status, name, path in changes:
+            if treep:
+                continue
+            parts = path.split(os.sep)
+            if path in parents or [i for i in range(1, len(parts) + 1)
+                                   if os.sep.join(parts[:i]) in pending]:
+                self.contention['conflicts'] += 1
+                raise ConflictError('commit', [self.branch], {},
+                                    '%s was changed on %s as well' %
+                                    (path, self.branch))
+
+        self.apply_changes(new_head, changes)
+        self.contention['rebases'] += 1
+
+    def commit_pending(self, comment=None):
+        """Commits the pending changes on top of 'head', which is where the
+        branch must still be."""
         accumulator = None
         if comment is None:
             accumulator = StringIO()
 
-        # Walk the objects now, creating and nesting trees until we end up
-        # with a top-level tree.  We then create a commit out of this tree.
-        tree = self.make_tree(self.objects, accumulator)
-        if accumulator:
-            comment = accumulator.getvalue()
-        name = self.make_commit(tree, comment)
-
-        self.dirty = False
+        if self.engine == 'fast-import':
+            name = self.fast_import_commit(comment, accumulator)
+        else:
+            # Write out every changed blob in one go, then walk the objects,
+            # creating and nesting trees until we end up with a top-level
+            # tree.  We then create a commit out of this tree.
+            self.write_books(self.objects, accumulator)
+            tree = self.make_tree(self.objects, accumulator)
+            if accumulator:
+                comment = accumulator.getvalue()
+            name = self.make_commit(tree, comment)
         return name
 
+    def fast_import_path(self, path):
+        if '\n' in path or path.startswith('"'):
+            path = '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"') \
+                                .replace('\n', '\\n')
+        return path
+
+    def fast_import_commit(self, comment=None, comment_accumulator=None):
+        """Creates the next commit with a single 'git fast-import' process,
+        instead of one process per blob and tree.  Only the changed books and
+        the deleted paths are streamed when the commit has a parent; otherwise
+        every book is listed.  fast-import is only used to write objects: the
+        branch itself is still moved by update_head."""
+        books = []
+        self.collect_books(self.objects, books, comment_accumulator)
+        # the books written by open_write already have their blobs
+        written = [book for book in books if book.name is not None]
+        books = [book for book in books if book.name is None]
+        if comment_accumulator:
+            comment = comment_accumulator.getvalue()
+        if not comment:
+            comment = ""
+
+        def data(buf, payload):
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            buf.append(('data %d\n' % len(payload)).encode('utf-8'))
+            buf.append(payload)
+            buf.append(b'\n')
+
+        ref = 'refs/heads/%s' % self.branch
+        buf = []
+        for mark, book in enumerate(books):
+            buf.append(('blob\nmark :%d\n' % (mark + 1)).encode('utf-8'))
+            data(buf, book.serialize_data(book.data))
+
+        commit_mark = len(books) + 1
+        ident = self.git('var', 'GIT_COMMITTER_IDENT')
+        buf.append(('commit %s\nmark :%d\ncommitter %s\n' %
+                    (ref, commit_mark, ident)).encode('utf-8'))
+        data(buf, comment)
+
+        lines = []
+        if self.head and self.keep_history:
+            lines.append('from %s' % self.head)
+            for path in self.deleted:
+                lines.append('D %s' % self.fast_import_path(path))
+        else:
+            # no parent to start from, so every book has to be listed
+            trees = [self.expand_tree(self.objects)]
+            while trees:
+                for path, obj in trees.pop().items():
+                    if path == '__root__':
+                        continue
+                    if '__lazy__' in obj:
+                        lines.append('M 040000 %s %s' % (obj['__root__'],
+                                     self.fast_import_path(obj['__lazy__'])))
+                    elif leaf_book(obj) is not None:
+                        book = leaf_book(obj)
+                        if not book.dirty:
+                            lines.append('M 100644 %s %s' % (book.name,
+                                         self.fast_import_path(book.path)))
+                    else:
+                        trees.append(obj)
+        for mark, book in enumerate(books):
+            lines.append('M 100644 :%d %s' %
+                         (mark + 1, self.fast_import_path(book.path)))
+        for book in written:
+            lines.append('M 100644 %s %s' %
+                         (book.name, self.fast_import_path(book.path)))
+
+        # A branch reset to nothing is one that fast-import leaves alone, so
+        # that update_head can do a proper compare-and-swap -- even if the
+        # ref has moved on meanwhile, which it would refuse to undo.
+        lines.append('')
+        lines.append('reset %s' % ref)
+        lines.append('')
+        lines.append('get-mark :%d' % commit_mark)
+        for mark in range(len(books)):
+            lines.append('get-mark :%d' % (mark + 1))
+        lines.append('done')
+        buf.append(('\n'.join(lines) + '\n').encode('utf-8'))
+
+        names = self.git('fast-import', '--quiet', '--done',
+                         input=b''.join(buf)).split('\n')
+        if len(names) != len(books) + 1:
+            raise GitError('fast-import', ['--quiet', '--done'], {},
+                           'Expected %d marks, got %d' %
+                           (len(books) + 1, len(names)))
+
+        for book, name in zip(books, names[1:]):
+            book.name = name
+            book.dirty = False
+        for book in written:
+            book.dirty = False
+        # fast-import doesn't tell us the tree names, so make_tree will have
+        # to work the top-level one out again if the mktree engine is used.
+        if '__root__' in self.objects:
+            del self.objects['__root__']
+
+        self.update_head(names[0])
+        return names[0]
+
     def sync(self):
         self.commit()
 
@@ -397,11 +2104,15 @@ class gitshelve(dict):
     def close(self):
         if self.dirty:
             self.sync()
+        self.save_snapshot()
+        self.close_reader()
+        self.close_odb()
         del self.objects        # free it up right away
 
     def dump_objects(self, fd, indent=0, objects=None):
         if objects is None:
             objects = self.objects
+        self.expand_tree(objects)
 
         if ('__root__' in objects) and indent == 0:
             data = '%stree %s\n' % (" " * indent, objects['__root__'])
@@ -414,11 +2125,11 @@ class gitshelve(dict):
         for key in keys:
             if key == '__root__':
                 continue
-            if not isinstance(objects[key], dict):
+            if not isinstance(objects[key], (dict, gitbook)):
                 raise TypeError("objects['%s'] is not a dict"%key)
 
-            if ('__book__' in objects[key]):
-                book = objects[key]['__book__']
+            book = leaf_book(objects[key])
+            if book is not None:
                 if book.name:
                     kind = 'blob ' + book.name
                 else:
@@ -437,14 +2148,31 @@ class gitshelve(dict):
             if kind[:4] == 'tree':
                 self.dump_objects(fd, indent + 2, objects[key])
 
+    def transaction(self, message=None):
+        """Returns a context manager that commits all the changes made
+        within it as one commit, with 'message', or undoes them all if it is
+        left by an exception.  Transactions can be nested; only the
+        outermost one commits."""
+        return gittransaction(self, message)
+
+    def touch(self, obj):
+        """Called before a tree dict or a book is changed, so that the
+        current transaction can undo it."""
+        if self.journals:
+            self.journals[-1].touch(obj)
+
     def get_tree(self, path, make_dirs=False):
         parts = path.split(os.sep)
         d = self.objects
         for part in parts:
-            if make_dirs and not (part in d):
-                d[part] = {}
+            self.expand_tree(d)
+            if make_dirs:
+                # about to be written to, and so are the trees above it
+                self.touch(d)
+                if not isinstance(d.get(part), dict):
+                    d[part] = gittree()
             d = d[part]
-        return d
+        return self.expand_tree(d)
 
     def __getitem__(self, path):
         d = None
@@ -453,123 +2181,281 @@ class gitshelve(dict):
         except KeyError:
             raise KeyError(path)
 
-        if d and ('__book__' in d):
-            return d['__book__'].get_data()
-        else:
+        book = leaf_book(d)
+        if book is None:
             raise KeyError(path)
+        return book.get_data()
 
     def __setitem__(self, path, data):
-        d = self.get_tree(path, make_dirs=True)
-        if not ('__book__' in d):
-            d.clear()
-            d['__book__'] = self.book_type(self, path)
-        d['__book__'].set_data(data)
+        parts = path.split(os.sep)
+        if len(parts) > 1:
+            d = self.get_tree(os.sep.join(parts[:-1]), make_dirs=True)
+        else:
+            d = self.expand_tree(self.objects)
+        self.touch(d)
+        book = d.get(parts[-1])
+        if book is None or leaf_book(book) is None:
+            book = d[parts[-1]] = self.book_type(self, path)
+        else:
+            book = leaf_book(book)
+            self.touch(book)
+        book.set_data(data)
         self.dirty = True
 
     def prune_tree(self, objects, paths):
+        """Removes the entry at 'paths' below 'objects', along with any tree
+        that it leaves empty, and drops the '__root__' of every tree on the
+        way.  Returns the number of entries left in 'objects'."""
+        self.expand_tree(objects)
         if len(paths) > 1:
             left = self.prune_tree(objects[paths[0]], paths[1:])
-            # do not delete if there's something left besides __root__ and
-            # paths[0]
-            has_root = '__root__' in objects[paths[0]]
-            if left > 0 or len(objects[paths[0]]) > int(has_root):
-                if '__root__' in objects:
-                    del objects['__root__']
-                for tree in objects:
-                    if '__root__' in objects[tree]:
-                        del objects[tree]['__root__']
-                return 3
-        l = len(objects[paths[0]])
-        del objects[paths[0]]
+            self.touch(objects)
+            if left == 0:
+                del objects[paths[0]]
+        else:
+            self.touch(objects)
+            del objects[paths[0]]
+
+        if '__root__' in objects:
+            del objects['__root__']
         self.dirty = True
-        return l - 1
+        return len(objects)
+
+    def mark_dirty(self, path):
+        """Drops the '__root__' of every tree above 'path', because
+        make_tree will have to write them again.  A tree that still has its
+        '__root__' is known to be unchanged, so commits never look inside
+        it."""
+        d = self.objects
+        for part in path.split(os.sep):
+            if '__lazy__' in d:
+                return              # never listed, so nothing in it changed
+            if '__root__' in d:
+                self.touch(d)
+                del d['__root__']
+            d = d.get(part)
+            if not isinstance(d, dict):
+                return
 
     def __delitem__(self, path):
         try:
             self.prune_tree(self.objects, path.split(os.sep))
         except KeyError:
             raise KeyError(path)
+        self.deleted.append(path)
 
     def __contains__(self, path):
         d = self.get_tree(path)
-        return len(list(d.keys())) == 1 and ('__book__' in d)
-
-    def walker(self, kind, objects, path=''):
-        for item in list(objects.items()):
-            if item[0] == '__root__':
+        return leaf_book(d) is not None
+
+    def walker(self, kind, objects, path='', start=None, stop=None):
+        """Yields the keys, values or items of the books below 'objects',
+        whose path is 'path'.  Given 'start' or 'stop', only the keys from
+        'start' up to but not including 'stop' are yielded, in sorted order,
+        and trees that lie wholly outside that range are never visited, nor
+        listed in lazy mode.  The trees are walked as they are rather than
+        copied, so the shelf must not be changed until the walk is over;
+        keys(), values() and items() return lists for that."""
+        self.expand_tree(objects)
+        if start is None and stop is None:
+            names = objects
+        else:
+            # A tree sorts as its name and a separator, as all of its keys
+            # do, so that keys come out in order however deep they are.
+            names = []
+            for name, obj in objects.items():
+                if name != '__root__' and leaf_book(obj) is None:
+                    name += os.sep
+                names.append(name)
+            names.sort()
+
+        for name in names:
+            if name == '__root__':
                 continue
-            if not isinstance(item[1], dict):
-                raise TypeError("item[1] is not a dict")
+            name = name.rstrip(os.sep)
+            obj = objects[name]
+            if not isinstance(obj, (dict, gitbook)):
+                raise TypeError("objects['%s'] is not a dict"%name)
 
             if path:
-                key = os.sep.join((path, item[0]))
+                key = os.sep.join((path, name))
             else:
-                key = item[0]
-
-            if len(list(item[1].keys())) == 1 and ('__book__' in item[1]):
-                value = item[1]['__book__']
-                if kind == 'keys':
-                    yield key
-                elif kind == 'values':
-                    yield value
-                else:
-                    if kind != 'items':
-                        raise ValueError("kind != keys, values, nor items")
-                    yield (key, value)
-            else:
-                for obj in self.walker(kind, item[1], key):
-                    yield obj
+                key = name
+
+            value = leaf_book(obj)
+            if value is None:
+                low = key + os.sep
+                if stop is not None and low >= stop:
+                    return          # and so is everything after it
+                if start is not None and low < start and \
+                   not start.startswith(low):
+                    continue
+                for item in self.walker(kind, obj, key, start, stop):
+                    yield item
+                continue
 
-        raise StopIteration
+            if stop is not None and key >= stop:
+                return
+            if start is not None and key < start:
+                continue
+            if kind == 'keys':
+                yield key
+            elif kind == 'values':
+                yield value
+            else:
+                if kind != 'items':
+                    raise ValueError("kind != keys, values, nor items")
+                yield (key, value)
+
+    def scan(self, kind, prefix='', start=None, stop=None):
+        """Walks the books below the tree 'prefix', going straight to it
+        rather than through the rest of the shelf.  See walker."""
+        prefix = prefix.rstrip(os.sep)
+        if not prefix:
+            return self.walker(kind, self.objects, '', start, stop)
+        try:
+            objects = self.get_tree(prefix)
+        except KeyError:
+            return iter(())
+        if leaf_book(objects) is not None:
+            # the prefix is a book itself
+            parts = prefix.rsplit(os.sep, 1)
+            objects = gittree({parts[-1]: objects})
+            prefix = os.sep.join(parts[:-1])
+        return self.walker(kind, objects, prefix, start, stop)
 
     def __iter__(self):
         return self.iterkeys()
 
-    def iteritems(self):
-        return self.walker('items', self.objects)
+    def iteritems(self, prefix='', start=None, stop=None):
+        return self.scan('items', prefix, start, stop)
 
-    def items(self):
-        i = []
-        for items in self.iteritems():
-            i.append(items)
-        return i
+    def items(self, prefix='', start=None, stop=None):
+        return list(self.iteritems(prefix, start, stop))
 
-    def iterkeys(self):
-        return self.walker('keys', self.objects)
+    def iterkeys(self, prefix='', start=None, stop=None):
+        return self.scan('keys', prefix, start, stop)
 
-    def keys(self):
-        k = []
-        for key in self.iterkeys():
-            k.append(key)
-        return k
+    def keys(self, prefix='', start=None, stop=None):
+        return list(self.iterkeys(prefix, start, stop))
 
-    def itervalues(self):
-        return self.walker('values', self.objects)
+    def itervalues(self, prefix='', start=None, stop=None):
+        return self.scan('values', prefix, start, stop)
 
-    def values(self):
-        v = []
-        for value in self.itervalues():
-            v.append(value)
-        return v
+    def values(self, prefix='', start=None, stop=None):
+        return list(self.itervalues(prefix, start, stop))
 
     def __getstate__(self):
         self.sync()                   # synchronize before persisting
         odict = self.__dict__.copy()  # copy the dict since we change it
         del odict['dirty']            # remove dirty flag
+        odict.pop('reader', None)     # child processes don't pickle
+        odict.pop('odb', None)        # nor do mmaps
+        odict.pop('journals', None)
         return odict
 
     def __setstate__(self, ndict):
         self.__dict__.update(ndict)  # update attributes
         self.dirty = False
+        self.reader = None
+        self.odb = None
+        self.journals = []
+
+        # If the HEAD reference is out of date, apply whatever changed.
+        self.refresh()
+
+
+# A shelf frozen at a revision -- a commit, a tag, or anything else git can
+# resolve to a commit.  Trees are listed as they are reached, as in lazy mode,
+# and every tree is kept in 'trees' under its path and name, so that views of
+# other revisions given the same dict use the very same objects for the
+# subtrees that didn't change.  The contents of books come from the shared
+# blob cache.  Anything that would change the view raises TypeError.
+
+class gitview(gitshelve):
+    lazy = True
+    trees = None
+
+    def __init__(self, revision, repository=None, book_type=gitbook,
+                 trees=None):
+        gitshelve.__init__(self, revision, repository, False, book_type,
+                           lazy=True)
+        if trees is None:
+            trees = {}
+        self.revision = revision
+        self.trees = trees
+
+    def open(cls, revision, repository=None, book_type=gitbook,
+             trees=None):
+        view = cls(revision, repository, book_type, trees)
+        view.read_repository()
+        return view
 
-        # If the HEAD reference is out of date, throw away all data and
-        # rebuild it.
-        if not self.head or self.head != self.current_head():
-            self.read_repository()
+    open = classmethod(open)
+
+    def read_repository(self):
+        self.init_data()
+        self.head, tree = self.resolve_revision()
+        self.objects = self.lazy_tree(tree, '')
+
+    def resolve_revision(self):
+        """Returns the names of the commit and the tree at 'revision'."""
+        odb = self.get_odb()
+        if odb is not None:
+            try:
+                name = odb.resolve(self.revision)
+                if name:
+                    kind, data = odb.read(name)
+                    while kind == 'tag':
+                        name = odb.field(data, b'object')
+                        kind, data = odb.read(name)
+                    if kind == 'commit':
+                        return name, odb.field(data, b'tree')
+            except gitodb.errors:
+                pass
+
+        names = self.git('rev-parse', '%s^{commit}' % self.revision,
+                         '%s^{tree}' % self.revision).split('\n')
+        if len(names) != 2 or len(names[0]) != 40 or len(names[1]) != 40:
+            raise ValueError("rev-parse went insane: %s" % names)
+        return names[0], names[1]
+
+    def current_head(self):
+        return self.resolve_revision()[0]
+
+    def lazy_tree(self, name, path):
+        tree = self.trees.get((path, name))
+        if tree is None:
+            tree = self.trees[(path, name)] = gitshelve.lazy_tree(self, name,
+                                                                 path)
+        return tree
+
+    def open_at(self, revision):
+        return gitview.open(revision, self.repository, self.book_type,
+                            self.trees)
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError("a gitview of %s is read-only" % self.revision)
+
+    __setitem__ = __delitem__ = read_only
+    commit = rebase = refresh = transaction = read_only
+    open_write = set_blob = mark_dirty = read_only
+
+    def sync(self):
+        pass
+
+    def close(self):
+        # the trees may be shared with other views, so they are left alone
+        self.close_reader()
+        self.close_odb()
 
 
 def open(branch='master', repository=None, keep_history=True,
-         book_type=gitbook):
-    return gitshelve.open(branch, repository, keep_history, book_type)
+         book_type=gitbook, engine='mktree', lazy=False, max_workers=None):
+    return gitshelve.open(branch, repository, keep_history, book_type, engine,
+                          lazy, max_workers)
+
+def open_at(revision, repository=None, book_type=gitbook, trees=None):
+    return gitview.open(revision, repository, book_type, trees)
 
 # gitshelve.py ends here
@@ -11,6 +11,7 @@
 """
 import argparse
 import GitTkt
+import gitshelve
 from GitTktShell import GitTktShell
 import logging
 import os
@@ -71,6 +72,11 @@ def ParseArgs(args):
                             nargs = "?",
                             help="level of verbose output to log"
                             "(DEBUG, INFO, WARNING, ERROR, CRITICAL, FATAL)")
+    outputParser.add_argument("--timings",
+                            action = 'store_true',
+                            help="print how long each git command took, in"
+                              " all, and how often blobs were cached, to"
+                              " stderr when done")
 
     globalParser = parser.add_argument_group("global options")
     globalParser.add_argument('--branch',help='branch name to store tickets'
@@ -134,6 +140,19 @@ def Main(args):
     format='%(asctime)s:[%(filename)s(%(lineno)d)]:[%(levelname)s]: %(message)s'
     logging.basicConfig(level=level,format=format)
     logging.debug(parseResults)
+    stats = None
+    if parseResults.timings:
+        stats = gitshelve.gitstats().install()
+    try:
+        return Run(parseResults,fields)
+    finally:
+        if stats is not None:
+            stats.uninstall()
+            sys.stderr.write(stats.summary())
+            sys.stderr.write(gitshelve.blobs.summary())
+
+def Run(parseResults,fields):
+    """ Runs the shell or the command that was parsed """
     #make sure the return value of GitTkt is an int (return code)
     if parseResults.subcommand is None:
         shell = GitTktShell(parseResults.branch)
@@ -145,6 +164,7 @@ def Main(args):
         #to pop them off.
         parseResults.pop('verbose')
         parseResults.pop('show_traceback')
+        parseResults.pop('timings')
         gitTkt = GitTkt.GitTkt(branch = parseResults.pop('branch'),
                         nonInteractive = parseResults.pop('non_interactive'),
                         save = parseResults.pop('save'),
@@ -84,6 +84,26 @@ class t_GitTkt(unittest.TestCase):
         self.stream.truncate(0)
         self.gittkt.Folders()
         self.assertRegexpMatches(self.stream.getvalue(),"active\narchived\n")
+
+    def testOutsideRepository(self):
+        outside = tempfile.mkdtemp()
+        os.chdir(outside)
+        try:
+            gittkt = GitTkt.GitTkt(branch = self.branch,
+                                   nonInteractive = True,
+                                   save = False,
+                                   loadFolders = ['active'],
+                                   outstream = self.stream)
+            #the ticket database is only opened when a list needs it
+            def printHelpFunc():
+                pass
+            self.assertEqual(1,gittkt.Run('folders',printHelpFunc))
+            self.assertEqual(1,gittkt.Run('folders',printHelpFunc))
+            self.assertIn("No folders found.",self.stream.getvalue())
+        finally:
+            os.chdir(self.gitDir)
+            shutil.rmtree(outside)
+        self.assertFalse(os.path.exists(os.path.join('.git','gittkt')))
         
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import os
+import sys
+import unittest
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import GitTktCodec
+
+class t_GitTktCodec(unittest.TestCase):
+    def setUp(self):
+        self.data = OrderedDict([('name','a ticket'),
+                                 ('description','two\nlines, "quoted"'),
+                                 ('status',None),
+                                 ('creation_date','2026-10-18 12:00:00')])
+
+    def testJson(self):
+        text = GitTktCodec.Encode(self.data)
+        self.assertEqual('gittkt:json\n{\n"name":"a ticket",\n'
+                         '"description":"two\\nlines, \\"quoted\\"",\n'
+                         '"status":null,\n'
+                         '"creation_date":"2026-10-18 12:00:00"\n}',text)
+        data = GitTktCodec.Decode(text)
+        self.assertEqual(self.data,data)
+        self.assertEqual(list(self.data.keys()),list(data.keys()))
+        with self.assertRaises(ValueError):
+            GitTktCodec.Decode('gittkt:json\n["not","a","dict"]')
+        with self.assertRaises(ValueError):
+            GitTktCodec.Decode('gittkt:json\n{"name":')
+
+    def testMarshal(self):
+        text = GitTktCodec.Encode(self.data,'marshal')
+        self.assertTrue(text.startswith('gittkt:marshal\n'))
+        #not read unless asked for, since a blob could claim to be one
+        with self.assertRaises(ValueError):
+            GitTktCodec.Decode(text)
+        self.assertEqual(self.data,GitTktCodec.Decode(text,('json',
+                                                            'marshal')))
+
+    def testLegacy(self):
+        text = str(dict(self.data))
+        self.assertEqual(dict(self.data),dict(GitTktCodec.Decode(text)))
+        for text in ("__import__('os').getcwd()","['a list']",
+                     "{'name' : open('x')}"):
+            with self.assertRaises(ValueError):
+                GitTktCodec.Decode(text)
+
+    def testRegistry(self):
+        class UpperCodec(GitTktCodec.TicketCodec):
+            name = 'upper'
+            def Encode(self,data):
+                return GitTktCodec.GetCodec('json').Encode(data).upper()
+            def Decode(self,text):
+                return GitTktCodec.GetCodec('json').Decode(text.lower())
+        with self.assertRaises(KeyError):
+            GitTktCodec.Encode(self.data,'upper')
+        GitTktCodec.RegisterCodec(UpperCodec())
+        try:
+            text = GitTktCodec.Encode({'name' : 'x'},'upper')
+            self.assertEqual('gittkt:upper\n{\n"NAME":"X"\n}',text)
+            self.assertEqual({'name' : 'x'},GitTktCodec.Decode(text,
+                                                               ['upper']))
+        finally:
+            del GitTktCodec.codecs['upper']
+        with self.assertRaises(ValueError):
+            GitTktCodec.Decode(text,['upper'])
+        with self.assertRaises(ValueError):
+            GitTktCodec.RegisterCodec(GitTktCodec.TicketCodec())
+
+if __name__ == '__main__':
+    unittest.main()
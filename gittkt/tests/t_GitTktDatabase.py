@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import GitTkt
+import GitTktDatabase
+import gitshelve
+
+@unittest.skipIf(GitTktDatabase.sqlite3 is None, "sqlite3 is not available")
+class t_GitTktDatabase(unittest.TestCase):
+    def setUp(self):
+        """Create a new git repository and cd to it"""
+        self.gitDir = tempfile.mkdtemp()
+        self.lastCWD = os.getcwd()
+        os.chdir(self.gitDir)
+        gitshelve.git('init')
+        self.fields = GitTkt.LoadFields()
+
+    def tearDown(self):
+        """Delete the git repository"""
+        os.chdir(self.lastCWD)
+        shutil.rmtree(self.gitDir)
+
+    def Ticket(self,num,name,author = 'someone'):
+        return {'num' : num,'uuid' : 'uuid-%d'%num,'name' : name,
+                'author' : author,'creation_date' : '2026-10-18'}
+
+    def testOpen(self):
+        os.mkdir('sub')
+        os.chdir('sub')
+        database = GitTktDatabase.Open('git-tkt',self.fields)
+        #nothing is looked for until it's used
+        self.assertEqual(None,database.path)
+        self.assertTrue(database.Connect())
+        self.assertEqual(os.path.realpath(os.path.join(self.gitDir,'.git',
+                                                       'gittkt',
+                                                       'git-tkt.sqlite')),
+                         os.path.realpath(database.path))
+        self.assertTrue(os.path.isfile(database.path))
+        self.assertEqual(['num','uuid','creation_date','name','description',
+                          'author'],database.columns)
+        database.Close()
+        database.Close()
+        #and it opens again after being closed
+        self.assertEqual(None,database.GetHead('active'))
+        database.Close()
+
+        #outside of a repository there is none to open
+        outside = tempfile.mkdtemp()
+        os.chdir(outside)
+        try:
+            database = GitTktDatabase.Open('git-tkt',self.fields)
+            self.assertFalse(database.Connect())
+        finally:
+            os.chdir(self.gitDir)
+            shutil.rmtree(outside)
+
+    def testUpdate(self):
+        database = GitTktDatabase.Open('git-tkt',self.fields)
+        self.assertEqual(None,database.GetHead('active'))
+        database.Update('active','head1',[self.Ticket(1,'one'),
+                                          self.Ticket(2,'two')],
+                        rebuild = True)
+        self.assertEqual('head1',database.GetHead('active'))
+        self.assertEqual(None,database.GetHead('other'))
+        self.assertEqual({1 : 'uuid-1',2 : 'uuid-2'},database.GetIds('active'))
+        rows = list(database.Select('active'))
+        self.assertEqual(['one','two'],[row['name'] for row in rows])
+        self.assertEqual(None,rows[0]['description'])
+        self.assertEqual(list(database.columns),list(rows[0].keys()))
+
+        database.Update('active','head2',[self.Ticket(3,'three'),
+                                          self.Ticket(2,'TWO')],[1])
+        self.assertEqual([(2,'TWO'),(3,'three')],[(row['num'],row['name'])
+                         for row in database.Select('active')])
+        #the same uuid under another number replaces its row
+        ticket = self.Ticket(4,'four')
+        ticket['uuid'] = 'uuid-3'
+        database.Update('active','head3',[ticket])
+        self.assertEqual({2 : 'uuid-2',4 : 'uuid-3'},database.GetIds('active'))
+        database.Close()
+
+        #the tables outlive the connection, but not a change of fields
+        database = GitTktDatabase.Open('git-tkt',self.fields)
+        self.assertEqual('head3',database.GetHead('active'))
+        database.Close()
+        del self.fields['description']
+        database = GitTktDatabase.Open('git-tkt',self.fields)
+        self.assertEqual(None,database.GetHead('active'))
+        database.Update('active','head4',[self.Ticket(1,'one')],
+                        rebuild = True)
+        self.assertEqual([1],[row['num'] for row in database.Select('active')])
+        database.Close()
+
+    def testWhere(self):
+        database = GitTktDatabase.Open('git-tkt',self.fields)
+        database.Update('active','head',[self.Ticket(1,'one','a'),
+                                         self.Ticket(2,'two','b'),
+                                         self.Ticket(3,'three','a'),
+                                         self.Ticket(4,"it's four",None)],
+                        rebuild = True)
+        def Names(**kwargs):
+            where,params = GitTktDatabase.Where(database.columns,**kwargs)
+            return [row['name'] for row in database.Select('active',where,
+                                                           params)]
+        self.assertEqual(['one','two','three',"it's four"],Names())
+        self.assertEqual(['one','three'],Names(equals = {'author' : 'a'}))
+        self.assertEqual(['two',"it's four"],
+                         Names(notEquals = {'author' : 'a'}))
+        self.assertEqual(['two','three'],Names(like = {'name' : 't%'}))
+        self.assertEqual(['one'],Names(like = {'name' : '%e'},
+                                       notLike = {'name' : 't%'}))
+        self.assertEqual(["it's four"],Names(equals = {'name' : "it's four"}))
+        self.assertEqual(['three'],Names(query = "num > 2 OR name = 'one'",
+                                         equals = {'author' : 'a'},
+                                         notEquals = {'name' : 'one'}))
+        with self.assertRaises(ValueError):
+            Names(equals = {'author" = "a" OR "1' : 'a'})
+        database.Close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,8 @@ if parentDir not in sys.path:
     sys.path.insert(0,parentDir)
 import GitTktFolder
 import GitTkt
+import GitTktCodec
+import GitTktDatabase
 import gitshelve
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -44,6 +46,22 @@ class t_GitTktFolder(unittest.TestCase):
         self.stream.seek(0)
         self.stream.truncate(0)
 
+    def testOperations(self):
+        stats = gitshelve.gitstats().install()
+        useOdb = gitshelve.gitshelve.use_odb
+        gitshelve.gitshelve.use_odb = False
+        try:
+            ticketId = self.gitTktFolder.Add({'field1' : 'data1'})
+            self.gitTktFolder.Show([ticketId])
+        finally:
+            gitshelve.gitshelve.use_odb = useOdb
+            stats.uninstall()
+        #the git commands are reported as part of the folder operations
+        self.assertIn('active.Add',stats.operations)
+        self.assertIn('active.Show',stats.operations)
+        self.assertNotIn(None,stats.operations)
+        self.assertEqual('Add',self.gitTktFolder.Add.__name__)
+
     def testAdd(self):
         ticketDataOld = {
             'field1' : 'data1',
@@ -54,7 +72,7 @@ class t_GitTktFolder(unittest.TestCase):
         self.ClearStream()
         #assert that the ticket was added to the shelf
         shelf = gitshelve.open(branch = self.branch)
-        data = eval(shelf['active/%s'%ticketId])
+        data = GitTktCodec.Decode(shelf['active/%s'%ticketId])
         newData = {}
         for key,value in data.items():
             if key not in GitTktFolder.GITTKT_RESERVED_FIELD_NAMES:
@@ -65,6 +83,8 @@ class t_GitTktFolder(unittest.TestCase):
         data = shelf['active/%s'%GitTktFolder.GITTKT_NUM_MAP_FILE]
         ticketNumFile = "1\t%s\n"%ticketId
         self.assertEqual(str(data),ticketNumFile)
+        #the ticket and the number map are written in a single commit
+        self.assertEqual('1',gitshelve.git('rev-list','--count',self.branch))
 
         #verify we strip out uuid and num from the ticket data
         ticketDataNew = {
@@ -78,7 +98,7 @@ class t_GitTktFolder(unittest.TestCase):
         self.ClearStream()
         #assert that the ticket was added to the shelf
         shelf = gitshelve.open(branch = self.branch)
-        data = eval(shelf['active/%s'%ticketId])
+        data = GitTktCodec.Decode(shelf['active/%s'%ticketId])
         newData = {}
         for key,value in data.items():
             if key not in GitTktFolder.GITTKT_RESERVED_FIELD_NAMES:
@@ -89,6 +109,225 @@ class t_GitTktFolder(unittest.TestCase):
         ticketNumFile += "2\t%s\n"%ticketId
         self.assertEqual(str(data),ticketNumFile)
 
+    def testTicketIds(self):
+        ticketIds = [self.gitTktFolder.Add({'name' : 'ticket %d'%num})
+                     for num in range(1,12)]
+        self.ClearStream()
+        #'1' is not found inside '11'
+        shown = self.gitTktFolder.Show(['1','11',ticketIds[4],
+                                        ticketIds[5][:32]])
+        self.assertEqual('ticket 1',shown['1']['name'])
+        self.assertEqual('ticket 11',shown['11']['name'])
+        self.assertEqual(5,shown[ticketIds[4]]['num'])
+        self.assertEqual(ticketIds[5],shown[ticketIds[5][:32]]['uuid'])
+
+        #another folder reads the index back from the shelf
+        folder = GitTktFolder.GitTktFolder(name = 'active',
+            branch = self.branch,
+            fields = GitTkt.LoadFields(),
+            outstream = self.stream)
+        ticketId = folder.Add({'name' : 'ticket 12'})
+        shelf = gitshelve.open(branch = self.branch)
+        numMap = shelf['active/%s'%GitTktFolder.GITTKT_NUM_MAP_FILE]
+        self.assertEqual(''.join('%d\t%s\n'%(num + 1,uuid)
+                                 for num,uuid in enumerate(ticketIds +
+                                                           [ticketId])),
+                         numMap)
+        self.assertEqual(12,folder.nextNum)
+        self.assertEqual(ticketId,folder.numToId[12])
+        self.assertEqual(12,folder.idToNum[ticketId])
+
+    def testSharedShelf(self):
+        for num in range(5):
+            self.gitTktFolder.Add({'name' : 'ticket %d'%num,
+                                  'author' : 'author'})
+        calls = []
+        gitshelve.hooks.append(calls.append)
+        useOdb = gitshelve.gitshelve.use_odb
+        gitshelve.gitshelve.use_odb = False
+        try:
+            self.gitTktFolder.List()
+        finally:
+            gitshelve.gitshelve.use_odb = useOdb
+            gitshelve.hooks.remove(calls.append)
+        #the shelf is only checked against the branch, not read again
+        self.assertEqual(['rev-parse'],[call.cmd for call in calls
+                                        if call.cmd != 'cat-file'])
+
+        #folders sharing a shelf see each other's tickets
+        shelf = gitshelve.gitshelve(self.branch)
+        folders = [GitTktFolder.GitTktFolder(name = name,
+            branch = self.branch,
+            fields = GitTkt.LoadFields(),
+            outstream = self.stream,
+            shelf = shelf) for name in ('active','other')]
+        ticketId = folders[1].Add({'name' : 'ticket 5'})
+        self.assertEqual('ticket 5',GitTktCodec.Decode(
+                                    shelf['active/%s'%ticketId])['name'])
+        self.assertIn('other/index.txt',shelf)
+        folders[0].Add({'name' : 'ticket 6'})
+        self.ClearStream()
+        #and a commit made elsewhere is picked up
+        self.gitTktFolder.Add({'name' : 'ticket 7'})
+        self.assertEqual(7,len(folders[0].Show(['1','2','3','4','5','6',
+                                                '7'])))
+        for folder in folders:
+            folder.Close()
+
+    def testGetTickets(self):
+        for num in range(12):
+            self.gitTktFolder.Add({'name' : 'ticket %d'%num,
+                                  'author' : 'author'})
+        self.ClearStream()
+        self.gitTktFolder.workers = 3
+        self.gitTktFolder.shelf.prefetch = 5
+        ticketIds = ['%d'%num for num in (12,3,7,1,2,4,5,6,8,9,10,11)]
+        tickets = list(self.gitTktFolder.GetTickets(ticketIds))
+        self.assertEqual(ticketIds,[ticketId for ticketId,data in tickets])
+        self.assertEqual(['ticket %d'%(int(ticketId)-1)
+                          for ticketId in ticketIds],
+                         [data['name'] for ticketId,data in tickets])
+        self.assertEqual([int(ticketId) for ticketId in ticketIds],
+                         [data['num'] for ticketId,data in tickets])
+        uuid = tickets[0][1]['uuid']
+        self.assertEqual([(uuid[:30],12)],[(ticketId,data['num'])
+            for ticketId,data in self.gitTktFolder.GetTickets([uuid[:30]])])
+        with self.assertRaises(GitTkt.GitTktError):
+            list(self.gitTktFolder.GetTickets(['1','13']))
+        with self.assertRaises(GitTktFolder.GitTktError):
+            self.gitTktFolder.Edit(['13'],interactive = False)
+
+        #without a pool they are decoded one at a time
+        self.gitTktFolder.workers = 1
+        ticketDatas = self.gitTktFolder.Show(ticketIds)
+        self.assertEqual(sorted(ticketIds),sorted(ticketDatas.keys()))
+        output = self.stream.getvalue()
+        self.assertTrue(output.index('ticket 11') < output.index('ticket 2') <
+                        output.index('ticket 10'))
+        self.ClearStream()
+        self.gitTktFolder.List()
+        rows = self.stream.getvalue().split('\n')[1:-1]
+        self.assertEqual(['%-3d| ticket %d'%(num,num-1) for num in range(1,13)],
+                         [row[:14].rstrip() for row in rows])
+
+    def testCodecs(self):
+        ticketId = self.gitTktFolder.Add({'name' : 'json ticket',
+                                          'author' : 'author'})
+        self.gitTktFolder.codec = 'marshal'
+        self.gitTktFolder.Add({'name' : 'marshal ticket','author' : 'author'})
+        #a ticket written before there were codecs
+        shelf = self.gitTktFolder.shelf
+        text = shelf['active/%s'%ticketId]
+        self.assertTrue(text.startswith('gittkt:json\n'))
+        shelf['active/%s'%ticketId] = str({'name' : 'old ticket',
+                                           'author' : 'author'})
+        shelf.commit('old ticket')
+        self.ClearStream()
+        self.gitTktFolder.List()
+        output = self.stream.getvalue()
+        self.assertIn('old ticket',output)
+        self.assertIn('marshal ticket',output)
+        #a folder that doesn't write marshal only reads it if told to
+        self.gitTktFolder.codec = 'json'
+        with self.assertRaises(ValueError):
+            self.gitTktFolder.Show(['2'])
+        self.gitTktFolder.codecs = ('json','marshal')
+        self.assertEqual('marshal ticket',
+                         self.gitTktFolder.Show(['2'])['2']['name'])
+
+        #nothing in a ticket is run when it's read
+        shelf['active/%s'%ticketId] = "__import__('os').remove('x')"
+        shelf.commit('bad ticket')
+        with self.assertRaises(ValueError):
+            self.gitTktFolder.Show(['1'])
+
+    @unittest.skipIf(GitTktDatabase.sqlite3 is None,
+                     "sqlite3 is not available")
+    def testDatabase(self):
+        for num in range(6):
+            self.gitTktFolder.Add({'name' : 'ticket %d'%num,
+                                  'author' : 'author %d'%(num%2)})
+        with self.assertRaises(GitTkt.GitTktError):
+            self.gitTktFolder.List(equals = {'author' : 'author 0'})
+        fields = GitTkt.LoadFields()
+        database = GitTktDatabase.Open(self.branch,fields)
+        folder = GitTktFolder.GitTktFolder(name = 'active',
+            branch = self.branch,
+            fields = fields,
+            outstream = self.stream,
+            database = database)
+        folder.shelf.use_odb = False
+        folder.shelf.blob_cache = None
+        def List(**kwargs):
+            self.ClearStream()
+            calls = []
+            gitshelve.hooks.append(calls.append)
+            try:
+                returnData = folder.List(**kwargs)
+            finally:
+                gitshelve.hooks.remove(calls.append)
+            return returnData['Ticket Name'],calls
+        names,calls = List()
+        self.assertEqual(['ticket %d'%num for num in range(6)],names)
+        self.assertEqual(gitshelve.git('rev-parse',self.branch),
+                         database.GetHead('active'))
+        self.assertIn('5  | ticket 4',self.stream.getvalue())
+
+        #up to date, so no ticket is read
+        names,calls = List(equals = {'author' : 'author 1'},
+                           notLike = {'name' : '%5'})
+        self.assertEqual(['ticket 1','ticket 3'],names)
+        self.assertEqual(['rev-parse'],[call.cmd for call in calls])
+        names,calls = List(query = 'num > 4')
+        self.assertEqual(['ticket 4','ticket 5'],names)
+        self.assertEqual(['#  |           Ticket Name           |   Author  |',
+                          '5  | ticket 4                        | author 0  |',
+                          '6  | ticket 5                        | author 1  |',
+                          ''],self.stream.getvalue().split('\n'))
+
+        #only what changed since is read again
+        firstHead = database.GetHead('active')
+        ticketId = self.gitTktFolder.Add({'name' : 'ticket 6',
+                                          'author' : 'author 0'})
+        shelf = self.gitTktFolder.shelf
+        shelf['active/%s'%folder.numToId[2]] = GitTktCodec.Encode(
+                          {'name' : 'changed','author' : 'author 1'})
+        shelf.commit('changed')
+        names,calls = List(equals = {'author' : 'author 1'})
+        self.assertEqual(['changed','ticket 3','ticket 5'],names)
+        #the index, and the two tickets
+        self.assertEqual(3,len([call for call in calls
+                                if call.args[:1] == ('--batch',)]))
+
+        #a change that only a merge commit makes is seen too
+        scratch = gitshelve.gitshelve.open(self.branch)
+        scratch['active/%s'%folder.numToId[4]] = GitTktCodec.Encode(
+                          {'name' : 'merged','author' : 'author 1'})
+        tree = scratch.make_tree(scratch.objects)
+        scratch.close_reader()
+        scratch.close_odb()
+        head = gitshelve.git('rev-parse',self.branch)
+        merge = gitshelve.git('commit-tree',tree,'-p',head,'-p',head + '^',
+                              input = 'merge')
+        gitshelve.git('update-ref','refs/heads/%s'%self.branch,merge,head)
+        names,calls = List(equals = {'author' : 'author 1'})
+        self.assertEqual(['changed','merged','ticket 5'],names)
+
+        #and a table that is lost or out of date is built again
+        database.Close()
+        os.remove(database.path)
+        database = folder.database = GitTktDatabase.Open(self.branch,fields)
+        names,calls = List(like = {'name' : 'ticket%'})
+        self.assertEqual(['ticket %d'%num for num in (0,2,4,5,6)],names)
+        gitshelve.git('update-ref','refs/heads/%s'%self.branch,firstHead)
+        names,calls = List()
+        self.assertEqual(['ticket %d'%num for num in range(6)],names)
+        self.assertEqual(firstHead,database.GetHead('active'))
+        with self.assertRaises(ValueError):
+            List(equals = {'missing' : 'x'})
+        database.Close()
+        folder.Close()
+
     def testList(self):
         ticketDataOld = {
             'name' : 'name_data',
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import gitshelve
+try:
+    import asyncio
+    import asyncgitshelve
+except (ImportError, SyntaxError):
+    asyncgitshelve = None       # Python 2
+
+@unittest.skipIf(asyncgitshelve is None, "asyncgitshelve needs Python 3.6")
+class t_asyncgitshelve(unittest.TestCase):
+    def setUp(self):
+        """Create a new git repository with a shelf of tickets, and cd to
+           it"""
+        self.gitDir = tempfile.mkdtemp()
+        self.lastCWD = os.getcwd()
+        os.chdir(self.gitDir)
+        gitshelve.git('init')
+        shelf = gitshelve.gitshelve('tickets')
+        for num in range(200):
+            shelf['active/%d'%num] = 'ticket %d'%num
+        shelf['archived/old'] = 'old ticket'
+        shelf.commit('tickets')
+        shelf.close()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        """Delete the git repository"""
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        os.chdir(self.lastCWD)
+        shutil.rmtree(self.gitDir)
+
+    def Run(self,coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def Collect(self,iterator):
+        items = []
+        while True:
+            try:
+                items.append(self.Run(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def testGit(self):
+        head = self.Run(asyncgitshelve.git('rev-parse','tickets'))
+        self.assertEqual(gitshelve.git('rev-parse','tickets'),head)
+        with self.assertRaises(gitshelve.GitError):
+            self.Run(asyncgitshelve.git('rev-parse','--verify','missing'))
+
+    def testBatch(self):
+        batch = asyncgitshelve.asyncbatch()
+        names = gitshelve.git('rev-parse','tickets','tickets^{tree}')
+        names = names.split('\n') + ['0' * 40]
+        answers = self.Run(asyncio.gather(*[batch.get(name)
+                                            for name in names],
+                                          return_exceptions=True))
+        self.assertEqual('commit',answers[0][0])
+        self.assertEqual(gitshelve.git('cat-file','commit',names[0],
+                                       keep_newline=True).encode('utf-8'),
+                         answers[0][1])
+        self.assertEqual('tree',answers[1][0])
+        self.assertTrue(isinstance(answers[2],KeyError))
+        self.Run(batch.close())
+        self.assertFalse(batch.alive())
+
+    def testConcurrentReads(self):
+        shelf = self.Run(asyncgitshelve.open('tickets'))
+        shelf.blob_cache = None
+        keys = ['active/%d'%num for num in range(200)]
+        datas = self.Run(asyncio.gather(*[shelf.aget(key) for key in keys]))
+        self.assertEqual(['ticket %d'%num for num in range(200)],datas)
+        #all of them went through one cat-file process
+        self.assertTrue(shelf.batch.alive())
+        with self.assertRaises(KeyError):
+            self.Run(shelf.aget('active/missing'))
+        with self.assertRaises(KeyError):
+            self.Run(shelf.aget('active'))
+        self.Run(shelf.aclose())
+
+    def testIterate(self):
+        shelf = self.Run(asyncgitshelve.open('tickets'))
+        shelf.prefetch = 16
+        items = self.Collect(shelf.aitems('active',stop='active/2'))
+        self.assertEqual([('active/%d'%num,'ticket %d'%num)
+                          for num in sorted(range(200),key=str)
+                          if str(num) < '2'],items)
+        keys = self.Collect(shelf.__aiter__())
+        self.assertEqual(201,len(keys))
+        self.assertEqual(['archived/old'],self.Collect(shelf.akeys('archived')))
+        self.Run(shelf.aclose())
+
+    def testCommit(self):
+        shelf = self.Run(asyncgitshelve.open('tickets'))
+        head = shelf.head
+        self.Run(shelf.aset('active/1','changed'))
+        shelf['new/ticket'] = 'new'
+        del shelf['archived/old']
+        name = self.Run(shelf.acommit('async'))
+        self.assertEqual(gitshelve.git('rev-parse','tickets'),name)
+        self.assertEqual(head,gitshelve.git('rev-parse','tickets^'))
+        self.assertEqual('async',gitshelve.git('log','-1','--format=%s',
+                                               'tickets'))
+        #nothing to do the second time
+        self.assertEqual(name,self.Run(shelf.acommit('again')))
+        self.Run(shelf.aclose())
+        gitshelve.git('fsck','--strict')
+
+        shelf = gitshelve.gitshelve.open('tickets')
+        self.assertEqual('changed',shelf['active/1'])
+        self.assertEqual('new',shelf['new/ticket'])
+        self.assertEqual('ticket 2',shelf['active/2'])
+        self.assertFalse('archived' in shelf.objects)
+        shelf.close()
+
+        #the branch moved underneath it, so the update is refused
+        shelf = self.Run(asyncgitshelve.open('tickets'))
+        other = gitshelve.gitshelve.open('tickets')
+        other['active/3'] = 'elsewhere'
+        other.close()
+        shelf['active/3'] = 'here'
+        with self.assertRaises(gitshelve.GitError):
+            self.Run(shelf.acommit('late'))
+        self.assertEqual('elsewhere',gitshelve.gitshelve.open('tickets')[
+                                                             'active/3'])
+
+    def testChangedWhileCommitting(self):
+        shelf = self.Run(asyncgitshelve.open('tickets'))
+        async def Change():
+            shelf['active/1'] = 'v1'
+            shelf['active/2'] = 'v1'
+            commit = asyncio.ensure_future(shelf.acommit('first'))
+            #let it collect the books and start writing them
+            await asyncio.sleep(0)
+            shelf['active/1'] = 'v2'
+            shelf['new/ticket'] = 'new'
+            del shelf['archived/old']
+            return await commit
+        name = self.Run(Change())
+        self.assertEqual(name,gitshelve.git('rev-parse','tickets'))
+        def Show(path):
+            return gitshelve.git('cat-file','blob','tickets:%s'%path,
+                                 keep_newline=True)
+        self.assertEqual('v1',Show('active/1'))
+        self.assertEqual('v1',Show('active/2'))
+        self.assertEqual('old ticket',Show('archived/old'))
+        self.assertEqual('v2',shelf['active/1'])
+        #what changed in the meantime goes in the next commit
+        self.assertTrue(shelf.dirty)
+        self.assertNotEqual(name,self.Run(shelf.acommit('second')))
+        self.assertEqual('v2',Show('active/1'))
+        self.assertEqual('v1',Show('active/2'))
+        self.assertEqual('new',Show('new/ticket'))
+        with self.assertRaises(gitshelve.GitError):
+            Show('archived/old')
+        self.assertFalse(shelf.dirty)
+        self.Run(shelf.aclose())
+        gitshelve.git('fsck','--strict')
+
+    def testNewBranch(self):
+        shelf = self.Run(asyncgitshelve.open('fresh'))
+        self.assertEqual(None,shelf.head)
+        shelf['a/b'] = 'data'
+        self.Run(shelf.aclose())
+        self.assertEqual('data',gitshelve.git('cat-file','blob','fresh:a/b',
+                                                keep_newline=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+dirName = os.path.dirname(__file__)
+parentDir = (os.path.abspath(os.path.join(dirName,"..")))
+if parentDir not in sys.path:
+    sys.path.insert(0,parentDir)
+import gitodb
+import gitshelve
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+class t_gitodb(unittest.TestCase):
+    def setUp(self):
+        """Create a new git repository with a few commits of a file that
+           deltas well, and cd to it"""
+        self.gitDir = tempfile.mkdtemp()
+        self.lastCWD = os.getcwd()
+        os.chdir(self.gitDir)
+        gitshelve.git('init')
+        lines = ['line %d %s'%(i,'x'*(i%37)) for i in range(1000)]
+        for commit in range(5):
+            lines[commit*100] = 'changed in commit %d'%commit
+            with open('big','w') as f:
+                f.write('\n'.join(lines))
+            os.makedirs(os.path.join('dir%d'%commit,'sub'))
+            with open(os.path.join('dir%d'%commit,'sub','file'),'w') as f:
+                f.write('file %d'%commit)
+            gitshelve.git('add','-A')
+            gitshelve.git('commit','-m','commit %d'%commit)
+        self.odb = gitodb.open()
+
+    def tearDown(self):
+        """Delete the git repository"""
+        self.odb.close()
+        os.chdir(self.lastCWD)
+        shutil.rmtree(self.gitDir)
+
+    def AllObjects(self):
+        objects = gitshelve.git('rev-list','--objects','--all')
+        return [line.split()[0] for line in objects.split('\n')]
+
+    def AssertReadsLikeGit(self,odb,gitDir='.git'):
+        batch = gitshelve.gitbatch(gitDir)
+        for sha in self.AllObjects():
+            self.assertEqual(batch.get(sha),odb.read(sha))
+        batch.close()
+
+    def testFindGitDir(self):
+        self.assertEqual(os.path.realpath('.git'),
+                         os.path.realpath(gitodb.find_git_dir()))
+        os.chdir('dir0')
+        self.assertEqual(os.path.realpath(os.path.join('..','.git')),
+                         os.path.realpath(gitodb.find_git_dir()))
+        self.assertEqual(None,gitodb.find_git_dir(self.gitDir))
+        self.assertEqual('../.git',gitodb.find_git_dir('../.git'))
+        with self.assertRaises(gitodb.OdbError):
+            gitodb.open(self.gitDir)
+
+    def testReadLoose(self):
+        self.AssertReadsLikeGit(self.odb)
+        with self.assertRaises(KeyError):
+            self.odb.read('0'*40)
+
+    def testReadPacked(self):
+        gitshelve.git('repack','-a','-d','-q','--depth=50','--window=50')
+        self.AssertReadsLikeGit(self.odb)
+        self.assertEqual(1,len(self.odb.packs))
+        #the versions of 'big' are stored as deltas of each other
+        self.assertTrue(len(self.odb.cache.entries) > 0)
+
+        #packs are picked up again when objects move
+        gitshelve.git('repack','-a','-d','-q','-f')
+        self.AssertReadsLikeGit(self.odb)
+
+    def AssertStreamsLikeRead(self,odb):
+        for sha in self.AllObjects():
+            kind,size,stream = odb.open_object(sha)
+            with stream:
+                chunks = []
+                chunk = stream.read(100)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = stream.read(100)
+            self.assertEqual(odb.read(sha),(kind,b''.join(chunks)))
+            self.assertEqual(len(odb.read(sha)[1]),size)
+
+    def testOpenObject(self):
+        self.AssertStreamsLikeRead(self.odb)
+        with self.assertRaises(KeyError):
+            self.odb.open_object('0'*40)
+        #packed, with and without deltas
+        gitshelve.git('repack','-a','-d','-q','--depth=50','--window=50')
+        self.AssertStreamsLikeRead(self.odb)
+        gitshelve.git('repack','-a','-d','-q','--depth=0','-f')
+        self.AssertStreamsLikeRead(self.odb)
+
+    def testReadRefDeltas(self):
+        #without --delta-base-offset, pack-objects writes REF_DELTA entries
+        bare = os.path.join(self.gitDir,'bare.git')
+        gitshelve.git('init','--bare',bare)
+        gitshelve.git('pack-objects','-q','--window=50',
+                             os.path.join(bare,'objects','pack','pack'),
+                             input='\n'.join(self.AllObjects()) + '\n')
+        odb = gitodb.open(bare)
+        self.AssertReadsLikeGit(odb,bare)
+        odb.close()
+
+    def testDeltaCache(self):
+        cache = gitodb.deltacache(10)
+        cache.put('a','blob',b'12345')
+        cache.put('b','blob',b'12345')
+        self.assertEqual(('blob',b'12345'),cache.get('a'))
+        cache.put('c','blob',b'123')
+        self.assertEqual(None,cache.get('b'))
+        self.assertEqual(8,cache.size)
+        cache.put('d','blob',b'12345678901')
+        self.assertEqual(None,cache.get('d'))
+        cache.clear()
+        self.assertEqual(0,cache.size)
+
+    def testApplyDelta(self):
+        base = b'0123456789'
+        #base size 10, result size 7: copy 4 bytes at 2, insert 'abc'
+        delta = b'\x0a\x07\x91\x02\x04\x03abc'
+        self.assertEqual(b'2345abc',gitodb.apply_delta(base,delta))
+        with self.assertRaises(gitodb.OdbError):
+            gitodb.apply_delta(b'short',delta)
+
+    def testDiffTree(self):
+        for old,new in (('master~4','master'),('master','master~4'),
+                        ('master~1','master')):
+            expected = gitshelve.git('diff-tree','-r','-t',old,new)
+            entries = self.odb.diff_tree(gitshelve.git('rev-parse',old),
+                                         gitshelve.git('rev-parse',new))
+            self.assertEqual(expected.split('\n'),
+                             [':%s %s %s %s %s\t%s'%entry
+                              for entry in entries])
+
+        #a file replaced by a directory
+        head = self.odb.resolve('master')
+        os.remove('big')
+        os.makedirs(os.path.join('big','sub'))
+        with open(os.path.join('big','sub','file'),'w') as f:
+            f.write('file')
+        gitshelve.git('add','-A')
+        gitshelve.git('commit','-m','big is a directory')
+        expected = gitshelve.git('diff-tree','-r','-t',head,'master')
+        entries = self.odb.diff_tree(head,self.odb.resolve('master'))
+        self.assertEqual(sorted(expected.split('\n')),
+                         sorted(':%s %s %s %s %s\t%s'%entry
+                                for entry in entries))
+        self.assertEqual([],list(self.odb.diff_tree(head,head)))
+
+    def testResolve(self):
+        head = gitshelve.git('rev-parse','master')
+        self.assertEqual(head,self.odb.resolve('master'))
+        self.assertEqual(head,self.odb.resolve('HEAD'))
+        self.assertEqual(head,self.odb.resolve('refs/heads/master'))
+        self.assertEqual(head,self.odb.resolve(head))
+        self.assertEqual(None,self.odb.resolve('nonexistent'))
+        self.assertEqual(None,self.odb.resolve('master~1'))
+        gitshelve.git('tag','v1','master~1')
+        gitshelve.git('pack-refs','--all')
+        self.assertEqual(gitshelve.git('rev-parse','v1'),
+                         self.odb.resolve('v1'))
+        self.assertEqual(head,self.odb.resolve('master'))
+
+    def testLsTree(self):
+        expected = gitshelve.git('ls-tree','-r','-t','master').split('\n')
+        entries = ['%s %s %s\t%s'%entry
+                   for entry in self.odb.ls_tree(self.odb.resolve('master'),
+                                                 True)]
+        self.assertEqual(expected,entries)
+        expected = gitshelve.git('ls-tree','master:dir0').split('\n')
+        tree = gitshelve.git('rev-parse','master:dir0')
+        self.assertEqual(expected,['%s %s %s\t%s'%entry
+                                   for entry in self.odb.ls_tree(tree)])
+        with self.assertRaises(gitodb.OdbError):
+            self.odb.read_tree(gitshelve.git('rev-parse','master:big'))
+
+    def testWriteObject(self):
+        for data in (b'',b'some data\n',b'\0\xff binary'):
+            name = self.odb.write_object('blob',data)
+            self.assertEqual(self.odb.hash_object('blob',data),name)
+            self.assertEqual(('blob',data),self.odb.read(name))
+            batch = gitshelve.gitbatch()
+            self.assertEqual(('blob',data),batch.get(name))
+            batch.close()
+        #writing an object twice, or one that is packed, is fine
+        self.assertEqual(name,self.odb.write_object('blob',data))
+        gitshelve.git('repack','-a','-d','-q')
+        self.assertEqual(name,self.odb.write_object('blob',data))
+        self.assertEqual(gitshelve.git('hash-object','--stdin',
+                                       input='some data\n'),
+                         self.odb.hash_object('blob',b'some data\n'))
+        gitshelve.git('fsck','--strict')
+
+    def testWriteStream(self):
+        data = b''.join(('chunk %d\n'%i).encode('ascii')*1000
+                        for i in range(100))
+        chunks = [data[i:i + 65536] for i in range(0,len(data),65536)]
+        name = self.odb.write_stream('blob',len(data),iter(chunks))
+        self.assertEqual(self.odb.hash_object('blob',data),name)
+        self.assertEqual(('blob',data),self.odb.read(name))
+        #again, when it is already there
+        self.assertEqual(name,self.odb.write_stream('blob',len(data),chunks))
+        self.assertEqual(self.odb.write_object('blob',b''),
+                         self.odb.write_stream('blob',0,[]))
+        with self.assertRaises(gitodb.OdbError):
+            self.odb.write_stream('blob',len(data) + 1,chunks)
+        self.assertEqual([],[n for n in os.listdir(self.odb.objects_dir)
+                             if n.startswith('tmp_obj_')])
+        gitshelve.git('fsck','--strict')
+
+    def testWriteTree(self):
+        blob = self.odb.write_object('blob',b'data')
+        tree = gitshelve.git('rev-parse','master:dir0')
+        #'a' sorts after 'a-b' and 'a.b' as a tree, but before them as a blob
+        entries = [('040000','a',tree),('100644','a-b',blob),
+                   ('100644','a.b',blob),('100644','a0',blob)]
+        mktree = gitshelve.git('mktree',input=''.join(
+            '%s %s %s\t%s\n'%(mode,mode == '040000' and 'tree' or 'blob',
+                               sha,name) for mode,name,sha in entries))
+        self.assertEqual(mktree,self.odb.write_tree(reversed(entries)))
+        entries[0] = ('100644','a',blob)
+        mktree = gitshelve.git('mktree',input=''.join(
+            '100644 blob %s\t%s\n'%(sha,name) for mode,name,sha in entries))
+        self.assertEqual(mktree,self.odb.write_tree(entries))
+
+    def testWriteCommit(self):
+        env = dict(os.environ)
+        os.environ['GIT_AUTHOR_DATE'] = '@1234567890 +0100'
+        os.environ['GIT_COMMITTER_DATE'] = '1234567899 -0230'
+        try:
+            tree = gitshelve.git('rev-parse','master^{tree}')
+            head = gitshelve.git('rev-parse','master')
+            for parents,message in (([],''),([head],'message\n'),
+                                    ([head,head+'~1'],'no newline')):
+                parents = [gitshelve.git('rev-parse',p) for p in parents]
+                args = []
+                for parent in parents:
+                    args += ['-p',parent]
+                expected = gitshelve.git('commit-tree',tree,*args,
+                                         input=message)
+                self.assertEqual(expected,self.odb.write_commit(tree,parents,
+                                                                message))
+            os.environ['GIT_AUTHOR_NAME'] = ' Other <Name>. '
+            os.environ['GIT_AUTHOR_DATE'] = 'yesterday'
+            with self.assertRaises(gitodb.OdbError):
+                self.odb.write_commit(tree,[],'')
+            os.environ['GIT_AUTHOR_DATE'] = '1234567890 +0000'
+            self.assertEqual('Other Name <test@example.com> 1234567890 +0000',
+                             self.odb.ident('author'))
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+
+    def testUpdateRef(self):
+        head = self.odb.resolve('master')
+        parent = gitshelve.git('rev-parse','master~1')
+        self.odb.update_ref('refs/heads/other',parent)
+        self.assertEqual(parent,gitshelve.git('rev-parse','other'))
+        self.odb.update_ref('refs/heads/other',head,parent,'moved')
+        self.assertEqual(head,gitshelve.git('rev-parse','other'))
+        self.assertEqual(['other@{0}: moved','other@{1}: '],
+                         gitshelve.git('reflog','show','--format=%gd: %gs',
+                                       'other').split('\n'))
+
+        #the ref has moved on, so nothing is changed
+        with self.assertRaises(gitodb.RefError):
+            self.odb.update_ref('refs/heads/other',parent,parent)
+        self.assertEqual(head,gitshelve.git('rev-parse','other'))
+
+        #somebody else is updating it
+        lock = os.path.join('.git','refs','heads','other.lock')
+        open(lock,'w').close()
+        with self.assertRaises(gitodb.RefError):
+            self.odb.update_ref('refs/heads/other',parent,head)
+        os.remove(lock)
+        self.assertEqual(head,gitshelve.git('rev-parse','other'))
+
+        #packed refs are compared and overridden like loose ones
+        gitshelve.git('pack-refs','--all')
+        self.odb.update_ref('refs/heads/master',parent,head)
+        self.assertEqual(parent,gitshelve.git('rev-parse','master'))
+        self.assertEqual('master@{0}: ',
+                         gitshelve.git('reflog','show','-1',
+                                       '--format=%gd: %gs','master'))
+        self.assertEqual(parent,gitshelve.git('rev-parse','HEAD@{0}'))
+        gitshelve.git('fsck','--strict')
+
+        with self.assertRaises(gitodb.OdbError):
+            self.odb.update_ref('HEAD',head)
+
+    def testReadConfig(self):
+        with open('config','w') as f:
+            f.write('# comment\n'
+                    '[User]\n'
+                    '\tName = "A \\"quoted\\" name " ; comment\n'
+                    '\temail=plain@example.com   # comment\n'
+                    '[core] bare\n'
+                    '[remote "Origin"]\n'
+                    '\turl = x\n')
+        self.assertEqual({'user.name':'A "quoted" name ',
+                          'user.email':'plain@example.com',
+                          'core.bare':'true',
+                          'remote.Origin.url':'x'},
+                         gitodb.read_config('config'))
+        with open('config','a') as f:
+            f.write('[include]\n\tpath = other\n')
+        with self.assertRaises(gitodb.OdbError):
+            gitodb.read_config('config')
+
+    def testShelfReadsWithoutGit(self):
+        shelf = gitshelve.open('tickets')
+        shelf['active/1'] = 'ticket 1'
+        shelf['archived/2'] = 'ticket 2'
+        shelf.commit('tickets')
+        shelf.close()
+        gitshelve.git('repack','-a','-d','-q')
+
+        def NoGit(*args,**kwargs):
+            raise AssertionError('git was run: %s'%(args,))
+        git = gitshelve.git
+        gitshelve.git = NoGit
+        try:
+            for lazy in (False,True):
+                shelf = gitshelve.open('tickets',lazy=lazy)
+                shelf.use_batch = False
+                self.assertEqual('ticket 1',shelf['active/1'])
+                self.assertEqual('ticket 2',shelf['archived/2'])
+                shelf.close()
+        finally:
+            gitshelve.git = git
+
+        #and writing a commit doesn't need git either
+        gitshelve.git = NoGit
+        try:
+            shelf = gitshelve.open('tickets')
+            shelf['active/3'] = 'ticket 3'
+            del shelf['active/1']
+            shelf.commit('tickets')
+            shelf.close()
+        finally:
+            gitshelve.git = git
+        self.assertEqual(['active/3','archived/2'],
+                         gitshelve.git('ls-tree','-r','--name-only',
+                                       'tickets').split('\n'))
+        self.assertEqual('tickets',gitshelve.git('log','-1','--format=%s',
+                                                 'tickets'))
+        gitshelve.git('fsck','--strict')
+
+        #without the native reader, everything still works through git
+        shelf = gitshelve.gitshelve('tickets')
+        shelf.use_odb = False
+        shelf.read_repository()
+        self.assertEqual('ticket 2',shelf['archived/2'])
+        shelf.close()
+
+if __name__ == '__main__':
+    unittest.main()
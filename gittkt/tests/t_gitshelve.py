@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
 import shutil
@@ -173,6 +174,31 @@ class t_gitshelve(unittest.TestCase):
         b.__setstate__({'data': 'something'})
         self.assertEqual(b.__getstate__(),{'shelf': {}, 'path': self.gitDir,
                                            'data': 'something', 'name': None})
+
+    def testGitbookCompact(self):
+        shelf = gitshelve.gitshelve()
+        name = '3602361dafeea2cbec159128f5166a8428c0795c'
+        b = gitshelve.gitbook(shelf, 'file', name=name)
+        self.assertFalse(hasattr(b, '__dict__'))
+        self.assertEqual(20, len(b.binname))
+        self.assertEqual(name, b.name)
+        copy = gitshelve.gitbook.__new__(gitshelve.gitbook)
+        copy.__setstate__(b.__getstate__())
+        self.assertEqual(name, copy.name)
+        self.assertFalse(copy.dirty)
+        #a book still answers to the dicts books used to be kept in
+        self.assertTrue(b['__book__'] is b)
+        self.assertTrue('__book__' in b)
+        self.assertFalse('__root__' in b)
+
+        s = gitshelve.gitshelve.open()
+        self.assertTrue(isinstance(s.objects, gitshelve.gittree))
+        self.assertTrue(isinstance(s.objects['file'], gitshelve.gitbook))
+        s['a/b'] = 'data'
+        self.assertTrue(isinstance(s.objects['a'], gitshelve.gittree))
+        self.assertTrue(isinstance(s.objects['a']['b'], gitshelve.gitbook))
+        self.assertEqual('a/b', s.objects['a']['b'].path)
+        s.close()
     #----gitshelve tests-------
     def testGitshelveInit(self):
         s = gitshelve.gitshelve()
@@ -216,6 +242,803 @@ class t_gitshelve(unittest.TestCase):
         #TODO: some verification that the repo was read
         s.close()
 
+    def testGitbatch(self):
+        name = gitshelve.git('rev-parse','master:file')
+        reader = gitshelve.gitbatch()
+        self.assertTrue(reader.alive())
+        self.assertEqual(('blob',b'temp'),reader.get(name))
+        self.assertEqual(('blob',b'temp'),reader.get(name))
+        with self.assertRaises(KeyError):
+            reader.get('0'*40)
+        reader.close()
+        self.assertFalse(reader.alive())
+        with self.assertRaises(IOError):
+            reader.get(name)
+
+    def testGitHooks(self):
+        calls = []
+        gitshelve.hooks.append(calls.append)
+        stats = gitshelve.gitstats().install()
+        try:
+            with gitshelve.operation('outer'):
+                gitshelve.git('rev-parse','master')
+                with gitshelve.operation('inner'):
+                    with self.assertRaises(gitshelve.GitError):
+                        gitshelve.git('rev-parse','--verify','missing')
+                gitshelve.git('hash-object','--stdin',input='data')
+            reader = gitshelve.gitbatch()
+            reader.get('master')
+            with self.assertRaises(KeyError):
+                reader.get('0'*40)
+            reader.close()
+        finally:
+            stats.uninstall()
+            gitshelve.hooks.remove(calls.append)
+        self.assertEqual([],gitshelve.hooks)
+
+        self.assertEqual(['rev-parse','rev-parse','hash-object','cat-file',
+                          'cat-file'],[call.cmd for call in calls])
+        self.assertEqual(('rev-parse','--verify','missing'),
+                         (calls[1].cmd,) + calls[1].args)
+        self.assertEqual([0,128,0,0,1],[call.returncode for call in calls])
+        self.assertEqual(['outer','inner','outer',None,None],
+                         [call.operation for call in calls])
+        self.assertEqual(4,calls[2].bytes_in)
+        self.assertEqual(41,calls[2].bytes_out)
+        self.assertEqual(('--batch','master'),calls[3].args)
+        for call in calls:
+            self.assertTrue(call.elapsed >= 0)
+
+        entry = stats.commands['rev-parse']
+        self.assertEqual(2,entry['calls'])
+        self.assertEqual(1,entry['failures'])
+        self.assertEqual(2,sum(entry['histogram']))
+        self.assertEqual(entry['max'] <= entry['elapsed'],True)
+        self.assertEqual(2,stats.commands['cat-file']['calls'])
+        self.assertEqual(2,stats.operations['outer']['calls'])
+        self.assertEqual(2,stats.operations[None]['calls'])
+        #a histogram bucket bounds the fraction of calls below it
+        entry = {'calls':4,'histogram':[1,0,2,0,0,0,0,0,0,0,0,0,1]}
+        self.assertEqual(0.001,stats.percentile(entry,0.25))
+        self.assertEqual(0.004,stats.percentile(entry,0.5))
+        self.assertEqual(None,stats.percentile(entry,0.9))
+        summary = stats.summary()
+        self.assertRegex(summary,r'\nrev-parse +2 ')
+        self.assertRegex(summary,r'\nouter +2 ')
+        self.assertIn('waiting for git',summary)
+
+        #nothing is counted once the stats are uninstalled
+        gitshelve.git('rev-parse','master')
+        self.assertEqual(2,stats.commands['rev-parse']['calls'])
+
+    def testGitshelveGetBlob(self):
+        name = gitshelve.git('rev-parse','master:file')
+        s = gitshelve.gitshelve()
+        #go through git rather than reading the object database natively,
+        #or the blobs already read
+        s.use_odb = False
+        s.blob_cache = None
+        self.assertEqual('temp',s.get_blob(name))
+        self.assertTrue(s.reader.alive())
+        with self.assertRaises(gitshelve.GitError):
+            s.get_blob('0'*40)
+
+        #if the batch process dies, we fall back to a cat-file per call
+        s.reader.proc.kill()
+        s.reader.proc.wait()
+        self.assertEqual('temp',s.get_blob(name))
+        self.assertEqual(None,s.reader)
+        self.assertFalse(s.use_batch)
+        self.assertEqual('temp',s.get_blob(name))
+        s.close()
+
+        s = gitshelve.gitshelve()
+        s.use_odb = False
+        s.blob_cache = None
+        s.get_blob(name)
+        reader = s.reader
+        s.close()
+        self.assertFalse(reader.alive())
+
+    def testGitshelveLoadBooks(self):
+        s = gitshelve.gitshelve('books')
+        for num in range(10):
+            s['a/%d'%num] = 'book %d'%num
+        s.commit('books')
+        s.close()
+
+        names = gitshelve.git('rev-parse','books:a/3','books:a/7').split('\n')
+        reader = gitshelve.gitbatch()
+        self.assertEqual([('blob',b'book 3'),None,('blob',b'book 7')],
+                         reader.get_many([names[0],'0'*40,names[1]]))
+        #the answers were all read, so the next request is unaffected
+        self.assertEqual(('blob',b'book 3'),reader.get(names[0]))
+        reader.close()
+
+        s = gitshelve.gitshelve.open('books')
+        s.use_odb = False
+        s.blob_cache = None
+        s.prefetch = 4
+        paths = ['a/%d'%num for num in (9,2,5,0,1,3,4,6,7,8)]
+        s['a/5'] = 'changed'
+        calls = []
+        gitshelve.hooks.append(calls.append)
+        try:
+            datas = list(s.load_books(paths))
+        finally:
+            gitshelve.hooks.remove(calls.append)
+        self.assertEqual(['book 9','book 2','changed','book 0','book 1',
+                          'book 3','book 4','book 6','book 7','book 8'],datas)
+        #one batch request for each book that had to be read, and nothing else
+        self.assertEqual(9,len(calls))
+        for call in calls:
+            self.assertEqual('cat-file',call.cmd)
+            self.assertEqual('--batch',call.args[0])
+        self.assertEqual(['book 2','changed'],list(s.load_books(['a/2','a/5'])))
+        self.assertEqual(9,len(calls))
+        with self.assertRaises(KeyError):
+            list(s.load_books(['a/1','a/missing']))
+        with self.assertRaises(KeyError):
+            list(s.load_books(['a']))
+        self.assertEqual(['book 7','book 3'],s.get_blobs([names[1],names[0]]))
+        with self.assertRaises(gitshelve.GitError):
+            s.get_blobs([names[0],'0'*40])
+        s.close()
+
+    def testGitshelveStreaming(self):
+        data = b''.join(('line %d\n'%i).encode('ascii') for i in range(50000))
+        for useOdb,engine in ((True,'mktree'),(False,'mktree'),
+                              (False,'fast-import')):
+            branch = 'stream-%s'%engine
+            s = gitshelve.open(branch,engine=engine)
+            s.use_odb = useOdb
+            s.blob_cache = None
+            s['small'] = 'small'
+            with s.open_write('big/log') as f:
+                for i in range(0,len(data),4096):
+                    f.write(data[i:i + 4096])
+            self.assertTrue(s.dirty)
+            #it reads back before and after the commit
+            with s.open_read('big/log') as f:
+                self.assertEqual(data,f.read())
+            s.commit('stream')
+            self.assertEqual(data,gitshelve.git('cat-file','blob',
+                             branch + ':big/log',keep_newline=True)
+                             .encode('ascii'))
+            with s.open_read('small') as f:
+                self.assertEqual(b'small',f.read())
+            s.close()
+
+            s = gitshelve.open(branch)
+            s.use_odb = useOdb
+            s.blob_cache = None
+            with s.open_read('big/log') as f:
+                self.assertEqual(b'line 0\n',f.readline())
+                self.assertEqual(data[7:],f.read())
+            #stopping early is fine too
+            f = s.open_read('big/log')
+            self.assertEqual(b'line',f.read(4))
+            f.close()
+            with self.assertRaises(KeyError):
+                s.open_read('big')
+            with self.assertRaises(KeyError):
+                s.open_read('missing')
+            s.close()
+
+        #an exception in the with block throws the data away
+        s = gitshelve.open('stream-mktree')
+        with self.assertRaises(ValueError):
+            with s.open_write('big/log') as f:
+                f.write(b'partial')
+                raise ValueError()
+        self.assertFalse(s.dirty)
+        self.assertEqual(data.decode('ascii'),s['big/log'])
+
+        #a streamed book is still pending when another writer gets in first
+        other = gitshelve.open('stream-mktree')
+        other['big/log'] = 'elsewhere'
+        other.commit('other')
+        other.close()
+        with s.open_write('big/log') as f:
+            f.write(b'here')
+        with self.assertRaises(gitshelve.ConflictError):
+            s.commit('conflict')
+        s.close_reader()
+        s.close_odb()
+
+        #a failing git command is reported when the stream ends
+        f = io.BufferedReader(gitshelve.gitpipe('cat-file','blob','0'*40))
+        with self.assertRaises(gitshelve.GitError):
+            f.read()
+        f.close()
+
+    def testGitshelveHistory(self):
+        s = gitshelve.open('history')
+        self.assertEqual([],list(s.history()))
+        s['a'] = 'a1'
+        s['b/c'] = 'c1'
+        first = s.commit('first')
+        s['a'] = 'a2'
+        del s['b/c']
+        s['b/d'] = 'd1'
+        second = s.commit('second')
+        blob = lambda path: gitshelve.git('rev-parse',path)
+        a1,c1 = blob(first + ':a'),blob(first + ':b/c')
+        a2,d1 = blob(second + ':a'),blob(second + ':b/d')
+
+        history = list(s.history())
+        author,date = history[0][1:3]
+        self.assertEqual(gitshelve.git('log','-1','--format=%an <%ae>',
+                                       second),author)
+        self.assertEqual(int(gitshelve.git('log','-1','--format=%at',
+                                           second)),date)
+        self.assertEqual([(second,'a',a1,a2),(second,'b/c',c1,None),
+                          (second,'b/d',None,d1),(first,'a',None,a1),
+                          (first,'b/c',None,c1)],
+                         [(commit,path,old,new) for commit,author,date,path,
+                          old,new in history])
+
+        self.assertEqual([(second,'b/c'),(second,'b/d'),(first,'b/c')],
+                         [(change[0],change[3])
+                          for change in s.history('b')])
+        self.assertEqual(['a','b/c','b/d'],
+                         [change[3] for change in s.history(base=first)])
+        self.assertEqual([],list(s.history(since='2090-01-01')))
+        self.assertEqual(5,len(list(s.history(since='1 hour ago'))))
+
+        #stopping early leaves nothing running
+        changes = s.history()
+        self.assertEqual('a',next(changes)[3])
+        changes.close()
+        s.close()
+
+    def testGitview(self):
+        s = gitshelve.open('views')
+        for num in range(3):
+            s['active/%d'%num] = 'ticket %d'%num
+        s['archived/old'] = 'old ticket'
+        s.commit('release')
+        gitshelve.git('tag','-a','-m','release','v1','views')
+        s['active/1'] = 'changed'
+        del s['active/2']
+        s.commit('after the release')
+
+        old = s.open_at('v1')
+        new = s.open_at('views')
+        self.assertEqual(gitshelve.git('rev-parse','views^'),old.head)
+        self.assertEqual(['active/0','active/1','active/2','archived/old'],
+                         sorted(old.keys()))
+        self.assertEqual('ticket 1',old['active/1'])
+        self.assertEqual([('active/0','ticket 0'),('active/1','changed'),
+                          ('archived/old','old ticket')],
+                         sorted((key,new[key]) for key in new.keys()))
+        #the unchanged trees are the same objects in both
+        self.assertTrue(old.objects['archived'] is new.objects['archived'])
+        self.assertFalse(old.objects['active'] is new.objects['active'])
+        self.assertEqual(new.head,s.open_at('views^0').head)
+
+        #through git, and outside of any shelf
+        view = gitshelve.open_at('views~1',trees=old.trees)
+        view.use_odb = False
+        self.assertEqual(old.head,view.head)
+        self.assertTrue(view.objects is old.objects)
+        self.assertEqual('ticket 2',view['active/2'])
+        with self.assertRaises(gitshelve.GitError):
+            gitshelve.open_at('missing')
+
+        for change in (lambda: old.__setitem__('active/0','x'),
+                       lambda: old.__delitem__('active/0'),
+                       lambda: old.commit('x'),
+                       lambda: old.open_write('active/0')):
+            with self.assertRaises(TypeError):
+                change()
+        self.assertEqual('ticket 0',old['active/0'])
+        for view in (old,new):
+            view.close()
+        s.close()
+
+    def testBlobCache(self):
+        cache = gitshelve.blobcache(max_bytes=10)
+        cache.put('a'*40,'12345')
+        cache.put('b'*40,'1234')
+        self.assertEqual('12345',cache.get('a'*40))
+        #'b' is now the least recently used, so it goes first
+        cache.put('c'*40,'123')
+        self.assertEqual(None,cache.get('b'*40))
+        self.assertEqual('123',cache.get('c'*40))
+        self.assertEqual(8,cache.size)
+        #too big to keep at all
+        cache.put('d'*40,'12345678901')
+        self.assertEqual(None,cache.get('d'*40))
+        self.assertEqual({'hits':2,'misses':2,'disk_hits':0,'evictions':1},
+                         cache.stats)
+        self.assertIn('2 hits',cache.summary())
+        #the limit is on bytes, not characters
+        cache = gitshelve.blobcache(max_bytes=10)
+        cache.put('a'*40,u'\u00e9\u00e9\u00e9')
+        self.assertEqual(6,cache.size)
+        cache.put('b'*40,u'\u00e9\u00e9\u00e9')
+        self.assertEqual(None,cache.get('a'*40))
+        self.assertEqual(6,cache.size)
+        #and a blob is only counted once
+        cache.insert('b'*40,u'\u00e9\u00e9\u00e9',6)
+        self.assertEqual(6,cache.size)
+        self.assertEqual(1,len(cache.entries))
+
+        #the blobs written to disk outlive the memory
+        cacheDir = tempfile.mkdtemp()
+        try:
+            cache = gitshelve.blobcache(max_bytes=10,directory=cacheDir)
+            cache.put('a'*40,'12345')
+            self.assertTrue(os.path.isfile(os.path.join(cacheDir,'aa',
+                                                        'a'*38)))
+            cache.clear()
+            self.assertEqual('12345',cache.get('a'*40))
+            self.assertEqual(1,cache.stats['disk_hits'])
+            self.assertEqual('12345',cache.get('a'*40))
+            self.assertEqual(1,cache.stats['hits'])
+        finally:
+            shutil.rmtree(cacheDir)
+
+        #shelves share the cache, and read from git only once
+        name = gitshelve.git('rev-parse','master:file')
+        calls = []
+        gitshelve.hooks.append(calls.append)
+        try:
+            cache = gitshelve.blobcache()
+            s = gitshelve.gitshelve()
+            s.use_odb = False
+            s.blob_cache = cache
+            self.assertEqual('temp',s.get_blob(name))
+            s.close()
+            s = gitshelve.gitshelve()
+            s.use_odb = False
+            s.blob_cache = cache
+            self.assertEqual('temp',s.get_blob(name))
+            s.close()
+        finally:
+            gitshelve.hooks.remove(calls.append)
+        self.assertEqual(1,len(calls))
+        self.assertEqual({'hits':1,'misses':1,'disk_hits':0,'evictions':0},
+                         cache.stats)
+
+        #and what is committed is there to be read back
+        s = gitshelve.gitshelve('cached')
+        s.blob_cache = cache
+        s['ticket'] = 'new ticket'
+        s.commit('cached')
+        self.assertEqual('new ticket',
+                         cache.get(gitshelve.git('rev-parse','cached:ticket')))
+        s.close()
+
+    def testGitshelveLazyReadRepository(self):
+        s = gitshelve.open('test')
+        s['active/a'] = 'data a'
+        s['active/index.txt'] = 'index'
+        s['archived/b/c'] = 'data c'
+        s['archived/b/d'] = 'data d'
+        s['top'] = 'data top'
+        s.commit('first')
+        s.close()
+        archived = gitshelve.git('rev-parse','test:archived')
+
+        s = gitshelve.open('test',lazy=True)
+        self.assertEqual({'__lazy__':''},s.objects)
+        self.assertEqual('index',s['active/index.txt'])
+        self.assertEqual({'__root__':archived,'__lazy__':'archived'},
+                         s.objects['archived'])
+        self.assertNotIn('__lazy__',s.objects['active'])
+        self.assertTrue('active/a' in s)
+
+        #a commit keeps the unexpanded tree as it is
+        s['active/index.txt'] = 'new index'
+        s.commit('second')
+        self.assertEqual({'__root__':archived,'__lazy__':'archived'},
+                         s.objects['archived'])
+        self.assertEqual(archived,gitshelve.git('rev-parse','test:archived'))
+
+        #reading or deleting reaches into the rest of the tree
+        self.assertEqual('archived/b/c',
+                         s.get_tree('archived/b/c')['__book__'].path)
+        self.assertEqual('data c',s['archived/b/c'])
+        del s['archived/b/c']
+        s.commit('third')
+        s.close()
+
+        eager = gitshelve.open('test')
+        lazy = gitshelve.open('test',lazy=True)
+        buf = StringIO()
+        eager.dump_objects(buf)
+        lazyBuf = StringIO()
+        lazy.dump_objects(lazyBuf)
+        self.assertEqual(buf.getvalue(),lazyBuf.getvalue())
+        self.assertNotIn('c',eager.objects['archived']['b'])
+        eager.close()
+        lazy.close()
+
+    def testGitshelveRefresh(self):
+        for lazy,useOdb in ((False,True),(False,False),(True,True)):
+            branch = 'test-%s-%s'%(lazy,useOdb)
+            s = gitshelve.open(branch)
+            s['active/a'] = 'data a'
+            s['active/b'] = 'data b'
+            s['archived/c/d'] = 'data d'
+            s['archived/c/e'] = 'data e'
+            s['top'] = 'data top'
+            s.commit('first')
+
+            reader = gitshelve.open(branch,lazy=lazy)
+            reader.use_odb = useOdb
+            self.assertEqual([],reader.refresh())
+            self.assertEqual('data a',reader['active/a'])
+            book = reader.get_tree('active/a')['__book__']
+
+            s['active/b'] = 'new b'
+            del s['archived/c/d']
+            s['new/f'] = 'data f'
+            s.commit('second')
+            self.assertEqual(['active/b','archived/c/d','new/f'],
+                             sorted(reader.refresh()))
+            self.assertEqual(s.head,reader.head)
+            #unchanged books are left alone, data and all
+            self.assertTrue(book is reader.get_tree('active/a')['__book__'])
+            self.assertEqual('data a',book.data)
+            self.assertEqual('new b',reader['active/b'])
+            self.assertEqual('data f',reader['new/f'])
+            with self.assertRaises(KeyError):
+                reader['archived/c/d']
+
+            fresh = gitshelve.open(branch)
+            buf = StringIO()
+            fresh.dump_objects(buf)
+            refreshedBuf = StringIO()
+            reader.dump_objects(refreshedBuf)
+            self.assertEqual(buf.getvalue(),refreshedBuf.getvalue())
+            fresh.close()
+
+            #pending changes survive, and win where both sides changed
+            reader['active/b'] = 'reader b'
+            reader['mine'] = 'data mine'
+            del reader['archived/c/e']
+            s['active/b'] = 'writer b'
+            s['top'] = 'new top'
+            s['archived/c/e'] = 'new e'
+            s.commit('third')
+            self.assertEqual(['active/b','archived/c/e','top'],
+                             sorted(reader.refresh()))
+            self.assertEqual('reader b',reader['active/b'])
+            self.assertEqual('new top',reader['top'])
+            reader.commit('fourth')
+            s.close()
+            reader.close()
+
+            s = gitshelve.open(branch)
+            self.assertEqual('reader b',s['active/b'])
+            self.assertEqual('data mine',s['mine'])
+            self.assertEqual('new top',s['top'])
+            with self.assertRaises(KeyError):
+                s['archived/c/e']
+            self.assertEqual('third',gitshelve.git('log','-1','--format=%s',
+                                                   branch+'~1'))
+            s.close()
+
+    def testGitshelveSnapshot(self):
+        s = gitshelve.open('tickets/main')
+        s['active/a'] = 'data a'
+        s['active/b'] = 'data b'
+        s['archived/c'] = 'data c'
+        s.commit('first')
+        s.close()
+        path = os.path.join('.git','gitshelve','tickets%2Fmain')
+        with open(path,'rb') as f:
+            header = f.read().split(b'\0')[0]
+        self.assertEqual(gitshelve.decode(header),'gitshelve-snapshot 1 %s'%
+                         gitshelve.git('rev-parse','tickets/main'))
+
+        other = gitshelve.gitshelve('tickets/main')
+        other.use_snapshot = False
+        other.read_repository()
+
+        def NoListing(*args,**kwargs):
+            raise AssertionError('the branch was listed')
+        tree_entries = gitshelve.gitshelve.tree_entries
+        gitshelve.gitshelve.tree_entries = NoListing
+        try:
+            s = gitshelve.open('tickets/main')
+            self.assertEqual('data b',s['active/b'])
+            s.close()
+
+            #the branch moved on without the snapshot, so it catches up
+            other['active/b'] = 'new b'
+            other['active/d'] = 'data d'
+            other.commit('second')
+            other.close()
+
+            s = gitshelve.open('tickets/main')
+            self.assertEqual('new b',s['active/b'])
+            self.assertEqual('data d',s['active/d'])
+            self.assertEqual('data c',s['archived/c'])
+            buf = StringIO()
+            s.dump_objects(buf)
+            s.close()
+        finally:
+            gitshelve.gitshelve.tree_entries = tree_entries
+        with open(path,'rb') as f:
+            header = f.read().split(b'\0')[0]
+        self.assertTrue(header.endswith(gitshelve.encode(
+            gitshelve.git('rev-parse','tickets/main'))))
+
+        #it matches what reading the branch gives
+        s = gitshelve.gitshelve('tickets/main')
+        s.use_snapshot = False
+        s.read_repository()
+        fullBuf = StringIO()
+        s.dump_objects(fullBuf)
+        s.close()
+        self.assertEqual(fullBuf.getvalue(),buf.getvalue())
+
+        #a damaged snapshot is ignored
+        with open(path,'wb') as f:
+            f.write(b'gitshelve-snapshot 1 ' + b'0'*40 + b'\0bad')
+        s = gitshelve.open('tickets/main')
+        self.assertEqual('new b',s['active/b'])
+        s.close()
+
+    def testGitshelveTransaction(self):
+        s = gitshelve.open('test')
+        s['active/a'] = 'data a'
+        s['active/b'] = 'data b'
+        s['top'] = 'data top'
+        s.commit('first')
+
+        def Dump(shelf):
+            buf = StringIO()
+            shelf.dump_objects(buf)
+            return buf.getvalue()
+
+        #everything in a transaction is one commit
+        head = s.head
+        with s.transaction('second') as shelf:
+            self.assertTrue(shelf is s)
+            s['active/a'] = 'new a'
+            s['new/c'] = 'data c'
+            del s['top']
+        self.assertEqual(head,gitshelve.git('rev-parse','test~1'))
+        self.assertEqual('second',gitshelve.git('log','-1','--format=%B',
+                                                'test'))
+        self.assertEqual(['active/a','active/b','new/c'],
+                         gitshelve.git('ls-tree','-r','--name-only',
+                                       'test').split('\n'))
+
+        #an exception undoes everything
+        head = s.head
+        before = Dump(s)
+        book = s.get_tree('active/a')['__book__']
+        try:
+            with s.transaction('third'):
+                s['active/a'] = 'newer a'
+                s['active/b/x'] = 'b is a directory now'
+                s['other/d'] = 'data d'
+                del s['new/c']
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(before,Dump(s))
+        self.assertEqual(head,s.head)
+        self.assertFalse(s.dirty)
+        self.assertEqual([],s.deleted)
+        self.assertTrue(book is s.get_tree('active/a')['__book__'])
+        self.assertEqual('new a',s['active/a'])
+        self.assertEqual('data b',s['active/b'])
+        self.assertEqual(head,gitshelve.git('rev-parse','test'))
+
+        #a nested transaction joins the outer one, but undoes its own changes
+        #when it fails
+        with s.transaction('outer'):
+            s['active/a'] = 'outer a'
+            try:
+                with s.transaction('failed'):
+                    s['active/b'] = 'inner b'
+                    raise ValueError
+            except ValueError:
+                pass
+            with s.transaction('inner'):
+                s['new/c'] = 'inner c'
+                with s.transaction():
+                    s['new/e'] = 'inner e'
+            self.assertEqual(head,s.head)
+        self.assertEqual(head,gitshelve.git('rev-parse','test~1'))
+        self.assertEqual('outer\n\ninner',
+                         gitshelve.git('log','-1','--format=%B','test'))
+        self.assertEqual('outer a',s['active/a'])
+        self.assertEqual('data b',s['active/b'])
+        self.assertEqual('inner c',s['new/c'])
+
+        #a commit that fails is undone as well
+        other = gitshelve.open('test')
+        other['active/a'] = 'other a'
+        other.commit('moved')
+        other.close()
+        before = Dump(s)
+        with self.assertRaises(gitshelve.ConflictError):
+            with s.transaction('stale'):
+                s['active/a'] = 'stale a'
+        self.assertEqual(before,Dump(s))
+        self.assertEqual('outer a',s['active/a'])
+        s.close()
+
+    def testGitshelveRebase(self):
+        s = gitshelve.gitshelve('race')
+        s['a/x'] = 'x'
+        s['c/z'] = 'z'
+        s.commit('start')
+        s.close()
+        first = gitshelve.open('race')
+        second = gitshelve.open('race')
+        for shelf in (first,second):
+            shelf.retry_delay = 0
+
+        #changes to other paths are rebased onto the new head
+        first['a/x'] = 'first x'
+        head = first.commit('first')
+        second['b/y'] = 'second y'
+        del second['c/z']
+        name = second.commit('second')
+        self.assertEqual(head,gitshelve.git('rev-parse','%s^'%name))
+        self.assertEqual(name,second.head)
+        self.assertEqual(['a/x','b/y'],
+                         gitshelve.git('ls-tree','-r','--name-only',
+                                       'race').split('\n'))
+        self.assertEqual('first x',second['a/x'])
+        self.assertEqual({'commits':1,'retries':1,'rebases':1,'conflicts':0},
+                         second.contention)
+        self.assertFalse(second.dirty)
+
+        #the same path can't be, and stays pending
+        first.refresh()
+        first['b/y'] = 'first y'
+        first.commit('first again')
+        second['b/y'] = 'second y again'
+        with self.assertRaises(gitshelve.ConflictError):
+            second.commit('second again')
+        self.assertEqual(1,second.contention['conflicts'])
+        self.assertTrue(second.dirty)
+        self.assertEqual('second y again',second['b/y'])
+        #nor can a book in a tree the other side deleted
+        del first['a']
+        first.commit('deleted a')
+        second.refresh()
+        second['a/w'] = 'second w'
+        second.commit('conflicts with nothing')
+        second.refresh()
+        first.refresh()
+        del first['a']
+        first.commit('deleted a again')
+        second['a/w'] = 'second w again'
+        with self.assertRaises(gitshelve.ConflictError):
+            second.commit('second w')
+        #once refreshed, the pending changes win
+        second.refresh()
+        name = second.commit('second wins')
+        self.assertEqual('second y again',
+                         gitshelve.git('cat-file','blob','%s:b/y'%name,
+                                       keep_newline=True))
+        first.close()
+        second.close()
+
+        #a branch that stays locked gives up after retry_limit attempts
+        s = gitshelve.open('race')
+        s.retry_delay = 0
+        s.retry_limit = 2
+        s['d'] = 'locked'
+        lock = os.path.join('.git','refs','heads','race.lock')
+        open(lock,'w').close()
+        try:
+            with self.assertRaises(gitshelve.StaleHeadError):
+                s.commit('locked')
+        finally:
+            os.remove(lock)
+        self.assertEqual(2,s.contention['retries'])
+        self.assertEqual(0,s.contention['rebases'])
+        s.commit('unlocked')
+        self.assertEqual('locked',gitshelve.open('race')['d'])
+        s.close()
+
+    def testGitshelveRebaseRollback(self):
+        s = gitshelve.gitshelve('race')
+        s['x/1'] = 'x'
+        s['y/1'] = 'y'
+        s.commit('start')
+        s.close()
+        first = gitshelve.open('race')
+        first.retry_delay = 0
+        head = first.head
+        #the first rebase succeeds, then a third writer conflicts with it
+        rebase = first.rebase
+        def Rebase(paths):
+            rebase(paths)
+            if not third:
+                third.append(gitshelve.open('race'))
+                third[0]['x/1'] = 'third x'
+                third[0].commit('third')
+                third[0].close()
+        third = []
+        first.rebase = Rebase
+        second = gitshelve.open('race')
+        second['y/2'] = 'second y'
+        second.commit('second')
+        second.close()
+        with self.assertRaises(gitshelve.ConflictError):
+            with first.transaction('first'):
+                first['x/1'] = 'first x'
+        self.assertEqual(1,first.contention['rebases'])
+        #back where it was, head and all
+        self.assertEqual(head,first.head)
+        self.assertEqual(['x/1','y/1'],sorted(first.keys()))
+        self.assertEqual('x',first['x/1'])
+        self.assertFalse(first.dirty)
+        first.refresh()
+        first['z'] = 'z'
+        first.commit('unrelated')
+        self.assertEqual(['x/1','y/1','y/2','z'],
+                         gitshelve.git('ls-tree','-r','--name-only',
+                                       'race').split('\n'))
+        self.assertEqual('third x',first['x/1'])
+        first.close()
+
+    def testGitshelveRebaseEngines(self):
+        for engine,useOdb in (('fast-import',True),('mktree',False)):
+            branch = 'race-%s'%engine
+            s = gitshelve.gitshelve(branch)
+            s['a'] = 'a'
+            s.commit('start')
+            s.close()
+            first = gitshelve.open(branch,engine=engine)
+            second = gitshelve.open(branch,engine=engine)
+            for shelf in (first,second):
+                shelf.use_odb = useOdb
+                shelf.retry_delay = 0
+            first['b'] = 'b'
+            first.commit('first')
+            second['c/d'] = 'd'
+            second.commit('second')
+            self.assertEqual(['a','b','c/d'],
+                             gitshelve.git('ls-tree','-r','--name-only',
+                                           branch).split('\n'))
+            self.assertEqual(1,second.contention['rebases'])
+            first.close()
+            second.close()
+
+    def testGitshelveConcurrentWriters(self):
+        import threading
+        s = gitshelve.gitshelve('writers')
+        s['start'] = 'start'
+        s.commit('start')
+        s.close()
+        errors = []
+        def Writer(num):
+            try:
+                shelf = gitshelve.open('writers')
+                shelf.retry_delay = 0.001
+                shelf.retry_limit = 50
+                for commit in range(5):
+                    shelf['writer%d/%d'%(num,commit)] = 'data'
+                    shelf.commit('writer %d, commit %d'%(num,commit))
+                shelf.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=Writer,args=(num,))
+                   for num in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([],errors)
+        #nobody's write was lost
+        self.assertEqual(21,len(gitshelve.git('ls-tree','-r','--name-only',
+                                              'writers').split('\n')))
+        self.assertEqual('21',gitshelve.git('rev-list','--count','writers'))
+
     def testGitshelveHashBlob(self):
         data = 'this is some data'
         s = gitshelve.gitshelve()
@@ -230,6 +1053,61 @@ class t_gitshelve(unittest.TestCase):
                          s.make_blob(data))
         s.close()
 
+    def testGitshelveMakeBlobs(self):
+        datas = ['this is some data', 'more data', u'd\xe9j\xe0 vu', '']
+        s = gitshelve.gitshelve()
+        self.assertEqual([],s.make_blobs([]))
+        self.assertEqual([s.make_blob(data) for data in datas],
+                         s.make_blobs(datas))
+        s.close()
+
+    def testGitshelveWriteBooks(self):
+        s = gitshelve.gitshelve()
+        s['a/b'] = 'data b'
+        s['a/c/d'] = 'data d'
+        s['e'] = 'data e'
+        #a tree with a '__root__' has nothing pending, so it isn't searched
+        s.objects['f'] = {'__root__':'unchanged',
+                          'g':{'__book__':gitshelve.gitbook(s,'f/g')}}
+        s.objects['f']['g']['__book__'].dirty = True
+        buf = StringIO()
+        s.write_books(s.objects, buf)
+        self.assertTrue(s.objects['f']['g']['__book__'].dirty)
+        del s.objects['f']
+        for path in ('a/b','a/c/d','e'):
+            book = s.get_tree(path)['__book__']
+            self.assertFalse(book.dirty)
+            self.assertEqual(s.hash_blob('data ' + path[-1]),book.name)
+        head = s.commit('batch')
+        self.assertEqual('data d',
+                         gitshelve.git('cat-file','blob','%s:a/c/d'%head,
+                                       keep_newline=True))
+        s.close()
+
+    def testGitshelveParallelWrites(self):
+        trees = []
+        for workers,useOdb in ((None,True),(3,True),(3,False),(40,True)):
+            s = gitshelve.gitshelve('workers-%s-%s'%(workers,useOdb),
+                                    max_workers=workers)
+            s.use_odb = useOdb
+            for num in range(20):
+                s['dir%d/%d'%(num % 4,num)] = 'data %d'%num
+            s.commit('parallel')
+            trees.append(gitshelve.git('rev-parse','%s^{tree}'%s.branch))
+            #every book got the name of its own data
+            for num in range(20):
+                book = s.get_tree('dir%d/%d'%(num % 4,num))
+                self.assertEqual(s.hash_blob('data %d'%num),book.name)
+            s.close()
+        self.assertEqual(trees[:1] * 4,trees)
+        s = gitshelve.open('workers-3-True',max_workers=2)
+        self.assertEqual(2,s.max_workers)
+        self.assertEqual(['data 5','data 6'],
+                          [gitshelve.git('cat-file','blob',name,
+                                        keep_newline=True)
+                          for name in s.make_blobs(['data 5','data 6'])])
+        s.close()
+
     def testGitshelveMakeTree(self):
         #TODO:This test is very clumsy.  Work can be done to build a meaningful
         #tree
@@ -276,6 +1154,45 @@ class t_gitshelve(unittest.TestCase):
         newHead = s.commit()
         s.close()
 
+    def testGitshelveFastImportCommit(self):
+        with self.assertRaises(ValueError):
+            gitshelve.gitshelve(engine='bogus')
+
+        trees = {}
+        for engine in ('mktree','fast-import'):
+            branch = 'test-%s'%engine
+            s = gitshelve.open(branch, engine=engine)
+            s['a/b'] = 'data b'
+            s['a/c/d'] = 'data d'
+            s['e'] = 'data e'
+            s['"f"'] = 'data f'
+            first = s.commit('first')
+            s['a/b'] = 'data b2'
+            s['g/h'] = 'data h'
+            del s['a/c/d']
+            second = s.commit()
+            self.assertEqual(second,s.current_head())
+            self.assertEqual([first],s.get_parent_ids())
+            self.assertEqual('data b2',gitshelve.git('cat-file','blob',
+                             '%s:a/b'%branch,keep_newline=True))
+            self.assertEqual(s.hash_blob('data h'),
+                             s.get_tree('g/h')['__book__'].name)
+            s.close()
+            trees[engine] = gitshelve.git('rev-parse','%s^{tree}'%branch)
+        self.assertEqual(trees['mktree'],trees['fast-import'])
+
+        #without history, every book is written to a parentless commit
+        s = gitshelve.open('test-fast-import',keep_history=False,
+                           engine='fast-import')
+        s['e'] = 'data e2'
+        s.commit('no history')
+        self.assertEqual([],s.get_parent_ids())
+        self.assertEqual(sorted(['a/b','e','g/h','"f"']),
+                         sorted(gitshelve.git('ls-tree','-r','-z',
+                                '--name-only','test-fast-import',
+                                keep_newline=True).split('\0')[:-1]))
+        s.close()
+
     def testGitshelveSync(self):
         s = gitshelve.gitshelve()
         s.sync()
@@ -362,6 +1279,50 @@ class t_gitshelve(unittest.TestCase):
         s.prune_tree(s.objects,['temp','temp2'])
         s.close()
 
+    def testGitshelveMarkDirty(self):
+        class countingshelve(gitshelve.gitshelve):
+            visited = []
+            def make_tree(self, objects, comment_accumulator=None):
+                self.visited.append(objects)
+                return gitshelve.gitshelve.make_tree(self, objects,
+                                                     comment_accumulator)
+
+        s = countingshelve('test')
+        s['a/b/c'] = 'data c'
+        s['a/d'] = 'data d'
+        s['e/f'] = 'data f'
+        s['e/g/h'] = 'data h'
+        s.commit('first')
+        for tree in (s.objects,s.objects['a'],s.objects['a']['b'],
+                     s.objects['e'],s.objects['e']['g']):
+            self.assertIn('__root__',tree)
+
+        #only the trees above a change are written again
+        s['a/b/c'] = 'new c'
+        self.assertNotIn('__root__',s.objects)
+        self.assertNotIn('__root__',s.objects['a'])
+        self.assertNotIn('__root__',s.objects['a']['b'])
+        self.assertIn('__root__',s.objects['e'])
+        del s.visited[:]
+        s.commit('second')
+        self.assertEqual([s.objects,s.objects['a'],s.objects['a']['b']],
+                         s.visited)
+        self.assertEqual('new c',gitshelve.git('cat-file','blob',
+                                               'test:a/b/c',
+                                               keep_newline=True))
+
+        #removing the last entry of a tree removes the tree, all the way up
+        del s['e/g/h']
+        self.assertNotIn('g',s.objects['e'])
+        self.assertNotIn('__root__',s.objects)
+        del s['e/f']
+        self.assertNotIn('e',s.objects)
+        s.commit('third')
+        self.assertEqual(['a/b/c','a/d'],
+                         gitshelve.git('ls-tree','-r','--name-only',
+                                       'test').split('\n'))
+        s.close()
+
     def testGitshelveDelItem(self):
         s = gitshelve.gitshelve()
         s['temp/temp'] = 'temp'
@@ -405,6 +1366,47 @@ class t_gitshelve(unittest.TestCase):
         k = s.keys()
         s.close()
 
+    def testGitshelveScan(self):
+        s = gitshelve.gitshelve('scan')
+        for key in ('active/a', 'active/c/d', 'top', 'active-x', 'archived/z',
+                    'active/b'):
+            s[key] = key
+        allKeys = ['active-x', 'active/a', 'active/b', 'active/c/d',
+                   'archived/z', 'top']
+        self.assertEqual(allKeys, sorted(s.iterkeys()))
+        self.assertEqual(['active/a', 'active/b', 'active/c/d'],
+                         sorted(s.keys('active')))
+        self.assertEqual(['active/c/d'], s.keys('active/c/'))
+        self.assertEqual(['top'], s.keys('top'))
+        self.assertEqual([], s.keys('missing'))
+        self.assertEqual([], s.keys('top/missing'))
+        #ranges come out in order, whatever the depth
+        self.assertEqual(allKeys, s.keys(start=''))
+        self.assertEqual(allKeys[1:], s.keys(start='active/'))
+        self.assertEqual(['active/b', 'active/c/d'],
+                         s.keys(start='active/b', stop='archived/z'))
+        self.assertEqual(['active/c/d'],
+                         s.keys('active', start='active/bb'))
+        self.assertEqual(['active-x'], s.keys(stop='active/'))
+        self.assertEqual([('active/b', s.get_tree('active/b'))],
+                         s.items('active', 'active/b', 'active/c'))
+        self.assertEqual(['active/b'],
+                         [book.path for book in
+                          s.itervalues(start='active/b', stop='active/c')])
+        s.commit('scan')
+        s.close()
+
+        #only the trees that are scanned get listed
+        s = gitshelve.gitshelve.open('scan', lazy=True)
+        self.assertEqual(['archived/z'], list(s.iterkeys('archived')))
+        self.assertTrue('__lazy__' in s.objects['active'])
+        self.assertEqual(['top'], s.keys(start='b'))
+        self.assertTrue('__lazy__' in s.objects['active'])
+        self.assertEqual(['active/c/d'],
+                         s.keys(start='active/c', stop='active/d'))
+        self.assertTrue('__lazy__' not in s.objects['active'])
+        s.close()
+
     def testGitshelveGetAndSetState(self):
         import pickle
         s = gitshelve.gitshelve()